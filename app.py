@@ -1,22 +1,333 @@
-from flask import Flask, request, abort
+import time
+PROCESS_STARTED = time.perf_counter()
+
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from linebot.models import MessageEvent, TextMessage, TextSendMessage, QuickReply, QuickReplyButton, MessageAction
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+import requests
+from requests.adapters import HTTPAdapter
+import bisect
+import contextlib
+import csv
+import functools
+import hmac
+import io
+import importlib.util
+import json
 import os
+import queue
+import random
 import re
+import sqlite3
+import sys
+import threading
 import uuid
-import pandas as pd
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from apscheduler.schedulers.background import BackgroundScheduler
 
 app = Flask(__name__)
 
+# ---------- 效能指標（Prometheus 文字格式，由 GET /metrics 提供） ----------
+# METRICS_LOG_EVENTS=1 時，每個 LINE 事件處理完另外印出一行 JSON 計時紀錄。
+METRICS_LOG_EVENTS = os.getenv("METRICS_LOG_EVENTS", "0") == "1"
+# /metrics 等維運路由需以 Authorization: Bearer <METRICS_TOKEN> 存取（Prometheus 的 authorization 設定）；未設定時沿用 STATS_TOKEN
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "") or os.getenv("STATS_TOKEN", "")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 120)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+class Metrics:
+    """極簡的計數器 / 直方圖 / gauge 實作，單次記錄只需一次加鎖"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.helps = {}
+        self.local = threading.local()
+
+    def describe(self, name, help_text, kind):
+        self.helps[name] = (help_text, kind)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        i = bisect.bisect_left(buckets, value)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+            h[1][i] += 1
+            h[2] += value
+            h[3] += 1
+        event = getattr(self.local, "event", None)
+        if event is not None and name == "stage_seconds":
+            stage = labels.get("stage")
+            event["stages"][stage] = event["stages"].get(stage, 0.0) + value
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def gauge(self, name, help_text, func):
+        self.describe(name, help_text, "gauge")
+        self.gauges[name] = func
+
+    def count_sheets_call(self):
+        event = getattr(self.local, "event", None)
+        if event is not None:
+            event["sheets_calls"] += 1
+
+    def begin_event(self):
+        self.local.event = {"started": time.perf_counter(), "sheets_calls": 0, "stages": {}}
+
+    def end_event(self, **fields):
+        event = getattr(self.local, "event", None)
+        self.local.event = None
+        if event is None:
+            return
+        seconds = time.perf_counter() - event["started"]
+        self.observe("event_seconds", seconds)
+        self.observe("sheets_calls_per_event", event["sheets_calls"], buckets=COUNT_BUCKETS)
+        if METRICS_LOG_EVENTS:
+            print(json.dumps(dict(
+                fields,
+                ms=round(seconds * 1000, 2),
+                sheets_calls=event["sheets_calls"],
+                stages_ms={k: round(v * 1000, 2) for k, v in event["stages"].items()},
+            ), ensure_ascii=False))
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: [v[0], list(v[1]), v[2], v[3]] for k, v in self.histograms.items()}
+        seen = set()
+
+        def header(name, default_kind):
+            if name in seen:
+                return
+            seen.add(name)
+            help_text, kind = self.helps.get(name, (name, default_kind))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, counts, total, count) in sorted(histograms.items(), key=lambda x: (x[0][0], x[0][1])):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, c in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += c
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+metrics = Metrics()
+metrics.describe("stage_seconds", "Time spent per processing stage", "histogram")
+metrics.describe("event_seconds", "Time to handle one LINE event", "histogram")
+metrics.describe("sheets_calls_per_event", "Google Sheets API calls made while handling one LINE event", "histogram")
+metrics.describe("sheets_calls_total", "Google Sheets API calls", "counter")
+metrics.describe("sheets_errors_total", "Google Sheets API calls that raised", "counter")
+metrics.describe("cache_requests_total", "Cache lookups by cache and result", "counter")
+metrics.describe("sheets_throttle_seconds", "Time spent waiting for a Sheets rate-limit token", "histogram")
+metrics.describe("sheets_retries_total", "Sheets calls retried after 429/5xx or connection errors", "counter")
+metrics.describe("sheets_coalesced_total", "Sheets reads served by an identical read already in flight", "counter")
+metrics.describe("job_seconds", "Scheduled job duration", "histogram")
+metrics.describe("job_failures_total", "Scheduled job runs that raised", "counter")
+
+metrics.describe("line_send_seconds", "LINE Messaging API call latency, including retries", "histogram")
+metrics.describe("line_send_failures_total", "LINE Messaging API calls that failed after retries", "counter")
+metrics.describe("line_retries_total", "LINE Messaging API calls retried after 429/5xx or connection errors", "counter")
+metrics.describe("line_reply_fallbacks_total", "Replies sent with push_message because the reply token was expired or used", "counter")
+
 # ---------- LINE 設定 ----------
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+LINE_POOL_SIZE = int(os.getenv("LINE_POOL_SIZE", 10))
+LINE_TIMEOUT_SECONDS = float(os.getenv("LINE_TIMEOUT_SECONDS", 5))
+LINE_MAX_RETRIES = int(os.getenv("LINE_MAX_RETRIES", 3))
+LINE_BACKOFF_BASE = float(os.getenv("LINE_BACKOFF_BASE", 0.5))
+LINE_MAX_MESSAGES = 5  # 每次 reply / push 最多 5 則訊息
+
+# 目前執行緒這次送出使用的 X-Line-Retry-Key。LineBotApi 的 retry_key 參數會寫進共用的 api.headers 且不會移除，
+# 其他執行緒的呼叫也會帶到同一個 key，因此改由 PooledHttpClient 依執行緒加上
+line_retry_key = threading.local()
+
+class PooledHttpClient(RequestsHttpClient):
+    """所有 LINE API 呼叫共用一個 keep-alive 連線池"""
+
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=LINE_POOL_SIZE))
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        retry_key = getattr(line_retry_key, "value", None)
+        if retry_key:
+            headers = dict(headers or {}, **{"X-Line-Retry-Key": retry_key})
+        return RequestsHttpResponse(self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+def is_reply_token_error(e):
+    message = getattr(getattr(e, "error", None), "message", "") or ""
+    return e.status_code == 400 and "reply token" in message.lower()
+
+class Messenger:
+    """對外發送訊息的唯一出口，介面與 LineBotApi 相同。
+    處理事件期間的 reply_message 先暫存，事件結束時合併成一次呼叫送出；
+    429 / 5xx / 連線錯誤有限次數重試；reply token 已過期或已使用時改用 push_message 送給同一位用戶"""
+
+    def __init__(self, api):
+        self.api = api
+        self.local = threading.local()
+
+    def begin(self, event):
+        """開始處理一個事件：記住 reply token 對應的用戶，供改用 push 時使用"""
+        source = getattr(event, "source", None)
+        self.local.user_id = getattr(source, "user_id", None)
+        self.local.pending = OrderedDict()
+
+    def flush(self):
+        pending = getattr(self.local, "pending", None)
+        self.local.pending = None
+        for reply_token, messages in (pending or {}).items():
+            try:
+                self.send_reply(reply_token, messages, self.local.user_id)
+            except Exception as e:
+                print(f"回覆 LINE 訊息時發生錯誤: {e}")
+
+    def reply_message(self, reply_token, messages, **kwargs):
+        messages = list(messages) if isinstance(messages, (list, tuple)) else [messages]
+        pending = getattr(self.local, "pending", None)
+        if pending is None:
+            return self.send_reply(reply_token, messages, None)
+        pending.setdefault(reply_token, []).extend(messages)
+
+    def push_message(self, to, messages, **kwargs):
+        messages = list(messages) if isinstance(messages, (list, tuple)) else [messages]
+        for chunk in self.chunks(messages):
+            # 同一個 retry key 讓 LINE 忽略重試造成的重複送出
+            self.call("push_message", to, chunk, retry_key=str(uuid.uuid4()), **kwargs)
+
+    def multicast(self, to, messages, **kwargs):
+        self.call("multicast", to, messages, retry_key=str(uuid.uuid4()), **kwargs)
+
+    def __getattr__(self, name):
+        # 其他 API（例如 get_profile）直接交給 LineBotApi
+        return getattr(self.api, name)
+
+    @staticmethod
+    def pack(messages):
+        """超過 5 則時把相鄰的文字訊息合併，盡量一次送完"""
+        messages = list(messages)
+        while len(messages) > LINE_MAX_MESSAGES:
+            for i in range(len(messages) - 1):
+                a, b = messages[i], messages[i + 1]
+                if (isinstance(a, TextSendMessage) and isinstance(b, TextSendMessage)
+                        and not a.quick_reply and len(a.text) + len(b.text) + 2 <= 5000):
+                    messages[i:i + 2] = [TextSendMessage(text=f"{a.text}\n\n{b.text}", quick_reply=b.quick_reply)]
+                    break
+            else:
+                break
+        return messages
+
+    def chunks(self, messages):
+        messages = self.pack(messages)
+        return [messages[i:i + LINE_MAX_MESSAGES] for i in range(0, len(messages), LINE_MAX_MESSAGES)]
+
+    def send_reply(self, reply_token, messages, user_id):
+        chunks = self.chunks(messages)
+        if not chunks:
+            return
+        try:
+            self.call("reply_message", reply_token, chunks[0])
+        except LineBotApiError as e:
+            if not (is_reply_token_error(e) and user_id and not getattr(e, "maybe_delivered", False)):
+                raise
+            metrics.inc("line_reply_fallbacks_total")
+            self.push_message(user_id, chunks[0])
+        for chunk in chunks[1:]:
+            if user_id:
+                self.push_message(user_id, chunk)
+
+    def call(self, method, *args, retry_key=None, **kwargs):
+        started = time.perf_counter()
+        maybe_delivered = False
+        # 同一次送出的每次重試都帶同一個 key
+        line_retry_key.value = retry_key
+        try:
+            with metrics.timer("stage_seconds", stage=f"line.{method}"):
+                for attempt in range(LINE_MAX_RETRIES + 1):
+                    try:
+                        return getattr(self.api, method)(*args, **kwargs)
+                    except LineBotApiError as e:
+                        retryable = e.status_code == 429 or e.status_code >= 500
+                        if not retryable or attempt == LINE_MAX_RETRIES:
+                            # 重試前的 5xx 可能已送達：呼叫端不應再改用 push 重送
+                            e.maybe_delivered = maybe_delivered
+                            metrics.inc("line_send_failures_total", method=method, status=e.status_code)
+                            raise
+                        maybe_delivered = maybe_delivered or e.status_code >= 500
+                    except requests.exceptions.RequestException:
+                        if attempt == LINE_MAX_RETRIES:
+                            metrics.inc("line_send_failures_total", method=method, status="connection")
+                            raise
+                        maybe_delivered = True
+                    metrics.inc("line_retries_total", method=method)
+                    time.sleep(random.uniform(0, LINE_BACKOFF_BASE * (2 ** attempt)))
+        finally:
+            line_retry_key.value = None
+            metrics.observe("line_send_seconds", time.perf_counter() - started, method=method)
+
+line_bot_api = Messenger(LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, timeout=LINE_TIMEOUT_SECONDS, http_client=PooledHttpClient))
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
 # ---------- Google Sheets 初始化 ----------
@@ -26,11 +337,260 @@ scope = [
     "https://www.googleapis.com/auth/drive.file",
     "https://www.googleapis.com/auth/drive"
 ]
-creds = ServiceAccountCredentials.from_json_keyfile_name("/etc/secrets/coffee-bot-468008-86e28eaa87f3.json", scope)
-client = gspread.authorize(creds)
+GOOGLE_KEYFILE = "/etc/secrets/coffee-bot-468008-86e28eaa87f3.json"
 
 # 試算表名稱（請與你的 Google Sheets 名稱一致）
 SPREADSHEET_NAME = "coffee_orders"
+# 已知試算表 key 時直接以 key 開啟，省去 Drive 搜尋
+SPREADSHEET_KEY = os.getenv("SPREADSHEET_KEY")
+SHEETS_POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", 16))
+
+def api_status(e):
+    """取出 gspread APIError 的 HTTP 狀態碼；其他例外回傳 None"""
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None)
+
+# ---------- Sheets 配額控管（token bucket、相同讀取合併、退避重試） ----------
+# 讀、寫各一個 token bucket（每個行程的每分鐘上限，多 worker 時請依 worker 數分配）。
+# 排程工作以背景優先權執行：bucket 低於 SHEETS_FOREGROUND_RESERVE 比例時就讓給 webhook 請求。
+SHEETS_READS_PER_MINUTE = float(os.getenv("SHEETS_READS_PER_MINUTE", 60))
+SHEETS_WRITES_PER_MINUTE = float(os.getenv("SHEETS_WRITES_PER_MINUTE", 60))
+SHEETS_FOREGROUND_RESERVE = float(os.getenv("SHEETS_FOREGROUND_RESERVE", 0.3))
+SHEETS_ACQUIRE_TIMEOUT = float(os.getenv("SHEETS_ACQUIRE_TIMEOUT", 15))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", 5))
+SHEETS_BACKOFF_BASE = float(os.getenv("SHEETS_BACKOFF_BASE", 0.5))
+SHEETS_BACKOFF_CAP = float(os.getenv("SHEETS_BACKOFF_CAP", 32))
+
+SHEETS_READ_METHODS = {"get_all_values", "get_all_records", "row_values", "col_values", "get", "batch_get", "acell", "cell"}
+# 重送可能造成重複寫入的方法：只在 429（確定未執行）時重試
+SHEETS_NON_IDEMPOTENT = {"append_row", "append_rows", "insert_row", "insert_rows", "delete_rows", "add_worksheet"}
+
+sheets_priority = threading.local()
+
+@contextlib.contextmanager
+def background_priority():
+    """區塊內的 Sheets 呼叫以背景優先權執行（排程工作使用）"""
+    previous = getattr(sheets_priority, "background", False)
+    sheets_priority.background = True
+    try:
+        yield
+    finally:
+        sheets_priority.background = previous
+
+class TokenBucket:
+    """每分鐘 per_minute 個 token，最多累積四分之一分鐘的量；per_minute 為 0 表示不限制"""
+
+    def __init__(self, per_minute, reserve):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, per_minute / 4.0)
+        self.reserve = reserve
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.cond = threading.Condition()
+
+    def acquire(self, background=False, timeout=None):
+        """取得一個 token，回傳等待秒數。前景請求等待超過 timeout 時直接放行，交給退避重試處理"""
+        if self.rate <= 0:
+            return 0.0
+        started = time.monotonic()
+        floor = self.capacity * self.reserve if background else 0.0
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens - 1 >= floor:
+                    self.tokens -= 1
+                    return now - started
+                if timeout is not None and now - started >= timeout:
+                    return now - started
+                self.cond.wait((floor + 1 - self.tokens) / self.rate)
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SheetsGateway:
+    """所有 Sheets 呼叫的共同出口"""
+
+    RETRY_STATUSES = {500, 502, 503, 504}
+
+    def __init__(self):
+        self.buckets = {
+            "read": TokenBucket(SHEETS_READS_PER_MINUTE, SHEETS_FOREGROUND_RESERVE),
+            "write": TokenBucket(SHEETS_WRITES_PER_MINUTE, SHEETS_FOREGROUND_RESERVE),
+        }
+        self.lock = threading.Lock()
+        self.inflight = {}
+
+    def execute(self, kind, label, func, coalesce_key=None, idempotent=True, on_stale=None):
+        if coalesce_key is None:
+            return self._execute(kind, label, func, idempotent, on_stale)
+        with self.lock:
+            waiter = self.inflight.get(coalesce_key)
+            leader = waiter is None
+            if leader:
+                waiter = self.inflight[coalesce_key] = _InFlight()
+        if not leader:
+            # 同一份資料已有請求在途中，等它回來直接共用結果
+            metrics.inc("sheets_coalesced_total", method=label)
+            waiter.done.wait()
+            if waiter.error is not None:
+                raise waiter.error
+            result = waiter.result
+            return [list(r) if isinstance(r, list) else r for r in result] if isinstance(result, list) else result
+        try:
+            waiter.result = self._execute(kind, label, func, idempotent, on_stale)
+            return waiter.result
+        except Exception as e:
+            waiter.error = e
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(coalesce_key, None)
+            waiter.done.set()
+
+    def _execute(self, kind, label, func, idempotent, on_stale):
+        background = getattr(sheets_priority, "background", False)
+        attempt = 0
+        stale_retried = False
+        while True:
+            waited = self.buckets[kind].acquire(background, None if background else SHEETS_ACQUIRE_TIMEOUT)
+            if waited:
+                metrics.observe("sheets_throttle_seconds", waited, kind=kind)
+            metrics.inc("sheets_calls_total", method=label)
+            metrics.count_sheets_call()
+            try:
+                with metrics.timer("stage_seconds", stage=f"sheets.{label}"):
+                    return func()
+            except gspread.exceptions.APIError as e:
+                metrics.inc("sheets_errors_total", method=label)
+                status = api_status(e)
+                if status in (401, 404) and on_stale and not stale_retried:
+                    on_stale(status)
+                    stale_retried = True
+                    continue
+                retryable = status == 429 or (idempotent and status in self.RETRY_STATUSES)
+                if not retryable or attempt >= SHEETS_MAX_RETRIES:
+                    raise
+            except requests.exceptions.ConnectionError:
+                metrics.inc("sheets_errors_total", method=label)
+                if not idempotent or attempt >= SHEETS_MAX_RETRIES:
+                    raise
+            delay = random.uniform(0, min(SHEETS_BACKOFF_CAP, SHEETS_BACKOFF_BASE * 2 ** attempt))
+            attempt += 1
+            metrics.inc("sheets_retries_total", method=label)
+            time.sleep(delay)
+
+sheets_gateway = SheetsGateway()
+
+class Workbook:
+    """整個行程共用的試算表連線：只開啟一次試算表、快取工作表物件並共用一個 keep-alive 連線池。
+    token 過期時就地重新登入；工作表或試算表失效（401 / 404）時重開後重試一次"""
+
+    def __init__(self, name, key=None):
+        self.name = name
+        self.key = key
+        self.lock = threading.RLock()
+        self.creds = None
+        self.client = None
+        self._spreadsheet = None
+        self.worksheets = {}
+        # title → opener(title)：第一次取用該工作表時執行（建立工作表、檢查欄位）
+        self.openers = {}
+
+    def authorize(self):
+        with self.lock:
+            if self.client is not None:
+                return self.client
+            self.creds = ServiceAccountCredentials.from_json_keyfile_name(GOOGLE_KEYFILE, scope)
+            self.client = gspread.authorize(self.creds)
+            http_client = getattr(self.client, "http_client", self.client)
+            session = getattr(http_client, "session", None)
+            if session is not None:
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SHEETS_POOL_SIZE)
+                session.mount("https://", adapter)
+            return self.client
+
+    def login(self):
+        """重新取得 access token（沿用同一個 client 與連線池）"""
+        with self.lock:
+            client = self.authorize()
+            getattr(client, "http_client", client).login()
+
+    def ensure_token(self):
+        if self.creds is not None and getattr(self.creds, "access_token_expired", False):
+            self.login()
+
+    def spreadsheet(self):
+        with self.lock:
+            if self._spreadsheet is None:
+                client = self.authorize()
+                self._spreadsheet = client.open_by_key(self.key) if self.key else client.open(self.name)
+                self.key = self._spreadsheet.id
+            return self._spreadsheet
+
+    def worksheet(self, title):
+        with self.lock:
+            ws = self.worksheets.get(title)
+            if ws is None:
+                opener = self.openers.get(title)
+                ws = opener(title) if opener else self.spreadsheet().worksheet(title)
+                self.worksheets[title] = ws
+            return ws
+
+    def add_worksheet(self, title, rows, cols):
+        with self.lock:
+            ws = self.spreadsheet().add_worksheet(title=title, rows=str(rows), cols=str(cols))
+            self.worksheets[title] = ws
+            return ws
+
+    def invalidate(self):
+        with self.lock:
+            self._spreadsheet = None
+            self.worksheets = {}
+
+    def call(self, title, method, *args, **kwargs):
+        self.ensure_token()
+        kind = "read" if method in SHEETS_READ_METHODS else "write"
+        coalesce_key = (title, method, repr(args), repr(sorted(kwargs.items()))) if kind == "read" else None
+        return sheets_gateway.execute(
+            kind, method,
+            lambda: getattr(self.worksheet(title), method)(*args, **kwargs),
+            coalesce_key=coalesce_key,
+            idempotent=method not in SHEETS_NON_IDEMPOTENT,
+            on_stale=self.recover,
+        )
+
+    def recover(self, status):
+        """401：重新登入；404：工作表或試算表已失效，重新開啟"""
+        if status == 401:
+            self.login()
+        else:
+            self.invalidate()
+
+    def handle(self, title):
+        return WorksheetHandle(self, title)
+
+class WorksheetHandle:
+    """可長期持有的工作表代理：每次呼叫都透過 Workbook 取得目前有效的工作表物件"""
+
+    def __init__(self, workbook, title):
+        self.workbook = workbook
+        self.title = title
+
+    def __getattr__(self, name):
+        attr = getattr(self.workbook.worksheet(self.title), name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self.workbook.call(self.title, name, *args, **kwargs)
+        return call
+
+workbook = Workbook(SPREADSHEET_NAME, SPREADSHEET_KEY)
 
 # 預期欄位順序（主表）
 EXPECTED_HEADERS = [
@@ -47,13 +607,14 @@ BACKUP_HEADERS = [
 ]
 
 def get_or_create_ws(title, rows=1000, cols=20):
+    spreadsheet = workbook.spreadsheet()
     try:
-        ws = client.open(SPREADSHEET_NAME).worksheet(title)
+        ws = spreadsheet.worksheet(title)
     except Exception:
-        ws = client.open(SPREADSHEET_NAME).add_worksheet(title=title, rows=str(rows), cols=str(cols))
+        ws = spreadsheet.add_worksheet(title=title, rows=str(rows), cols=str(cols))
     headers_to_check = EXPECTED_HEADERS if title == "訂單清單" else BACKUP_HEADERS
-    values = ws.get_all_values()
-    if not values or values[0] != headers_to_check:
+    # 只讀第一列比對欄位名稱，不必下載整張表
+    if ws.row_values(1) != headers_to_check:
         try:
             ws.clear()
         except Exception:
@@ -61,11 +622,1906 @@ def get_or_create_ws(title, rows=1000, cols=20):
         ws.update([headers_to_check])
     return ws
 
-sheet = get_or_create_ws("訂單清單")
-backup_sheet = get_or_create_ws("已取消訂單")
+# 工作表在第一次使用時才開啟並檢查欄位（STARTUP_MODE=eager 時於啟動時預先執行）
+workbook.openers["訂單清單"] = get_or_create_ws
+workbook.openers["已取消訂單"] = get_or_create_ws
+sheet = workbook.handle("訂單清單")
+backup_sheet = workbook.handle("已取消訂單")
+
+# ---------- 共用：本機 SQLite 檔與 LRU + TTL 對照表 ----------
+def sqlite_connect(path):
+    return sqlite3.connect(path, timeout=10)
+
+class SQLiteStore:
+    """以本機 SQLite 檔（WAL，多個 worker 行程可同時讀寫）保存資料的元件；子類別需設定 self.path"""
+
+    def connect(self):
+        return sqlite_connect(self.path)
+
+    def open_wal(self):
+        """建立資料表時使用：切換為 WAL 模式的連線"""
+        conn = sqlite_connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def purge_table(self, table, key_column, time_column, ttl, max_entries):
+        """刪除 time_column 超過 ttl 秒的紀錄，並只保留最新的 max_entries 筆"""
+        with self.connect() as conn:
+            conn.execute(f"DELETE FROM {table} WHERE {time_column} < ?", (time.time() - ttl,))
+            conn.execute(
+                f"""DELETE FROM {table} WHERE {key_column} IN (
+                    SELECT {key_column} FROM {table} ORDER BY {time_column} DESC LIMIT -1 OFFSET ?
+                )""",
+                (max_entries,),
+            )
+
+class TTLCache:
+    """單一行程使用的 LRU + TTL 對照表：超過 ttl 秒未使用的項目失效，超過 max_entries 時淘汰最久未使用者。
+    項目依最後使用時間排列，過期的都在最前面"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, touch=True):
+        """回傳未過期的值，否則 None；touch=True 時這次讀取也算使用"""
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if now - item[0] > self.ttl:
+                del self.entries[key]
+                return None
+            if touch:
+                self.entries[key] = (now, item[1])
+                self.entries.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self._put(key, value)
+
+    def add(self, key, value):
+        """沒有未過期的同名項目時才寫入，回傳是否寫入"""
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None and now - item[0] <= self.ttl:
+                return False
+            self._put(key, value)
+            return True
+
+    def _put(self, key, value):
+        self.entries[key] = (time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def purge(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            while self.entries and next(iter(self.entries.values()))[0] < cutoff:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+# ---------- 訂單日誌（先寫入本機 SQLite，再由背景批次寫入 Sheets） ----------
+# 用戶確認訂單時只寫入本機日誌就回覆，背景執行緒再以 append_rows 批次送到「訂單清單」/「已取消訂單」。
+# 每個 (工作表, 訂單編號) 只會寫入一次；多個 gunicorn worker 共用同一個日誌檔時以 claim 欄位避免重複送出。
+ORDER_JOURNAL_PATH = os.getenv("ORDER_JOURNAL_PATH", "order_journal.db")
+JOURNAL_FLUSH_SECONDS = float(os.getenv("JOURNAL_FLUSH_SECONDS", 5))
+JOURNAL_BATCH_WINDOW_SECONDS = float(os.getenv("JOURNAL_BATCH_WINDOW_SECONDS", 1))
+JOURNAL_BATCH_SIZE = int(os.getenv("JOURNAL_BATCH_SIZE", 200))
+JOURNAL_CLAIM_SECONDS = 120
+
+class OrderJournal(SQLiteStore):
+    """可持久化的待寫入佇列"""
+
+    def __init__(self, path, worksheets, on_flushed=None):
+        self.path = path
+        self.worksheets = worksheets
+        self.on_flushed = on_flushed
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.flusher = None
+        self.started_at = time.time()
+        with self.open_wal() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    target TEXT NOT NULL,
+                    order_id TEXT NOT NULL,
+                    row_json TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    flushed_at REAL,
+                    row_number INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL DEFAULT 0,
+                    claimed_by TEXT,
+                    claimed_at REAL,
+                    last_error TEXT,
+                    UNIQUE (target, order_id)
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS journal_pending ON journal (target, flushed_at)")
+
+    def record(self, target, order_id, row):
+        """寫入日誌；同一張表同一訂單重複寫入時忽略。回傳是否為新紀錄"""
+        with self.connect() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO journal (target, order_id, row_json, created_at) VALUES (?, ?, ?, ?)",
+                (target, order_id, json.dumps(row, ensure_ascii=False), time.time()),
+            )
+            inserted = cur.rowcount == 1
+        self.start_flusher()
+        self.wakeup.set()
+        return inserted
+
+    def record_many(self, target, rows):
+        """一次交易寫入多列（購物車的各品項），flusher 會以同一次 append_rows 送出。回傳新紀錄數"""
+        now = time.time()
+        with self.connect() as conn:
+            inserted = 0
+            for row in rows:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO journal (target, order_id, row_json, created_at) VALUES (?, ?, ?, ?)",
+                    (target, row[0], json.dumps(row, ensure_ascii=False), now),
+                )
+                inserted += cur.rowcount
+        self.start_flusher()
+        self.wakeup.set()
+        return inserted
+
+    def pending_rows(self, target):
+        with self.connect() as conn:
+            cur = conn.execute(
+                "SELECT row_json FROM journal WHERE target = ? AND flushed_at IS NULL ORDER BY id", (target,)
+            )
+            return [json.loads(r[0]) for r in cur.fetchall()]
+
+    def pending_count(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM journal WHERE flushed_at IS NULL").fetchone()[0]
+
+    def _claim(self, target):
+        token = f"{os.getpid()}-{threading.get_ident()}"
+        now = time.time()
+        conn = self.connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                """UPDATE journal SET claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+                   WHERE id IN (
+                       SELECT id FROM journal
+                       WHERE target = ? AND flushed_at IS NULL AND next_attempt_at <= ?
+                         AND (claimed_at IS NULL OR claimed_at < ?)
+                       ORDER BY id LIMIT ?
+                   )""",
+                (token, now, target, now, now - JOURNAL_CLAIM_SECONDS, JOURNAL_BATCH_SIZE),
+            )
+            rows = conn.execute(
+                "SELECT id, order_id, row_json, attempts, created_at FROM journal WHERE claimed_by = ? AND claimed_at = ? ORDER BY id",
+                (token, now),
+            ).fetchall()
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def flush(self):
+        """把所有待寫入的列批次送出，回傳成功寫入的列數"""
+        written = 0
+        with self.flush_lock:
+            for target, ws in self.worksheets.items():
+                claimed = self._claim(target)
+                if not claimed:
+                    continue
+                ids = [r[0] for r in claimed]
+                try:
+                    # 先前嘗試過（可能已寫入但尚未標記）的列，先比對訂單編號欄避免重複寫入
+                    if any(r[3] > 1 or r[4] < self.started_at for r in claimed):
+                        existing = set(ws.col_values(1))
+                        fresh = [r for r in claimed if r[1] not in existing]
+                    else:
+                        fresh = claimed
+                    rows = [json.loads(r[2]) for r in fresh]
+                    first_row = None
+                    if rows:
+                        first_row = appended_row_number(ws.append_rows(rows))
+                    with self.connect() as conn:
+                        now = time.time()
+                        for i, r in enumerate(fresh):
+                            conn.execute(
+                                "UPDATE journal SET flushed_at = ?, row_number = ?, claimed_by = NULL, last_error = NULL WHERE id = ?",
+                                (now, first_row + i if first_row else None, r[0]),
+                            )
+                        conn.execute(
+                            f"UPDATE journal SET flushed_at = ?, claimed_by = NULL WHERE id IN ({','.join('?' * len(ids))}) AND flushed_at IS NULL",
+                            [now] + ids,
+                        )
+                    written += len(rows)
+                    if self.on_flushed and rows:
+                        self.on_flushed(target, rows, first_row)
+                except Exception as e:
+                    print(f"批次寫入「{target}」時發生錯誤: {e}")
+                    with self.connect() as conn:
+                        for r in claimed:
+                            delay = min(300, 2 ** r[3])
+                            conn.execute(
+                                "UPDATE journal SET claimed_by = NULL, claimed_at = NULL, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                                (time.time() + delay, str(e), r[0]),
+                            )
+        return written
+
+    def start_flusher(self):
+        # gunicorn fork 之後才啟動執行緒
+        if self.flusher and self.flusher.is_alive():
+            return
+        self.flusher = threading.Thread(target=self._flush_loop, name="order-journal-flusher", daemon=True)
+        self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self.wakeup.wait(JOURNAL_FLUSH_SECONDS)
+            if self.wakeup.is_set():
+                # 稍等一下，把同一波訂單集中成一次 append_rows
+                time.sleep(JOURNAL_BATCH_WINDOW_SECONDS)
+                self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"訂單日誌寫入時發生錯誤: {e}")
+
+def on_journal_flushed(target, rows, first_row):
+    if target == "訂單清單":
+        for i, row in enumerate(rows):
+            order_index.on_append(row, first_row + i if first_row else None)
+
+order_journal = OrderJournal(
+    ORDER_JOURNAL_PATH,
+    {"訂單清單": sheet, "已取消訂單": backup_sheet},
+    on_flushed=on_journal_flushed,
+)
+
+# ---------- 訂單索引（訂單編號 → 列號 / 列資料） ----------
+# 索引建立後，查詢 / 刪除 / 修改訂單都只查記憶體，不再整張表下載。
+# 員工也會直接在試算表上編輯，因此定期比對試算表最後更新時間，有變動時才重新同步。
+ORDER_INDEX_CHECK_SECONDS = int(os.getenv("ORDER_INDEX_CHECK_SECONDS", 60))
+ORDER_INDEX_RESYNC_MINUTES = int(os.getenv("ORDER_INDEX_RESYNC_MINUTES", 30))
+# 查無訂單時最多每隔幾秒重新同步一次（訂單可能是其他 worker 剛寫入的）
+ORDER_INDEX_MISS_RESYNC_SECONDS = int(os.getenv("ORDER_INDEX_MISS_RESYNC_SECONDS", 30))
+
+# 刪單時先把「狀態」改成此值（tombstone），再由排程一次批次刪除這些列
+TOMBSTONE_STATUS = "已取消"
+TOMBSTONE_COMPACT_MINUTES = int(os.getenv("TOMBSTONE_COMPACT_MINUTES", 60))
+
+class OrderIndex:
+    """在記憶體中保存「訂單清單」的 訂單編號 → (列號, 列資料) 對照表，
+    以及 顧客編號 → 訂單編號、(咖啡品名, 樣式) → 訂單編號 的次要索引"""
+
+    def __init__(self, ws, journal=None):
+        self.ws = ws
+        self.journal = journal
+        self.lock = threading.RLock()
+        self.headers = []
+        self.rows = {}
+        self.customers = {}
+        self.items = {}
+        self.loaded = False
+        self.last_sync = 0.0
+        self.last_update_time = None
+        self.version = 0
+        # 本行程對索引的異動記錄 (序號, 列號, 列資料)；列號為 "delete" 表示有列被刪除。
+        # 下載整張表期間發生的新增／修改在重建後補回，不會被舊內容蓋掉
+        self.seq = 0
+        self.changes = deque(maxlen=1000)
+        # 重新下載整張表的次數：本行程以外的異動只會經由重新同步進入索引
+        self.sync_count = 0
+        # 上次檢查後本行程是否寫過試算表（自己的寫入也會改變最後更新時間），以及最後一次寫入完成的時間
+        self.own_writes = False
+        self.last_write_at = 0.0
+        self.last_miss_resync = 0.0
+
+    def _log_change(self, row_number, row):
+        self.seq += 1
+        self.changes.append((self.seq, row_number, row))
+        if row_number is not None:
+            self.own_writes = True
+            self.last_write_at = time.time()
+
+    def resync(self):
+        """整張表重新讀取一次並重建索引"""
+        for _ in range(3):
+            with self.lock:
+                seq = self.seq
+            values = self.ws.get_all_values()
+            with self.lock:
+                missed = [c for c in self.changes if c[0] > seq]
+                if any(c[1] == "delete" for c in missed):
+                    # 下載期間有列被刪除：列號可能已移動，重新下載
+                    continue
+                self._rebuild(values)
+                for _, row_number, row in missed:
+                    entry = self.rows.get(row[0])
+                    # 下載結果已有列號時，不以日誌中（列號為 None）的狀態覆蓋
+                    if row_number is None and entry and entry[0] is not None:
+                        continue
+                    self._reindex(row[0], row)
+                    self.rows[row[0]] = (row_number, list(row))
+                return
+        with self.lock:
+            self._rebuild(values)
+
+    def _rebuild(self, values):
+        with self.lock:
+            self.headers = values[0] if values else list(EXPECTED_HEADERS)
+            self.rows = {}
+            for idx in range(1, len(values)):
+                row = values[idx]
+                if len(row) > 0 and row[0]:
+                    self.rows[row[0]] = (idx + 1, row)
+            # 尚在日誌中、還沒寫進試算表的訂單（列號為 None）
+            if self.journal:
+                for row in self.journal.pending_rows(self.ws.title):
+                    self.rows.setdefault(row[0], (None, row))
+            self.customers = {}
+            self.items = {}
+            for oid, (_, row) in self.rows.items():
+                self.customers.setdefault(self.customer_of(row), set()).add(oid)
+                self.items.setdefault(self.item_of(row), set()).add(oid)
+            self.loaded = True
+            self.last_sync = time.time()
+            self.sync_count += 1
+            self.version += 1
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            with self.lock:
+                if not self.loaded:
+                    self.resync()
+
+    def is_live(self, row):
+        """已標記為 tombstone 的列視為不存在"""
+        if "狀態" not in self.headers:
+            return True
+        i = self.headers.index("狀態")
+        return not (i < len(row) and row[i] == TOMBSTONE_STATUS)
+
+    def is_empty(self):
+        self.ensure_loaded()
+        with self.lock:
+            return not any(self.is_live(row) for _, row in self.rows.values())
+
+    def customer_of(self, row):
+        i = self.headers.index("顧客編號") if "顧客編號" in self.headers else EXPECTED_HEADERS.index("顧客編號")
+        return row[i] if i < len(row) else ""
+
+    def item_of(self, row):
+        values = []
+        for name in ("咖啡品名", "樣式"):
+            i = self.headers.index(name) if name in self.headers else EXPECTED_HEADERS.index(name)
+            values.append(row[i] if i < len(row) else "")
+        return tuple(values)
+
+    def _unindex(self, order_id, row):
+        for index, key in ((self.customers, self.customer_of(row)), (self.items, self.item_of(row))):
+            ids = index.get(key)
+            if ids:
+                ids.discard(order_id)
+
+    def _reindex(self, order_id, row):
+        """顧客編號或品項改變時（例如員工手動修改）同步更新次要索引"""
+        old = self.rows.get(order_id)
+        if old:
+            self._unindex(order_id, old[1])
+        self.customers.setdefault(self.customer_of(row), set()).add(order_id)
+        self.items.setdefault(self.item_of(row), set()).add(order_id)
+
+    def for_customer(self, user_id):
+        """該顧客所有有效訂單的 (列號, 列資料)，不讀取試算表"""
+        self.ensure_loaded()
+        with self.lock:
+            entries = [self.rows[oid] for oid in self.customers.get(user_id, ()) if oid in self.rows]
+            found = [e for e in entries if self.is_live(e[1])]
+        metrics.inc("cache_requests_total", cache="customer_index", result="hit" if found else "miss")
+        return found
+
+    def for_items(self, keys):
+        """指定 (咖啡品名, 樣式) 的有效訂單；keys 為 None 時回傳全部"""
+        self.ensure_loaded()
+        with self.lock:
+            if keys is None:
+                entries = list(self.rows.values())
+            else:
+                entries = [self.rows[oid] for key in keys for oid in self.items.get(key, ()) if oid in self.rows]
+            return [e for e in entries if self.is_live(e[1])]
+
+    def get(self, order_id):
+        self.ensure_loaded()
+        with self.lock:
+            entry = self.rows.get(order_id)
+            found = entry if entry and self.is_live(entry[1]) else None
+        metrics.inc("cache_requests_total", cache="order_index", result="hit" if found else "miss")
+        return found
+
+    def tombstoned_rows(self):
+        with self.lock:
+            return sorted(n for n, row in self.rows.values() if n is not None and not self.is_live(row))
+
+    def verify(self, order_id):
+        """寫入前讀取單一列確認列號仍對應該訂單；若被人工移動過就重新同步。
+        訂單尚未寫入試算表時先送出日誌；仍無法取得列號時回傳 None"""
+        entry = self.get(order_id)
+        if entry and entry[0] is None and self.journal:
+            self.journal.flush()
+            entry = self.get(order_id)
+        if entry and entry[0] is not None:
+            current = self.ws.row_values(entry[0])
+            if current and current[0] == order_id:
+                if not self.is_live(current):
+                    # 索引過期：這列已在試算表上被標記為 tombstone，視為不存在
+                    with self.lock:
+                        self.rows[order_id] = (entry[0], current)
+                        self.version += 1
+                    return None
+                return entry
+        self.resync()
+        entry = self.get(order_id)
+        return entry if entry and entry[0] is not None else None
+
+    def on_append(self, row, row_number=None):
+        """row_number 為 None 表示訂單仍在日誌中等待寫入"""
+        with self.lock:
+            self._reindex(row[0], row)
+            self.rows[row[0]] = (row_number, list(row))
+            self._log_change(row_number, list(row))
+            self.version += 1
+
+    def on_update(self, row_number, row):
+        with self.lock:
+            self._reindex(row[0], row)
+            self.rows[row[0]] = (row_number, list(row))
+            self._log_change(row_number, list(row))
+            self.version += 1
+
+    def on_delete_many(self, row_numbers):
+        """多列同時刪除後，依刪除位置一次調整其餘列號"""
+        deleted = sorted(row_numbers)
+        removed = set(deleted)
+        with self.lock:
+            shifted = {}
+            for oid, (n, row) in self.rows.items():
+                if n in removed:
+                    self._unindex(oid, row)
+                    continue
+                shifted[oid] = (n - bisect.bisect_left(deleted, n) if n is not None else None, row)
+            self.rows = shifted
+            self._log_change("delete", None)
+            self.version += 1
+
+    def check_for_changes(self):
+        """排程呼叫：試算表有變動或距上次同步過久時重新同步"""
+        try:
+            update_time = get_last_update_time(self.ws.spreadsheet)
+        except Exception as e:
+            print(f"讀取試算表更新時間時發生錯誤: {e}")
+            update_time = None
+        stale = time.time() - self.last_sync > ORDER_INDEX_RESYNC_MINUTES * 60
+        changed = update_time is not None and update_time != self.last_update_time
+        with self.lock:
+            own_writes, self.own_writes = self.own_writes, False
+            last_write_at = self.last_write_at
+        observed = parse_update_time(update_time) if changed else None
+        if self.loaded and own_writes and not stale and observed is not None and observed <= last_write_at:
+            # 最後一次變動不晚於本行程最後一次寫入：視為自己的寫入，索引已同步更新，不必重新下載。
+            # 更早的其他 worker 寫入由查無訂單時的重新同步（resync_after_miss）或下次變動補上
+            self.last_update_time = update_time
+            return
+        if not self.loaded or stale or changed:
+            try:
+                self.resync()
+                self.last_update_time = update_time
+            except Exception as e:
+                print(f"同步訂單索引時發生錯誤: {e}")
+
+    def resync_after_miss(self):
+        """查無訂單時重新同步（每 ORDER_INDEX_MISS_RESYNC_SECONDS 秒最多一次），回傳是否有重新同步"""
+        with self.lock:
+            if time.time() - self.last_miss_resync < ORDER_INDEX_MISS_RESYNC_SECONDS:
+                return False
+            self.last_miss_resync = time.time()
+        try:
+            self.resync()
+        except Exception as e:
+            print(f"同步訂單索引時發生錯誤: {e}")
+            return False
+        return True
+
+def parse_update_time(value):
+    """試算表最後更新時間（RFC 3339，例如 2026-10-17T08:00:00.123Z）轉成 epoch 秒；無法解析時回傳 None"""
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+def appended_row_number(resp):
+    """從 append_row 回應的 updatedRange（例如 '訂單清單'!A120:N120）取出列號"""
+    try:
+        m = re.search(r'![A-Z]+(\d+)', resp["updates"]["updatedRange"])
+        return int(m.group(1))
+    except Exception:
+        return None
+
+def get_last_update_time(spreadsheet):
+    # gspread 6 以後改為方法；舊版為屬性
+    getter = getattr(spreadsheet, "get_lastUpdateTime", None)
+    if getter:
+        return getter()
+    return spreadsheet.lastUpdateTime
+
+order_index = OrderIndex(sheet, order_journal)
+
+# ---------- 訂單存取層 ----------
+# handle_message 與統計排程只透過 order_repo 讀寫訂單。
+# ORDER_BACKEND=sheets（預設）：直接以「訂單清單」為主檔，搭配上方的索引與日誌。
+# ORDER_BACKEND=sqlite：本機 SQLite 為主檔，異動再非同步鏡像到「訂單清單」供員工查看。
+ORDER_BACKEND = os.getenv("ORDER_BACKEND", "sheets")
+ORDER_DB_PATH = os.getenv("ORDER_DB_PATH", "orders.db")
+ORDER_SHEET_MIRROR = os.getenv("ORDER_SHEET_MIRROR", "1") == "1"
+MIRROR_RETRY_SECONDS = float(os.getenv("MIRROR_RETRY_SECONDS", 5))
+# 同一筆異動重播失敗超過此次數就移到 outbox_dead，不再阻擋其他異動
+MIRROR_MAX_ATTEMPTS = int(os.getenv("MIRROR_MAX_ATTEMPTS", 8))
+
+def order_time_key(value):
+    """去掉「(已修改)」標記，回傳可直接比較大小的下單時間字串"""
+    return re.sub(r'\s*\(已修改\)\s*', '', str(value or "")).strip()
+
+class OrderRepository:
+    """訂單存取介面；列資料皆為依 headers() 欄位順序排列的字串 list"""
+
+    def headers(self):
+        raise NotImplementedError
+
+    def is_empty(self):
+        raise NotImplementedError
+
+    def get(self, order_id):
+        raise NotImplementedError
+
+    def list_by_customer(self, user_id):
+        raise NotImplementedError
+
+    def list_between(self, start, end):
+        """下單時間介於 [start, end) 的訂單；start / end 為 'YYYY-MM-DD' 或 'YYYY-MM-DD HH:MM'，可為 None"""
+        raise NotImplementedError
+
+    def all_values(self):
+        """與 worksheet.get_all_values() 相同格式：第一列為欄位名稱"""
+        raise NotImplementedError
+
+    def version(self):
+        """每次訂單異動都會改變的版本號，供排程判斷是否需要重新計算"""
+        raise NotImplementedError
+
+    def external_version(self):
+        """只在發現本行程以外的異動（其他 worker、員工手動修改）時改變；本行程自己的寫入不影響"""
+        return self.version()
+
+    def add(self, row):
+        raise NotImplementedError
+
+    def add_many(self, rows):
+        """一次寫入同一張購物車訂單的多列"""
+        raise NotImplementedError
+
+    def update(self, order_id, row):
+        raise NotImplementedError
+
+    def cancel(self, order_id, delete_time):
+        """刪除訂單並寫入「已取消訂單」，回傳被刪除的列；找不到時丟出 LookupError"""
+        raise NotImplementedError
+
+    def cancel_many(self, order_ids, delete_time):
+        """一次刪除多筆訂單（購物車的所有品項列），全部成功或全部不動；回傳被刪除的列。
+        任一筆找不到時丟出 LookupError"""
+        raise NotImplementedError
+
+    def archive(self, order_ids):
+        """把已結案的訂單移出主檔（封存內容由 order_archive 保存），回傳移出筆數"""
+        raise NotImplementedError
+
+    def reprice(self, prices, keys=None):
+        """依價格表修正 keys 品項（None 為全部）進行中訂單的單價與總金額，回傳修正筆數"""
+        raise NotImplementedError
+
+    def iter_rows(self):
+        """逐筆產生訂單列（不含標題列），供串流匯出使用"""
+        raise NotImplementedError
+
+    def set_status(self, order_ids, status, from_statuses=None):
+        """以一次批次寫入把多筆訂單的「狀態」改成 status，回傳實際修改筆數；
+        給定 from_statuses 時只修改目前狀態在其中的訂單"""
+        raise NotImplementedError
+
+    def price_fixes(self, rows, prices):
+        """回傳 {訂單編號: (單價, 總金額)}，只包含進行中且金額與價格表不符的訂單"""
+        fixes = {}
+        for row in rows:
+            if self.field(row, "狀態") not in PRICE_PROPAGATE_STATUSES:
+                continue
+            key = (self.field(row, "咖啡品名"), self.field(row, "樣式"))
+            if key not in prices:
+                continue
+            unit_price = prices[key]
+            total = format_number(unit_price * to_number(self.field(row, "數量")))
+            if self.field(row, "單價") != str(unit_price) or self.field(row, "總金額") != total:
+                fixes[row[0]] = (str(unit_price), total)
+        return fixes
+
+    def field(self, row, name):
+        headers = self.headers()
+        if name not in headers:
+            return ""
+        i = headers.index(name)
+        return row[i] if i < len(row) else ""
+
+    def recent_for_user(self, user_id, limit):
+        """該用戶最近的 limit 筆訂單（新到舊）；limit 為 None 時回傳全部"""
+        rows = self.list_by_customer(user_id)
+        rows.sort(key=lambda row: order_time_key(self.field(row, "下單時間")), reverse=True)
+        return rows[:limit]
+
+    def refresh_after_miss(self):
+        """查無訂單時讓本行程的快取追上其他 worker 的寫入；有重新讀取時回傳 True"""
+        return False
+
+    def find_for_user(self, order_id, user_id):
+        """只回傳屬於該用戶的訂單"""
+        row = self.get(order_id)
+        if not row or self.field(row, "顧客編號") != user_id:
+            return None
+        return row
+
+    def order_lines(self, order_id, user_id):
+        """購物車訂單（編號為「訂單編號-序號」）屬於該用戶的所有品項列，依序號排列"""
+        lines = [row for row in self.list_by_customer(user_id) if cart_order_id(row[0]) == order_id and row[0] != order_id]
+        lines.sort(key=lambda row: int(row[0].rsplit("-", 1)[1]))
+        return lines
+
+    def backup_row(self, row, delete_time):
+        headers = self.headers()
+        row_dict = {headers[i]: (row[i] if i < len(row) else "") for i in range(len(headers))}
+        row_dict["刪單時間"] = delete_time
+        return [row_dict.get(h, "") for h in BACKUP_HEADERS]
+
+    def in_range(self, row, start, end):
+        t = order_time_key(self.field(row, "下單時間"))
+        return (start is None or t >= start) and (end is None or t < end)
+
+class SheetsOrderRepository(OrderRepository):
+    """以「訂單清單」為主檔：讀取走記憶體索引，新增走日誌批次寫入"""
+
+    def __init__(self, ws, index, journal):
+        self.ws = ws
+        self.index = index
+        self.journal = journal
+        # 修改、刪單與壓縮互斥，避免列號在寫入途中被移動
+        self.write_lock = threading.RLock()
+
+    def headers(self):
+        self.index.ensure_loaded()
+        return self.index.headers
+
+    def is_empty(self):
+        return self.index.is_empty()
+
+    def get(self, order_id):
+        entry = self.index.get(order_id)
+        return entry[1] if entry else None
+
+    def refresh_after_miss(self):
+        return self.index.resync_after_miss()
+
+    def rows(self):
+        self.index.ensure_loaded()
+        with self.index.lock:
+            entries = [e for e in self.index.rows.values() if self.index.is_live(e[1])]
+        # 已寫入的依列號排序，日誌中尚未寫入的排在最後
+        entries.sort(key=lambda e: (e[0] is None, e[0] or 0))
+        return [row for _, row in entries]
+
+    def list_by_customer(self, user_id):
+        entries = self.index.for_customer(user_id)
+        entries.sort(key=lambda e: (e[0] is None, e[0] or 0))
+        return [row for _, row in entries]
+
+    def list_between(self, start, end):
+        return [row for row in self.rows() if self.in_range(row, start, end)]
+
+    def all_values(self):
+        return [list(self.headers())] + self.rows()
+
+    def version(self):
+        return self.index.version
+
+    def external_version(self):
+        return self.index.sync_count
+
+    def add(self, row):
+        self.journal.record(self.ws.title, row[0], row)
+        self.index.on_append(row)
+
+    def add_many(self, rows):
+        self.journal.record_many(self.ws.title, rows)
+        for row in rows:
+            self.index.on_append(row)
+
+    def update(self, order_id, row):
+        with self.write_lock:
+            entry = self.index.verify(order_id)
+            if not entry:
+                raise LookupError("訂單已被移動或刪除")
+            self.ws.update(f"A{entry[0]}", [row])
+            self.index.on_update(entry[0], row)
+
+    def cancel(self, order_id, delete_time):
+        """只把「狀態」改成 tombstone 並寫入「已取消訂單」，實際刪列交給 compact()"""
+        with self.write_lock:
+            entry = self.index.verify(order_id)
+            if not entry:
+                raise LookupError("訂單已被移動或刪除")
+            row_number, row = entry
+            status_idx = self.index.headers.index("狀態")
+            self.ws.update(gspread.utils.rowcol_to_a1(row_number, status_idx + 1), [[TOMBSTONE_STATUS]])
+            # 標記成功後才寫入備份，標記失敗時訂單仍有效，不能出現在「已取消訂單」
+            self.journal.record("已取消訂單", order_id, self.backup_row(row, delete_time))
+            tombstone = list(row) + [""] * max(0, status_idx + 1 - len(row))
+            tombstone[status_idx] = TOMBSTONE_STATUS
+            self.index.on_update(row_number, tombstone)
+            return row
+
+    def cancel_many(self, order_ids, delete_time, missing_ok=False):
+        """以一次 batch_update 把多列標記為 tombstone；missing_ok 時略過已不在試算表的列（鏡像重播使用）"""
+        with self.write_lock:
+            entries = []
+            for order_id in order_ids:
+                entry = self.index.verify(order_id)
+                if entry:
+                    entries.append(entry)
+                elif not missing_ok:
+                    raise LookupError("訂單已被移動或刪除")
+            if not entries:
+                return []
+            status_idx = self.index.headers.index("狀態")
+            self.ws.batch_update([{"range": gspread.utils.rowcol_to_a1(n, status_idx + 1), "values": [[TOMBSTONE_STATUS]]}
+                                  for n, _ in entries])
+            self.journal.record_many("已取消訂單", [self.backup_row(row, delete_time) for _, row in entries])
+            for row_number, row in entries:
+                tombstone = list(row) + [""] * max(0, status_idx + 1 - len(row))
+                tombstone[status_idx] = TOMBSTONE_STATUS
+                self.index.on_update(row_number, tombstone)
+            return [row for _, row in entries]
+
+    def compact(self):
+        """把所有 tombstone 列以一次 batch_update 刪除（排程呼叫），回傳刪除列數"""
+        try:
+            with self.write_lock, self.journal.flush_lock:
+                # 以最新內容決定列號
+                self.index.resync()
+                row_numbers = self.index.tombstoned_rows()
+                if not row_numbers:
+                    return 0
+                self.delete_rows(row_numbers)
+                return len(row_numbers)
+        except Exception as e:
+            print(f"刪除已取消訂單列時發生錯誤: {e}")
+            return 0
+
+    def delete_rows(self, row_numbers):
+        """以一次 batch_update 刪除多列並調整索引；呼叫端需持有 write_lock 與 journal.flush_lock"""
+        ranges = []
+        for n in sorted(row_numbers):
+            if ranges and ranges[-1][1] == n - 1:
+                ranges[-1][1] = n
+            else:
+                ranges.append([n, n])
+        # 由下往上刪，前面的刪除才不會影響後面的列號
+        requests = [{
+            "deleteDimension": {
+                "range": {"sheetId": self.ws.id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end}
+            }
+        } for start, end in reversed(ranges)]
+        spreadsheet = self.ws.spreadsheet
+        try:
+            # 刪除列不可重送：第一次其實已成功時，重送會刪到往上移的其他訂單。
+            # 失敗時不重試，由下次排程（壓縮、封存）重新同步後再刪
+            sheets_gateway.execute("write", "spreadsheet.batch_update",
+                                   lambda: spreadsheet.batch_update({"requests": requests}), idempotent=False)
+        except Exception:
+            # 不確定是否已刪除：列號可能已移動，重新下載索引
+            with contextlib.suppress(Exception):
+                self.index.resync()
+            raise
+        self.index.on_delete_many(row_numbers)
+
+    def reprice(self, prices, keys=None):
+        with self.write_lock:
+            # 先送出日誌並確認索引沒有過期，才能以索引中的列號寫入
+            self.journal.flush()
+            self.index.check_for_changes()
+            rows = [row for n, row in self.index.for_items(keys) if n is not None]
+            return self.apply_prices(self.price_fixes(rows, prices))
+
+    def iter_rows(self):
+        self.index.check_for_changes()
+        yield from self.rows()
+
+    def set_status(self, order_ids, status, from_statuses=None):
+        with self.write_lock:
+            self.journal.flush()
+            self.index.check_for_changes()
+            col = self.index.headers.index("狀態") + 1
+            updates, applied = [], []
+            for order_id in order_ids:
+                entry = self.index.get(order_id)
+                if not entry or entry[0] is None:
+                    continue
+                n, row = entry
+                current = self.field(row, "狀態")
+                if current == status or (from_statuses is not None and current not in from_statuses):
+                    continue
+                updates.append({"range": gspread.utils.rowcol_to_a1(n, col), "values": [[status]]})
+                new_row = list(row) + [""] * max(0, col - len(row))
+                new_row[col - 1] = status
+                applied.append((n, new_row))
+            if updates:
+                self.ws.batch_update(updates)
+            for n, new_row in applied:
+                self.index.on_update(n, new_row)
+            return len(applied)
+
+    def apply_prices(self, fixes):
+        """把 {訂單編號: (單價, 總金額)} 以一次 batch_update 寫入，只動這兩個欄位"""
+        if not fixes:
+            return 0
+        with self.write_lock:
+            headers = self.index.headers
+            price_col = headers.index("單價") + 1
+            total_col = headers.index("總金額") + 1
+            updates, applied = [], []
+            for order_id, (unit_price, total) in fixes.items():
+                entry = self.index.get(order_id)
+                if not entry or entry[0] is None:
+                    continue
+                n, row = entry
+                if total_col == price_col + 1:
+                    updates.append({"range": f"{gspread.utils.rowcol_to_a1(n, price_col)}:{gspread.utils.rowcol_to_a1(n, total_col)}",
+                                    "values": [[unit_price, total]]})
+                else:
+                    updates.append({"range": gspread.utils.rowcol_to_a1(n, price_col), "values": [[unit_price]]})
+                    updates.append({"range": gspread.utils.rowcol_to_a1(n, total_col), "values": [[total]]})
+                new_row = list(row) + [""] * max(0, total_col - len(row), price_col - len(row))
+                new_row[price_col - 1] = unit_price
+                new_row[total_col - 1] = total
+                applied.append((n, new_row))
+            if updates:
+                self.ws.batch_update(updates)
+            for n, new_row in applied:
+                self.index.on_update(n, new_row)
+            return len(applied)
+
+    def archive(self, order_ids):
+        """把訂單搬到各月份的封存工作表（每個月份一次 append_rows），再一次刪除主表上的列"""
+        with self.write_lock, self.journal.flush_lock:
+            self.index.resync()
+            entries = [self.index.rows[oid] for oid in order_ids if oid in self.index.rows]
+            entries = [(n, row) for n, row in entries if n is not None]
+            if not entries:
+                return 0
+            headers = list(self.index.headers)
+            by_month = {}
+            for _, row in entries:
+                by_month.setdefault(archive_month(row, headers), []).append(row)
+            for month, rows in by_month.items():
+                ws = get_archive_ws(month)
+                # 上次搬移途中失敗時，已寫入封存表的訂單不再重複寫入
+                existing = set(ws.col_values(1))
+                missing = [row for row in rows if row[0] not in existing]
+                if missing:
+                    ws.append_rows(missing)
+            self.delete_rows([n for n, _ in entries])
+            return len(entries)
+
+class SQLiteOrderRepository(OrderRepository, SQLiteStore):
+    """以本機 SQLite 為主檔；所有異動寫入 outbox，由背景執行緒依序重播到鏡像（SheetsOrderRepository）"""
+
+    def __init__(self, path, mirror=None):
+        self.path = path
+        self.mirror = mirror
+        self.wakeup = threading.Event()
+        self.mirror_thread = None
+        with self.open_wal() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS orders (
+                    order_id TEXT PRIMARY KEY,
+                    customer_id TEXT NOT NULL,
+                    order_time TEXT NOT NULL,
+                    row_json TEXT NOT NULL,
+                    product TEXT NOT NULL DEFAULT '',
+                    style TEXT NOT NULL DEFAULT '',
+                    status TEXT NOT NULL DEFAULT ''
+                )"""
+            )
+            if "product" not in [r[1] for r in conn.execute("PRAGMA table_info(orders)")]:
+                # 舊版主檔：補上 咖啡品名／樣式／狀態 欄位供改價時以索引查詢
+                for column in ("product", "style", "status"):
+                    conn.execute(f"ALTER TABLE orders ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+                for order_id, row_json in conn.execute("SELECT order_id, row_json FROM orders").fetchall():
+                    conn.execute("UPDATE orders SET product = ?, style = ?, status = ? WHERE order_id = ?",
+                                 self._item_columns(json.loads(row_json)) + (order_id,))
+            conn.execute("CREATE INDEX IF NOT EXISTS orders_customer ON orders (customer_id, order_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS orders_time ON orders (order_time)")
+            conn.execute("CREATE INDEX IF NOT EXISTS orders_item ON orders (product, style, status)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS cancelled_orders (
+                    order_id TEXT PRIMARY KEY,
+                    customer_id TEXT NOT NULL,
+                    row_json TEXT NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    order_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    done_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (done_at, id)")
+            if "next_attempt_at" not in [r[1] for r in conn.execute("PRAGMA table_info(outbox)")]:
+                conn.execute("ALTER TABLE outbox ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS outbox_dead (
+                    id INTEGER PRIMARY KEY,
+                    op TEXT NOT NULL,
+                    order_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    last_error TEXT,
+                    failed_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS revision (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO revision (id, value) VALUES (1, 0)")
+        self.seeded = False
+        self.seed_lock = threading.Lock()
+        # 本行程遞增 revision 的次數；revision 減去此值只在其他行程或員工修改時改變
+        self.own_bumps = 0
+
+    def _open(self):
+        return sqlite_connect(self.path)
+
+    def connect(self):
+        self.ensure_seeded()
+        return self._open()
+
+    def ensure_seeded(self):
+        """主檔為空時，第一次使用前由試算表匯入既有訂單"""
+        if self.seeded:
+            return
+        with self.seed_lock:
+            if self.seeded:
+                return
+            with self._open() as conn:
+                empty = conn.execute("SELECT 1 FROM orders LIMIT 1").fetchone() is None
+            if empty and self.mirror:
+                self.import_rows(self.mirror.all_values())
+            self.seeded = True
+
+    def import_rows(self, values):
+        """第一次啟用時由試算表匯入既有訂單（不再鏡像回去）"""
+        if len(values) < 2:
+            return
+        headers = values[0]
+        with self._open() as conn:
+            for row in values[1:]:
+                if not row or not row[0]:
+                    continue
+                row_dict = {headers[i]: (row[i] if i < len(row) else "") for i in range(len(headers))}
+                self._upsert(conn, [row_dict.get(h, "") for h in EXPECTED_HEADERS])
+
+    def _upsert(self, conn, row):
+        self._bump(conn)
+        conn.execute(
+            "INSERT OR REPLACE INTO orders (order_id, customer_id, order_time, row_json, product, style, status) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (row[0], self.field(row, "顧客編號"), order_time_key(self.field(row, "下單時間")), json.dumps(row, ensure_ascii=False))
+            + self._item_columns(row),
+        )
+
+    def _item_columns(self, row):
+        return self.field(row, "咖啡品名"), self.field(row, "樣式"), self.field(row, "狀態")
+
+    def _bump(self, conn, own=True):
+        conn.execute("UPDATE revision SET value = value + 1 WHERE id = 1")
+        if own:
+            self.own_bumps += 1
+
+    def _enqueue(self, conn, op, order_id, payload):
+        if self.mirror:
+            conn.execute(
+                "INSERT INTO outbox (op, order_id, payload) VALUES (?, ?, ?)",
+                (op, order_id, json.dumps(payload, ensure_ascii=False)),
+            )
+
+    def _query(self, sql, params=()):
+        with self.connect() as conn:
+            return [json.loads(r[0]) for r in conn.execute(sql, params).fetchall()]
+
+    def headers(self):
+        return EXPECTED_HEADERS
+
+    def is_empty(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT 1 FROM orders LIMIT 1").fetchone() is None
+
+    def get(self, order_id):
+        rows = self._query("SELECT row_json FROM orders WHERE order_id = ?", (order_id,))
+        return rows[0] if rows else None
+
+    def list_by_customer(self, user_id):
+        return self._query("SELECT row_json FROM orders WHERE customer_id = ? ORDER BY order_time", (user_id,))
+
+    def list_between(self, start, end):
+        return self._query(
+            "SELECT row_json FROM orders WHERE order_time >= ? AND order_time < ? ORDER BY order_time",
+            (start or "", end or "\uffff"),
+        )
+
+    def all_values(self):
+        return [list(EXPECTED_HEADERS)] + self._query("SELECT row_json FROM orders ORDER BY rowid")
+
+    def version(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT value FROM revision WHERE id = 1").fetchone()[0]
+
+    def external_version(self):
+        return self.version() - self.own_bumps
+
+    def add(self, row):
+        with self.connect() as conn:
+            self._upsert(conn, row)
+            self._enqueue(conn, "add", row[0], row)
+        self.notify_mirror()
+
+    def add_many(self, rows):
+        with self.connect() as conn:
+            for row in rows:
+                self._upsert(conn, row)
+            self._enqueue(conn, "add_many", rows[0][0], rows)
+        self.notify_mirror()
+
+    def update(self, order_id, row):
+        with self.connect() as conn:
+            if conn.execute("SELECT 1 FROM orders WHERE order_id = ?", (order_id,)).fetchone() is None:
+                raise LookupError("訂單已被刪除")
+            self._upsert(conn, row)
+            self._enqueue(conn, "update", order_id, row)
+        self.notify_mirror()
+
+    def cancel(self, order_id, delete_time):
+        with self.connect() as conn:
+            found = conn.execute("SELECT row_json FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            if found is None:
+                raise LookupError("訂單已被刪除")
+            row = json.loads(found[0])
+            conn.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
+            self._bump(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO cancelled_orders (order_id, customer_id, row_json) VALUES (?, ?, ?)",
+                (order_id, self.field(row, "顧客編號"), json.dumps(self.backup_row(row, delete_time), ensure_ascii=False)),
+            )
+            self._enqueue(conn, "cancel", order_id, delete_time)
+        self.notify_mirror()
+        return row
+
+    def cancel_many(self, order_ids, delete_time):
+        rows = []
+        with self.connect() as conn:
+            for order_id in order_ids:
+                found = conn.execute("SELECT row_json FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+                if found is None:
+                    # 離開 with 時整筆交易復原
+                    raise LookupError("訂單已被刪除")
+                row = json.loads(found[0])
+                conn.execute("DELETE FROM orders WHERE order_id = ?", (order_id,))
+                self._bump(conn)
+                conn.execute(
+                    "INSERT OR REPLACE INTO cancelled_orders (order_id, customer_id, row_json) VALUES (?, ?, ?)",
+                    (order_id, self.field(row, "顧客編號"), json.dumps(self.backup_row(row, delete_time), ensure_ascii=False)),
+                )
+                rows.append(row)
+            self._enqueue(conn, "cancel_many", "", {"order_ids": list(order_ids), "delete_time": delete_time})
+        self.notify_mirror()
+        return rows
+
+    def reprice(self, prices, keys=None):
+        statuses = sorted(PRICE_PROPAGATE_STATUSES)
+        in_statuses = ",".join("?" * len(statuses))
+        with self.connect() as conn:
+            # 只以索引取出受影響品項的進行中訂單
+            if keys is None:
+                found = conn.execute(f"SELECT row_json FROM orders WHERE status IN ({in_statuses})", statuses).fetchall()
+            else:
+                found = []
+                for product, style in set(keys):
+                    found += conn.execute(
+                        f"SELECT row_json FROM orders WHERE product = ? AND style = ? AND status IN ({in_statuses})",
+                        [product, style] + statuses,
+                    ).fetchall()
+            rows = [json.loads(r[0]) for r in found]
+            fixes = self.price_fixes(rows, prices)
+            if not fixes:
+                return 0
+            price_idx = EXPECTED_HEADERS.index("單價")
+            total_idx = EXPECTED_HEADERS.index("總金額")
+            for row in rows:
+                if row[0] in fixes:
+                    row[price_idx], row[total_idx] = fixes[row[0]]
+                    self._upsert(conn, row)
+            self._enqueue(conn, "reprice", "", fixes)
+        self.notify_mirror()
+        return len(fixes)
+
+    def iter_rows(self):
+        conn = self.connect()
+        try:
+            cursor = conn.execute("SELECT row_json FROM orders ORDER BY order_time")
+            while True:
+                batch = cursor.fetchmany(500)
+                if not batch:
+                    break
+                for (row_json,) in batch:
+                    yield json.loads(row_json)
+        finally:
+            conn.close()
+
+    def set_status(self, order_ids, status, from_statuses=None):
+        status_idx = EXPECTED_HEADERS.index("狀態")
+        changed = []
+        with self.connect() as conn:
+            for order_id in order_ids:
+                found = conn.execute("SELECT row_json FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+                if found is None:
+                    continue
+                row = json.loads(found[0])
+                if row[status_idx] == status or (from_statuses is not None and row[status_idx] not in from_statuses):
+                    continue
+                row[status_idx] = status
+                self._upsert(conn, row)
+                changed.append(order_id)
+            if changed:
+                self._enqueue(conn, "status", "", {"order_ids": changed, "status": status,
+                                                   "from_statuses": None if from_statuses is None else sorted(from_statuses)})
+        if changed:
+            self.notify_mirror()
+        return len(changed)
+
+    def archive(self, order_ids):
+        with self.connect() as conn:
+            conn.executemany("DELETE FROM orders WHERE order_id = ?", [(oid,) for oid in order_ids])
+            self._bump(conn)
+            self._enqueue(conn, "archive", "", list(order_ids))
+        self.notify_mirror()
+        return len(order_ids)
+
+    # ----- 鏡像到試算表 -----
+    def notify_mirror(self):
+        if not self.mirror:
+            return
+        # gunicorn fork 之後才啟動執行緒
+        if not (self.mirror_thread and self.mirror_thread.is_alive()):
+            self.mirror_thread = threading.Thread(target=self._mirror_loop, name="order-sheet-mirror", daemon=True)
+            self.mirror_thread.start()
+        self.wakeup.set()
+
+    def _mirror_loop(self):
+        while True:
+            self.wakeup.wait(MIRROR_RETRY_SECONDS)
+            self.wakeup.clear()
+            try:
+                self.replay_outbox()
+            except Exception as e:
+                print(f"鏡像訂單到試算表時發生錯誤: {e}")
+
+    def replay_outbox(self):
+        """依序重播尚未完成的異動，回傳完成筆數。
+        失敗的異動依次數退避重試，涉及相同訂單的後續異動（包括批次異動）先暫停以保持先後順序，其他訂單照常重播；
+        失敗超過 MIRROR_MAX_ATTEMPTS 次的移到 outbox_dead，新增被移走的訂單之後的修改／刪除也一併移過去"""
+        now = time.time()
+        with self.connect() as conn:
+            pending = conn.execute(
+                "SELECT id, op, order_id, payload, attempts, next_attempt_at FROM outbox WHERE done_at IS NULL ORDER BY id"
+            ).fetchall()
+            dead = self.dead_added_ids(conn)
+        blocked = set()
+        done = 0
+        for op_id, op, order_id, payload, attempts, next_attempt_at in pending:
+            payload = json.loads(payload)
+            # 批次異動（改價、改狀態、封存、整車刪除）的 order_id 為空，彼此之間也保持順序
+            keys = self.op_order_ids(op, order_id, payload) | {order_id}
+            if keys & blocked or next_attempt_at > now:
+                blocked |= keys
+                continue
+            if op in ("update", "cancel") and order_id in dead:
+                # 試算表上沒有這筆訂單，修改／刪除不能當作已完成
+                with self.connect() as conn:
+                    self._dead_letter(conn, op_id, op, order_id, attempts, "訂單的新增已移到 outbox_dead")
+                continue
+            try:
+                self.replay_op(op, order_id, payload)
+            except Exception as e:
+                attempts += 1
+                with self.connect() as conn:
+                    if attempts >= MIRROR_MAX_ATTEMPTS:
+                        print(f"鏡像異動 #{op_id}（{op} {order_id}）失敗 {attempts} 次，移到 outbox_dead: {e}")
+                        self._dead_letter(conn, op_id, op, order_id, attempts, str(e))
+                        if op in ("add", "add_many"):
+                            dead |= keys
+                    else:
+                        print(f"鏡像異動 #{op_id}（{op} {order_id}）失敗，第 {attempts} 次: {e}")
+                        conn.execute(
+                            "UPDATE outbox SET attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                            (attempts, str(e), time.time() + min(300, MIRROR_RETRY_SECONDS * 2 ** attempts), op_id),
+                        )
+                        blocked |= keys
+                continue
+            with self.connect() as conn:
+                conn.execute("UPDATE outbox SET done_at = ? WHERE id = ?", (time.time(), op_id))
+            done += 1
+        return done
+
+    def _dead_letter(self, conn, op_id, op, order_id, attempts, error):
+        conn.execute(
+            "INSERT OR REPLACE INTO outbox_dead (id, op, order_id, payload, attempts, last_error, failed_at) "
+            "SELECT id, op, order_id, payload, ?, ?, ? FROM outbox WHERE id = ?",
+            (attempts, error, time.time(), op_id),
+        )
+        conn.execute("DELETE FROM outbox WHERE id = ?", (op_id,))
+        metrics.inc("order_mirror_dead_ops_total", op=op)
+
+    def dead_added_ids(self, conn):
+        """新增已移到 outbox_dead、因此不在試算表上的訂單編號"""
+        ids = set()
+        for op, order_id, payload in conn.execute(
+            "SELECT op, order_id, payload FROM outbox_dead WHERE op IN ('add', 'add_many')"
+        ):
+            ids |= self.op_order_ids(op, order_id, json.loads(payload))
+        return ids
+
+    def dead_count(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM outbox_dead").fetchone()[0]
+
+    def replay_op(self, op, order_id, payload):
+        if op == "add":
+            self.mirror.add(payload)
+        elif op == "add_many":
+            self.mirror.add_many(payload)
+        elif op in ("update", "cancel"):
+            try:
+                if op == "update":
+                    self.mirror.update(order_id, payload)
+                else:
+                    self.mirror.cancel(order_id, payload)
+            except LookupError:
+                # 已不在試算表（先前已刪除或員工手動移除），沒有可鏡像的列
+                pass
+        elif op == "cancel_many":
+            self.mirror.cancel_many(payload["order_ids"], payload["delete_time"], missing_ok=True)
+        elif op == "archive":
+            self.mirror.archive(payload)
+        elif op == "reprice":
+            self.mirror.apply_prices({oid: tuple(v) for oid, v in payload.items()})
+        elif op == "status":
+            from_statuses = payload.get("from_statuses")
+            self.mirror.set_status(payload["order_ids"], payload["status"],
+                                   None if from_statuses is None else set(from_statuses))
+
+    @staticmethod
+    def op_order_ids(op, order_id, payload):
+        """異動涉及的訂單編號（批次異動的編號在 payload 中）"""
+        if op == "add_many":
+            return {row[0] for row in payload}
+        if op in ("archive", "reprice"):
+            return set(payload)
+        if op in ("status", "cancel_many"):
+            return set(payload["order_ids"])
+        return {order_id}
+
+    def pending_order_ids(self, conn):
+        """outbox 中尚未重播的異動涉及的訂單編號"""
+        ids = set()
+        for op, order_id, payload in conn.execute("SELECT op, order_id, payload FROM outbox WHERE done_at IS NULL"):
+            ids |= self.op_order_ids(op, order_id, json.loads(payload))
+        return ids
+
+    def pull_staff_edits(self):
+        """員工在試算表上修改的「狀態」拉回本機主檔（排程呼叫）"""
+        if not self.mirror:
+            return
+        try:
+            values = self.mirror.all_values()
+        except Exception as e:
+            print(f"讀取試算表狀態時發生錯誤: {e}")
+            return
+        headers = values[0] if values else []
+        if "狀態" not in headers:
+            return
+        status_idx = headers.index("狀態")
+        status_by_id = {row[0]: row[status_idx] for row in values[1:] if row and len(row) > status_idx}
+        local_status_idx = EXPECTED_HEADERS.index("狀態")
+        with self.connect() as conn:
+            # 尚未鏡像到試算表的訂單以本機為準，否則剛改的狀態會被試算表上的舊值蓋回
+            unsynced = self.pending_order_ids(conn)
+            for order_id, row_json in conn.execute("SELECT order_id, row_json FROM orders").fetchall():
+                if order_id in unsynced:
+                    continue
+                status = status_by_id.get(order_id)
+                row = json.loads(row_json)
+                if status is not None and status != row[local_status_idx]:
+                    row[local_status_idx] = status
+                    # 員工的修改：即時統計需要重建
+                    self._bump(conn, own=False)
+                    conn.execute(
+                        "UPDATE orders SET row_json = ?, status = ? WHERE order_id = ?",
+                        (json.dumps(row, ensure_ascii=False), status, order_id),
+                    )
+
+sheets_order_repo = SheetsOrderRepository(sheet, order_index, order_journal)
+metrics.describe("order_mirror_dead_ops_total", "Order changes moved to outbox_dead after failing to mirror", "counter")
+if ORDER_BACKEND == "sqlite":
+    order_repo = SQLiteOrderRepository(ORDER_DB_PATH, mirror=sheets_order_repo if ORDER_SHEET_MIRROR else None)
+else:
+    order_repo = sheets_order_repo
+
+# ---------- 訂單編號與封存 ----------
+# 訂單編號為 YYMM + 4 碼 base36 流水號（例如 2610004F），依時間遞增且由共用的 SQLite 計數器發號，不會重複。
+# 購物車訂單的每個品項各佔一列，編號為「訂單編號-序號」（例如 2610004F-1、2610004F-2）。
+# 已結案（ARCHIVE_STATUSES）且下單超過 ARCHIVE_AFTER_DAYS 天的訂單由排程搬到「訂單封存-YYYY-MM」工作表，
+# 主表只保留進行中的訂單；封存內容同時存入本機 SQLite，供查詢與報表使用而不必讀取封存工作表。
+ORDER_ARCHIVE_DB_PATH = os.getenv("ORDER_ARCHIVE_DB_PATH", "order_archive.db")
+ORDER_ID_DB_PATH = os.getenv("ORDER_ID_DB_PATH", ORDER_ARCHIVE_DB_PATH)
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 30))
+ARCHIVE_STATUSES = {s.strip() for s in os.getenv("ARCHIVE_STATUSES", "已送達,已完成").split(",") if s.strip()}
+ARCHIVE_CHECK_HOURS = int(os.getenv("ARCHIVE_CHECK_HOURS", 24))
+ARCHIVE_SHEET_PREFIX = "訂單封存-"
+ORDER_ID_PATTERN = re.compile(r'^(\d{2})(0[1-9]|1[0-2])[0-9A-Z]{4,}(?:-\d+)?$')
+# 購物車訂單每個品項一列，編號為「訂單編號-序號」
+CART_LINE_PATTERN = re.compile(r'^(\d{4}[0-9A-Z]{4,})-(\d+)$')
+BASE36_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def to_base36(n):
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = BASE36_DIGITS[r] + digits
+        if n == 0:
+            return digits
+
+def order_id_month(order_id):
+    """由新格式訂單編號取出月份（YYYY-MM）；舊的隨機編號回傳 None"""
+    m = ORDER_ID_PATTERN.match(order_id or "")
+    return f"20{m.group(1)}-{m.group(2)}" if m else None
+
+def cart_line_id(order_id, line_no):
+    return f"{order_id}-{line_no}"
+
+def cart_order_id(order_id):
+    """購物車品項列的編號換回訂單編號；一般訂單原樣回傳"""
+    m = CART_LINE_PATTERN.match(order_id or "")
+    return m.group(1) if m else order_id
+
+def archive_month(row, headers):
+    """封存分區：新格式編號依編號月份，舊編號依下單時間"""
+    month = order_id_month(row[0])
+    if month:
+        return month
+    i = headers.index("下單時間") if "下單時間" in headers else -1
+    t = order_time_key(row[i] if 0 <= i < len(row) else "")
+    return t[:7] if re.match(r'^\d{4}-\d{2}', t) else "未知"
+
+class OrderIdAllocator(SQLiteStore):
+    """每個月份一個計數器；BEGIN IMMEDIATE 保證多個 worker 同時下單也拿到不同號碼"""
+
+    def __init__(self, path):
+        self.path = path
+        with self.open_wal() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS order_id_seq (month TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def next_id(self, now):
+        month = now.strftime("%y%m")
+        conn = self.connect()
+        try:
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR IGNORE INTO order_id_seq (month, value) VALUES (?, 0)", (month,))
+            conn.execute("UPDATE order_id_seq SET value = value + 1 WHERE month = ?", (month,))
+            value = conn.execute("SELECT value FROM order_id_seq WHERE month = ?", (month,)).fetchone()[0]
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return month + to_base36(value).rjust(4, "0")
+
+class OrderArchive(SQLiteStore):
+    """已封存訂單的本機副本（所有 worker 共用）"""
+
+    def __init__(self, path):
+        self.path = path
+        with self.open_wal() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS archived_orders (
+                    order_id TEXT PRIMARY KEY,
+                    month TEXT NOT NULL,
+                    customer_id TEXT NOT NULL,
+                    archived_at REAL NOT NULL,
+                    row_json TEXT NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS archived_orders_month ON archived_orders (month)")
+
+    def add(self, headers, rows):
+        now = time.time()
+        with self.connect() as conn:
+            for row in rows:
+                row_dict = {h: (row[i] if i < len(row) else "") for i, h in enumerate(headers)}
+                conn.execute(
+                    "INSERT OR REPLACE INTO archived_orders (order_id, month, customer_id, archived_at, row_json) VALUES (?, ?, ?, ?, ?)",
+                    (row[0], archive_month(row, headers), row_dict.get("顧客編號", ""), now, json.dumps(row_dict, ensure_ascii=False)),
+                )
+
+    def get(self, order_id):
+        """依編號所屬月份直接查該分區；舊編號以主鍵查詢"""
+        month = order_id_month(order_id)
+        with self.connect() as conn:
+            if month:
+                found = conn.execute(
+                    "SELECT row_json FROM archived_orders WHERE month = ? AND order_id = ?", (month, order_id)
+                ).fetchone()
+            else:
+                found = conn.execute("SELECT row_json FROM archived_orders WHERE order_id = ?", (order_id,)).fetchone()
+        if found is None:
+            return None
+        row_dict = json.loads(found[0])
+        return [row_dict.get(h, "") for h in EXPECTED_HEADERS]
+
+    def rows(self):
+        with self.connect() as conn:
+            found = conn.execute("SELECT row_json FROM archived_orders ORDER BY month, order_id").fetchall()
+        return [[d.get(h, "") for h in EXPECTED_HEADERS] for d in (json.loads(r[0]) for r in found)]
+
+    def size(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM archived_orders").fetchone()[0]
+
+order_ids = OrderIdAllocator(ORDER_ID_DB_PATH)
+order_archive = OrderArchive(ORDER_ARCHIVE_DB_PATH)
+
+def new_order_id(now):
+    """發出新的訂單編號；與舊的隨機編號撞號時跳過"""
+    while True:
+        order_id = order_ids.next_id(now)
+        if order_repo.get(order_id) is None and order_archive.get(order_id) is None:
+            return order_id
+
+def get_archive_ws(month):
+    title = f"{ARCHIVE_SHEET_PREFIX}{month}"
+    try:
+        workbook.worksheet(title)
+    except Exception:
+        workbook.add_worksheet(title, 1000, len(EXPECTED_HEADERS))
+        workbook.handle(title).update([EXPECTED_HEADERS])
+    return workbook.handle(title)
+
+def find_order_for_user(order_id, user_id):
+    """先查主檔，再依編號月份查封存；回傳 (列資料, 是否已封存)"""
+    row = order_repo.find_for_user(order_id, user_id)
+    if row:
+        return row, False
+    row = order_archive.get(order_id)
+    if row and order_repo.field(row, "顧客編號") == user_id:
+        return row, True
+    return None, False
+
+def find_order_lines_for_user(order_id, user_id, refresh=True):
+    """同 find_order_for_user，但輸入購物車訂單編號時回傳所有品項列；回傳 (列資料 list, 是否已封存)"""
+    row, archived = find_order_for_user(order_id, user_id)
+    if row:
+        return [row], archived
+    lines = order_repo.order_lines(order_id, user_id)
+    if lines:
+        return lines, False
+    while True:
+        row = order_archive.get(cart_line_id(order_id, len(lines) + 1))
+        if not row or order_repo.field(row, "顧客編號") != user_id:
+            if not lines and refresh and order_repo.refresh_after_miss():
+                # 可能是其他 worker 剛寫入、本行程索引還沒同步的訂單
+                return find_order_lines_for_user(order_id, user_id, refresh=False)
+            return lines, bool(lines)
+        lines.append(row)
+
+def archive_orders():
+    """把已結案且過期的訂單移出主表（排程呼叫），回傳封存筆數"""
+    if ARCHIVE_AFTER_DAYS <= 0 or not ARCHIVE_STATUSES:
+        return 0
+    cutoff = (datetime.utcnow() + timedelta(hours=8) - timedelta(days=ARCHIVE_AFTER_DAYS)).strftime('%Y-%m-%d %H:%M')
+    values = order_repo.all_values()
+    headers = values[0] if values else list(EXPECTED_HEADERS)
+    rows = [row for row in values[1:]
+            if row and row[0] and order_repo.field(row, "狀態") in ARCHIVE_STATUSES
+            and order_time_key(order_repo.field(row, "下單時間")) < cutoff]
+    if not rows:
+        return 0
+    # 先寫入本機封存再移出主檔；中途失敗時訂單會同時存在兩邊，下次執行再移出
+    order_archive.add(headers, rows)
+    moved = order_repo.archive([row[0] for row in rows])
+    print(f"已封存 {moved} 筆結案訂單")
+    return moved
+
+def report_values():
+    """報表用的訂單：主檔加上封存（兩邊都有時以主檔為準）"""
+    values = order_repo.all_values()
+    hot = {row[0] for row in values[1:] if row}
+    return values + [row for row in order_archive.rows() if row[0] not in hot]
+
+# ---------- 即時銷售統計 ----------
+# 依 日、月、咖啡品名、樣式、顧客編號 累計 [訂單筆數, 數量, 總金額]，下單／修改／刪單時即時更新。
+# 購物車的多個品項列只算一筆訂單。啟動時由 report_values()（記憶體索引或本機主檔，加上封存）重建；
+# 其他 worker 或員工的異動由排程在 order_repo.external_version() 改變時重建，本行程自己的寫入已即時計入。
+STATS_TOKEN = os.getenv("STATS_TOKEN", "")
+SALES_STATS_REFRESH_SECONDS = int(os.getenv("SALES_STATS_REFRESH_SECONDS", 60))
+SALES_STATS_DIMENSIONS = ("day", "month", "product", "style", "customer")
+
+class SalesCounters:
+    """每筆訂單記住自己的貢獻，異動時先扣除舊值再加上新值"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contributions = {}
+        self.totals = {d: {} for d in SALES_STATS_DIMENSIONS}
+        self.version = None
+        self.rebuilt_at = None
+
+    @staticmethod
+    def contribution(row, headers=EXPECTED_HEADERS):
+        f = {h: (row[i] if i < len(row) else "") for i, h in enumerate(headers)}
+        t = order_time_key(f.get("下單時間"))
+        keys = {
+            "day": t[:10],
+            "month": t[:7],
+            "product": f.get("咖啡品名", ""),
+            "style": f.get("樣式", ""),
+            "customer": f.get("顧客編號", ""),
+        }
+        return keys, to_number(f.get("數量")), to_number(f.get("總金額"))
+
+    def _add(self, order_id, contribution, sign):
+        keys, qty, total = contribution
+        base_id = cart_order_id(order_id)
+        for dim, key in keys.items():
+            # [訂單編號 → 品項列數, 數量, 總金額]；訂單筆數為不同訂單編號的數目
+            entry = self.totals[dim].setdefault(key, [{}, 0, 0])
+            lines = entry[0].get(base_id, 0) + sign
+            if lines > 0:
+                entry[0][base_id] = lines
+            else:
+                entry[0].pop(base_id, None)
+            entry[1] += sign * qty
+            entry[2] += sign * total
+            if not entry[0]:
+                del self.totals[dim][key]
+
+    def record(self, row):
+        """新增或修改訂單"""
+        if not row or not row[0] or row[EXPECTED_HEADERS.index("狀態")] == TOMBSTONE_STATUS:
+            return
+        new = self.contribution(row)
+        with self.lock:
+            old = self.contributions.get(row[0])
+            if old:
+                self._add(row[0], old, -1)
+            self._add(row[0], new, 1)
+            self.contributions[row[0]] = new
+
+    def remove(self, order_id):
+        with self.lock:
+            old = self.contributions.pop(order_id, None)
+            if old:
+                self._add(order_id, old, -1)
+
+    def rebuild(self):
+        version = order_repo.external_version()
+        values = report_values()
+        headers = values[0] if values else list(EXPECTED_HEADERS)
+        contributions = {row[0]: self.contribution(row, headers) for row in values[1:] if row and row[0]}
+        with self.lock:
+            self.contributions = {}
+            self.totals = {d: {} for d in SALES_STATS_DIMENSIONS}
+            for oid, c in contributions.items():
+                self.contributions[oid] = c
+                self._add(oid, c, 1)
+            self.version = version
+            self.rebuilt_at = time.time()
+
+    def refresh(self):
+        """排程呼叫：有本行程以外的異動（其他 worker、員工修改）才重建"""
+        if order_repo.external_version() != self.version:
+            self.rebuild()
+
+    def summary(self, day=None, month=None, top=10):
+        now = datetime.utcnow() + timedelta(hours=8)
+        day = day or now.strftime("%Y-%m-%d")
+        month = month or now.strftime("%Y-%m")
+
+        def entry(values):
+            orders, qty, total = values or ({}, 0, 0)
+            return {"orders": len(orders), "quantity": qty, "total": total}
+
+        def ranked(dim):
+            items = sorted(self.totals[dim].items(), key=lambda kv: kv[1][2], reverse=True)[:top]
+            return [dict(entry(v), key=k) for k, v in items]
+
+        with self.lock:
+            return {
+                "day": dict(entry(self.totals["day"].get(day)), key=day),
+                "month": dict(entry(self.totals["month"].get(month)), key=month),
+                "all": {"orders": sum(len(v[0]) for v in self.totals["month"].values()),
+                        "quantity": sum(v[1] for v in self.totals["month"].values()),
+                        "total": sum(v[2] for v in self.totals["month"].values())},
+                "products": ranked("product"),
+                "styles": ranked("style"),
+                "customers": ranked("customer"),
+                "orders_tracked": len(self.contributions),
+                "rebuilt_at": self.rebuilt_at,
+            }
+
+sales_stats = SalesCounters()
+
+def sales_stats_text():
+    stats = sales_stats.summary(top=5)
+
+    def line(label, e):
+        return f"{label}：{e['orders']} 筆／數量 {format_number(e['quantity'])}／金額 {format_number(e['total'])}"
+
+    lines = ["📊 即時銷售統計", line(f"今日 {stats['day']['key']}", stats["day"]), line(f"本月 {stats['month']['key']}", stats["month"]),
+             line("累計", stats["all"]), "---", "熱銷品項："]
+    lines += [f"{p['key']}：數量 {format_number(p['quantity'])}／金額 {format_number(p['total'])}" for p in stats["products"]]
+    lines += ["樣式："] + [f"{p['key']}：數量 {format_number(p['quantity'])}" for p in stats["styles"]]
+    return "\n".join(lines)
+
+def require_token(expected):
+    """管理用路由：以 Authorization: Bearer <token> 驗證；未設定 token 時一律拒絕。
+    不接受網址參數（?token= 會留在存取記錄中）"""
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not expected or not hmac.compare_digest(token.encode(), expected.encode()):
+        abort(403)
+
+@app.route("/stats", methods=['GET'])
+def stats_route():
+    require_token(STATS_TOKEN)
+    top = request.args.get("top", "10")
+    return jsonify(sales_stats.summary(request.args.get("day"), request.args.get("month"), int(top) if top.isdigit() else 10))
+
+# ---------- 出貨匯出 ----------
+# GET /export/orders?format=csv|ndjson&status=處理中&start=2026-10-01&end=2026-10-08
+# 以 generator 逐筆輸出，記憶體用量不隨訂單數成長。資料來源：
+# EXPORT_SOURCE=local（預設）：order_repo（記憶體索引或本機 SQLite）；sheet：以 EXPORT_CHUNK_ROWS 列為一段分段讀取「訂單清單」。
+# 以 POST 並帶 mark=1 時，送出最後一筆之前把其中尚未出貨（EXPORT_MARKABLE_STATUSES）的訂單以一次批次寫入改成「已出貨」，
+# 並在檔尾加一行結果：CSV 為「#marked=筆數」或「#error=原因」，NDJSON 為 {"_marked": 筆數} 或 {"_error": 原因}。
+# 沒有結果行的檔案表示傳輸中斷，不能確定訂單是否已標記。
+EXPORT_TOKEN = os.getenv("EXPORT_TOKEN", "") or STATS_TOKEN
+EXPORT_SOURCE = os.getenv("EXPORT_SOURCE", "local")
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 500))
+EXPORT_MARK_STATUS = "已出貨"
+# 只有尚未出貨的訂單會被標記（空白狀態視為處理中），避免已送達等訂單被改回已出貨並再次通知顧客
+EXPORT_MARKABLE_STATUSES = {s.strip() for s in os.getenv("EXPORT_MARKABLE_STATUSES", "處理中,").split(",")}
+
+def iter_sheet_rows(ws, chunk_rows):
+    """分段讀取工作表；每次只保留一段在記憶體中，回傳 (標題列, 資料列 generator)"""
+    headers = ws.row_values(1)
+    last_col = gspread.utils.rowcol_to_a1(1, max(len(headers), 1))[:-1]
+
+    def rows():
+        start = 2
+        while True:
+            chunk = ws.get(f"A{start}:{last_col}{start + chunk_rows - 1}")
+            if not chunk:
+                return
+            for row in chunk:
+                if row and row[0]:
+                    yield [row[i] if i < len(row) else "" for i in range(len(headers))]
+            if len(chunk) < chunk_rows:
+                return
+            start += chunk_rows
+    return headers, rows()
+
+def row_status(headers, row):
+    i = headers.index("狀態") if "狀態" in headers else len(row)
+    return row[i] if i < len(row) else ""
+
+def export_rows(statuses, start, end):
+    if EXPORT_SOURCE == "sheet":
+        headers, rows = iter_sheet_rows(sheet, EXPORT_CHUNK_ROWS)
+    else:
+        headers, rows = list(order_repo.headers()), order_repo.iter_rows()
+    time_idx = headers.index("下單時間") if "下單時間" in headers else None
+    for row in rows:
+        status = row_status(headers, row)
+        if status == TOMBSTONE_STATUS or (statuses is not None and status not in statuses):
+            continue
+        t = order_time_key(row[time_idx] if time_idx is not None and time_idx < len(row) else "")
+        # end 依給定的精確度包含在內，例如 end=2026-10-08 含當天全部訂單
+        if (start and t < start) or (end and t[:len(end)] > end):
+            continue
+        yield headers, row
+
+@app.route("/export/orders", methods=['GET', 'POST'])
+def export_orders_route():
+    require_token(EXPORT_TOKEN)
+    fmt = request.args.get("format", "csv")
+    if fmt not in ("csv", "ndjson"):
+        abort(400)
+    statuses = None
+    if "status" in request.args:
+        statuses = {s.strip() for s in request.args.get("status", "").split(",")}
+    start = request.args.get("start") or None
+    end = request.args.get("end") or None
+    mark = request.method == "POST" and request.args.get("mark") == "1"
+
+    def generate():
+        exported = []
+        header_written = False
+        # 標記時保留最後一段，等標記完成才送出，客戶端收到完整檔案時標記結果已確定
+        held = None
+        for headers, row in export_rows(statuses, start, end):
+            if fmt == "csv":
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                if not header_written:
+                    # BOM 讓 Excel 以 UTF-8 開啟
+                    buf.write("\ufeff")
+                    writer.writerow(headers)
+                    header_written = True
+                writer.writerow(row)
+                chunk = buf.getvalue()
+            else:
+                chunk = json.dumps(dict(zip(headers, row)), ensure_ascii=False) + "\n"
+            if mark and row_status(headers, row) in EXPORT_MARKABLE_STATUSES:
+                exported.append(row[0])
+            if not mark:
+                yield chunk
+                continue
+            if held is not None:
+                yield held
+            held = chunk
+        if not mark:
+            return
+        try:
+            marked = order_repo.set_status(exported, EXPORT_MARK_STATUS, EXPORT_MARKABLE_STATUSES) if exported else 0
+            print(f"出貨匯出：{marked} 筆訂單已標記為{EXPORT_MARK_STATUS}")
+            result = ("marked", marked)
+        except Exception as e:
+            print(f"標記已出貨時發生錯誤: {e}")
+            result = ("error", str(e).replace("\n", " "))
+        if held is not None:
+            yield held
+        if fmt == "csv":
+            yield f"#{result[0]}={result[1]}\n"
+        else:
+            yield json.dumps({f"_{result[0]}": result[1]}, ensure_ascii=False) + "\n"
+
+    filename = f"orders-{(datetime.utcnow() + timedelta(hours=8)).strftime('%Y%m%d-%H%M')}.{fmt}"
+    mimetype = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson; charset=utf-8"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 # ---------- 使用者狀態 ----------
-user_states = {}
+# 每位用戶一筆紀錄：{"state": ..., "temp_order": {...}, "temp_modify": {...}}
+# 閒置超過 SESSION_TTL_SECONDS 自動失效，超過 SESSION_MAX_ENTRIES 時淘汰最久未使用者。
+# SESSION_BACKEND=sqlite 時多個 gunicorn worker 共用同一個 SQLite（WAL）檔，不需要 sticky routing。
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", 1800))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", 10000))
+
+def new_session(state="init", **data):
+    return dict(data, state=state)
+
+class MemorySessionStore:
+    """單一行程使用的 LRU + TTL 狀態表"""
+
+    def __init__(self, ttl, max_entries):
+        self.entries = TTLCache(ttl, max_entries)
+
+    def get(self, user_id):
+        data = self.entries.get(user_id)
+        return json.loads(data) if data is not None else new_session()
+
+    def save(self, user_id, session):
+        self.entries.put(user_id, json.dumps(session, ensure_ascii=False))
+
+    def clear(self, user_id):
+        self.entries.pop(user_id)
+
+    def purge(self):
+        self.entries.purge()
+
+    def size(self):
+        return len(self.entries)
+
+class SQLiteSessionStore(SQLiteStore):
+    """多個 worker 行程共用的狀態表（SQLite WAL）"""
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with self.open_wal() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS sessions (
+                    user_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated_at)")
+
+    def get(self, user_id):
+        with self.connect() as conn:
+            found = conn.execute(
+                "SELECT data FROM sessions WHERE user_id = ? AND updated_at >= ?",
+                (user_id, time.time() - self.ttl),
+            ).fetchone()
+            if found is None:
+                return new_session()
+            # 讀取也算使用，供 LRU 淘汰判斷
+            conn.execute("UPDATE sessions SET updated_at = ? WHERE user_id = ?", (time.time(), user_id))
+            return json.loads(found[0])
+
+    def save(self, user_id, session):
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (user_id, json.dumps(session, ensure_ascii=False), time.time()),
+            )
+
+    def clear(self, user_id):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def purge(self):
+        """刪除過期紀錄並把筆數壓回上限內（排程呼叫）"""
+        self.purge_table("sessions", "user_id", "updated_at", self.ttl, self.max_entries)
+
+    def size(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+if SESSION_BACKEND == "sqlite":
+    session_store = SQLiteSessionStore(SESSION_DB_PATH, SESSION_TTL_SECONDS, SESSION_MAX_ENTRIES)
+else:
+    session_store = MemorySessionStore(SESSION_TTL_SECONDS, SESSION_MAX_ENTRIES)
 
 # ---------- 輔助：把欄位 key 正規化 ----------
 def normalize_key(k: str) -> str:
@@ -78,7 +2534,31 @@ def normalize_key(k: str) -> str:
     return k
 
 # ---------- 訂單解析（接受「欄位：值」多行格式） ----------
+# 咖啡品名／樣式／數量 可重複多組，一次訂購多項商品（購物車）
+CART_ITEM_FIELDS = ("咖啡品名", "樣式", "數量")
+CART_MAX_ITEMS = int(os.getenv("CART_MAX_ITEMS", 10))
+
+def parse_payment(text):
+    """『匯款』或『付現』；無法辨識時回傳 None"""
+    pm = (text or "").replace(" ", "")
+    if "匯款" in pm:
+        return "匯款"
+    if "付現" in pm or "現付" in pm:
+        return "付現"
+    return None
+
+def parse_cart(text):
+    with metrics.timer("stage_seconds", stage="parse_order_fields"):
+        return _parse_order_fields(text)
+
 def parse_order_fields(text):
+    """只接受單一品項（修改訂單使用）"""
+    data = parse_cart(text)
+    if not data or len(data["items"]) != 1:
+        return None
+    return data
+
+def _parse_order_fields(text):
     """
     解析使用者送來的多行格式，格式例如：
     姓名：王小明
@@ -89,8 +2569,11 @@ def parse_order_fields(text):
     送達地址：台北市...
     備註：xxx  (備註可留空)
     支援全形/半形冒號（：或:），key 兩側可包含方括號【】或[]。
+    咖啡品名／樣式／數量 重複出現時視為下一項商品；另可選填「付款方式：匯款/付現」。
+    回傳的 coffee / style / qty 為第一項商品，items 為全部商品。
     """
     data_dict = {}
+    items = []
     for part in text.strip().splitlines():
         if not part or part.strip() == "":
             continue
@@ -103,28 +2586,221 @@ def parse_order_fields(text):
         key = normalize_key(raw_key)
         val = raw_val.strip()
         data_dict[key] = val
+        if key in CART_ITEM_FIELDS:
+            if not items or key in items[-1]:
+                items.append({})
+            items[-1][key] = val
 
-    required_fields = ["姓名", "電話", "咖啡品名", "樣式", "數量", "送達地址"]
+    required_fields = ["姓名", "電話", "送達地址"]
     if not all(field in data_dict for field in required_fields):
         return None
+    if not items or len(items) > CART_MAX_ITEMS:
+        return None
+    if not all(all(field in item for field in CART_ITEM_FIELDS) and str(item["數量"]).isdigit() for item in items):
+        return None
 
     phone = data_dict.get("電話", "")
-    qty = data_dict.get("數量", "")
 
     if not re.match(r'^09\d{8}$', phone):
         return None
-    if not str(qty).isdigit():
-        return None
 
-    return {
-        "name": data_dict.get("姓名", ""),
-        "phone": phone,
-        "coffee": data_dict.get("咖啡品名", ""),
-        "style": data_dict.get("樣式", ""),
-        "qty": int(qty),
-        "address": data_dict.get("送達地址", ""),
-        "remark": data_dict.get("備註", "") or ""
-    }
+    items = [{"coffee": item["咖啡品名"], "style": item["樣式"], "qty": int(item["數量"])} for item in items]
+    return dict(items[0], **{
+        "name": data_dict.get("姓名", ""),
+        "phone": phone,
+        "address": data_dict.get("送達地址", ""),
+        "remark": data_dict.get("備註", "") or "",
+        "items": items,
+        "payment": parse_payment(data_dict.get("付款方式", "")),
+    })
+
+# ---------- 非同步事件處理（WEBHOOK_ASYNC=1 時啟用） ----------
+# 驗證簽章後立即回應 LINE，事件交由背景執行緒處理，避免 Sheets 變慢時 webhook 逾時重送。
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "0") == "1"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 200))
+
+def dispatch_event(event):
+    """依 WebhookHandler.handle 的規則找出對應的處理函式並執行單一事件"""
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        func = handler._default
+    if func is not None:
+        func(event)
+
+class EventDispatcher:
+    """依 user_id 固定分派到同一個工作執行緒：同一用戶的事件依序處理，不同用戶平行處理"""
+
+    def __init__(self, workers, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.started = False
+        self.lock = threading.Lock()
+        self.counters = {"enqueued": 0, "processed": 0, "failed": 0, "rejected": 0}
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def ensure_started(self):
+        # gunicorn fork 之後才啟動執行緒
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            for i, q in enumerate(self.queues):
+                threading.Thread(target=self._worker, args=(q,), name=f"event-worker-{i}", daemon=True).start()
+            self.started = True
+
+    def submit(self, event, dedup_key=None):
+        """放入佇列；佇列已滿時回傳 False。處理失敗時釋放 dedup_key，讓重送的事件能再處理"""
+        self.ensure_started()
+        source = getattr(event, "source", None)
+        key = getattr(source, "user_id", None) or getattr(source, "group_id", None) or ""
+        q = self.queues[zlib.crc32(key.encode("utf-8")) % len(self.queues)]
+        try:
+            q.put_nowait((time.monotonic(), event, dedup_key))
+        except queue.Full:
+            with self.lock:
+                self.counters["rejected"] += 1
+            return False
+        with self.lock:
+            self.counters["enqueued"] += 1
+        return True
+
+    def _worker(self, q):
+        while True:
+            enqueued_at, event, dedup_key = q.get()
+            wait = time.monotonic() - enqueued_at
+            try:
+                dispatch_event(event)
+                outcome = "processed"
+            except Exception as e:
+                print(f"處理 LINE 事件時發生錯誤: {e}")
+                outcome = "failed"
+                if dedup_key:
+                    with contextlib.suppress(Exception):
+                        event_dedup.release(dedup_key)
+            finally:
+                q.task_done()
+            with self.lock:
+                self.counters[outcome] += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        depths = [q.qsize() for q in self.queues]
+        with self.lock:
+            done = self.counters["processed"] + self.counters["failed"]
+            return dict(
+                self.counters,
+                workers=len(self.queues),
+                queue_capacity=self.queues[0].maxsize * len(self.queues),
+                queue_depth=sum(depths),
+                busiest_queue_depth=max(depths),
+                avg_wait_ms=round(self.total_wait / done * 1000, 2) if done else 0.0,
+                max_wait_ms=round(self.max_wait * 1000, 2),
+            )
+
+dispatcher = EventDispatcher(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+# ---------- 重送事件去重 ----------
+# 回覆太慢時 LINE 會重送同一個事件；以 webhookEventId 記錄已處理的事件，重複的在任何 I/O 之前就丟棄。
+# EVENT_DEDUP_BACKEND=memory（預設）：單一行程的 LRU + TTL；sqlite：多個 worker 行程共用。
+EVENT_DEDUP_BACKEND = os.getenv("EVENT_DEDUP_BACKEND", "memory")
+EVENT_DEDUP_DB_PATH = os.getenv("EVENT_DEDUP_DB_PATH", "events.db")
+EVENT_DEDUP_TTL_SECONDS = int(os.getenv("EVENT_DEDUP_TTL_SECONDS", 86400))
+EVENT_DEDUP_MAX_ENTRIES = int(os.getenv("EVENT_DEDUP_MAX_ENTRIES", 50000))
+
+def event_key(event):
+    """webhookEventId；舊格式沒有時改用訊息 ID，兩者皆無則不去重"""
+    event_id = getattr(event, "webhook_event_id", None)
+    if event_id:
+        return event_id
+    message_id = getattr(getattr(event, "message", None), "id", None)
+    return f"message:{message_id}" if message_id else None
+
+def is_redelivery(event):
+    return bool(getattr(getattr(event, "delivery_context", None), "is_redelivery", False))
+
+class MemoryEventDedup:
+    """單一行程使用的 LRU + TTL 事件紀錄"""
+
+    def __init__(self, ttl, max_entries):
+        self.entries = TTLCache(ttl, max_entries)
+
+    def claim(self, key):
+        """第一次看到此事件時回傳 True"""
+        return self.entries.add(key, True)
+
+    def release(self, key):
+        """處理失敗、需要讓 LINE 重送時撤銷紀錄"""
+        self.entries.pop(key)
+
+    def purge(self):
+        self.entries.purge()
+
+    def size(self):
+        return len(self.entries)
+
+class SQLiteEventDedup(SQLiteStore):
+    """多個 worker 行程共用的事件紀錄（SQLite WAL），以 INSERT OR IGNORE 原子地搶下事件"""
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with self.open_wal() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS webhook_events (
+                    event_id TEXT PRIMARY KEY,
+                    seen_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS webhook_events_seen ON webhook_events (seen_at)")
+
+    def claim(self, key):
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("DELETE FROM webhook_events WHERE event_id = ? AND seen_at < ?", (key, now - self.ttl))
+            cur = conn.execute("INSERT OR IGNORE INTO webhook_events (event_id, seen_at) VALUES (?, ?)", (key, now))
+            return cur.rowcount == 1
+
+    def release(self, key):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM webhook_events WHERE event_id = ?", (key,))
+
+    def purge(self):
+        """刪除過期紀錄並把筆數壓回上限內（排程呼叫）"""
+        self.purge_table("webhook_events", "event_id", "seen_at", self.ttl, self.max_entries)
+
+    def size(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM webhook_events").fetchone()[0]
+
+if EVENT_DEDUP_BACKEND == "sqlite":
+    event_dedup = SQLiteEventDedup(EVENT_DEDUP_DB_PATH, EVENT_DEDUP_TTL_SECONDS, EVENT_DEDUP_MAX_ENTRIES)
+else:
+    event_dedup = MemoryEventDedup(EVENT_DEDUP_TTL_SECONDS, EVENT_DEDUP_MAX_ENTRIES)
+
+metrics.describe("webhook_duplicates_total", "LINE events dropped because they were already handled", "counter")
+
+def claim_event(event):
+    """回傳 (是否需要處理, 去重用的 key)"""
+    key = event_key(event)
+    if key is None:
+        return True, None
+    try:
+        if event_dedup.claim(key):
+            return True, key
+    except Exception as e:
+        # 去重失敗時寧可重複處理，也不要漏掉事件
+        print(f"檢查重送事件時發生錯誤: {e}")
+        return True, None
+    metrics.inc("webhook_duplicates_total", redelivery="true" if is_redelivery(event) else "false")
+    return False, key
 
 # ---------- Flask / LINE webhook ----------
 @app.route("/callback", methods=['POST'])
@@ -132,260 +2808,494 @@ def callback():
     signature = request.headers.get('X-Line-Signature', '')
     body = request.get_data(as_text=True)
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         abort(400)
+    if WEBHOOK_ASYNC:
+        rejected = False
+        for event in events:
+            fresh, key = claim_event(event)
+            if fresh and not dispatcher.submit(event, key):
+                # 沒排進佇列的事件要讓 LINE 重送時能再處理
+                if key:
+                    event_dedup.release(key)
+                rejected = True
+        if rejected:
+            # 佇列已滿：回 503 讓 LINE 稍後重送
+            abort(503)
+        return 'OK'
+    for event in events:
+        fresh, key = claim_event(event)
+        if not fresh:
+            continue
+        try:
+            dispatch_event(event)
+        except Exception:
+            if key:
+                event_dedup.release(key)
+            raise
     return 'OK'
 
-def get_price_info():
+@app.route("/callback/stats", methods=['GET'])
+def callback_stats():
+    require_token(METRICS_TOKEN)
+    return jsonify(dict(dispatcher.stats(), mode="async" if WEBHOOK_ASYNC else "sync", dedup_entries=event_dedup.size()))
+
+# ---------- 價格表快取 ----------
+PRICE_CACHE_TTL_SECONDS = int(os.getenv("PRICE_CACHE_TTL_SECONDS", 300))
+
+# 可使用管理指令的 LINE user_id（以逗號分隔）
+ADMIN_USER_IDS = {u.strip() for u in os.getenv("ADMIN_USER_IDS", "").split(",") if u.strip()}
+
+def load_price_info():
     """從「價格表」工作表讀取單價資訊"""
-    try:
-        price_ws = client.open(SPREADSHEET_NAME).worksheet("價格表")
-        price_records = price_ws.get_all_records()
-        prices = {}
-        for record in price_records:
-            key = (record.get("咖啡品名"), record.get("樣式"))
-            prices[key] = int(record.get("單價", 0))
-        return prices
-    except Exception as e:
-        print(f"讀取價格表時發生錯誤: {e}")
-        return {}
+    price_ws = workbook.handle("價格表")
+    price_records = price_ws.get_all_records()
+    prices = {}
+    for record in price_records:
+        key = (record.get("咖啡品名"), record.get("樣式"))
+        prices[key] = int(record.get("單價", 0))
+    return prices
 
+class PriceCache:
+    """價格表快取：到期後只由一個執行緒重新讀取，其餘請求沿用舊資料；讀取失敗時保留上一份成功的價格表"""
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    user_id = event.source.user_id
-    msg = event.message.text.strip()
-    state = user_states.get(user_id, "init")
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.prices = None
+        self.loaded_at = 0.0
+        self.refresh_lock = threading.Lock()
 
-    # ----- waiting_payment：處理使用者輸入付款方式 -----
-    if state == "waiting_payment":
-        temp = user_states.get(f"{user_id}_temp_order")
-        if not temp:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ 訂單資料遺失，請重新下單。"))
-            user_states.pop(user_id, None)
-            user_states.pop(f"{user_id}_temp_order", None)
-            return
+    def is_fresh(self):
+        return self.prices is not None and time.time() - self.loaded_at < self.ttl
 
-        pm = msg.replace(" ", "")
-        if "匯款" in pm:
-            payment_method = "匯款"
-        elif "付現" in pm or "現付" in pm:
-            payment_method = "付現"
+    def get(self):
+        if self.is_fresh():
+            metrics.inc("cache_requests_total", cache="price", result="hit")
+            return self.prices
+        metrics.inc("cache_requests_total", cache="price", result="miss")
+        if self.prices is not None:
+            # 已有舊資料：搶不到更新權的請求直接使用舊價格，不排隊等待
+            if not self.refresh_lock.acquire(blocking=False):
+                return self.prices
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 付款方式請輸入『匯款』或『付現』，請重新輸入。"))
-            return
+            self.refresh_lock.acquire()
+        try:
+            if not self.is_fresh():
+                self.refresh()
+            return self.prices if self.prices is not None else {}
+        finally:
+            self.refresh_lock.release()
 
-        prices = get_price_info()
-        item_key = (temp["coffee"], temp["style"])
-        unit_price = prices.get(item_key, 0)
-        total_amount = unit_price * temp["qty"]
+    def refresh(self):
+        try:
+            self.prices = self.loader()
+            self.loaded_at = time.time()
+        except Exception as e:
+            print(f"讀取價格表時發生錯誤: {e}")
+            if self.prices is not None:
+                # 延後下次重試，避免 Sheets 異常時每筆訂單都重新嘗試
+                self.loaded_at = time.time() - self.ttl + min(self.ttl, 30)
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+    def reload(self):
+        """強制重新讀取（管理指令使用）"""
+        with self.refresh_lock:
+            self.invalidate()
+            self.refresh()
+            return self.prices if self.prices is not None else {}
 
-        order_id = str(uuid.uuid4())[:8]
-        order_time = (datetime.utcnow() + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M')
+price_cache = PriceCache(load_price_info, PRICE_CACHE_TTL_SECONDS)
+
+def get_price_info():
+    """取得單價資訊（經由快取）"""
+    with metrics.timer("stage_seconds", stage="get_price_info"):
+        return price_cache.get()
+
+# ---------- 價格異動同步到訂單 ----------
+# 取代整張表重寫的 update_prices_and_totals：只找出價格有變動的 (咖啡品名, 樣式)，
+# 經由品項索引找到受影響的進行中訂單，只寫入這些列的「單價」「總金額」兩格，全部合併成一次 batch_update。
+# 重啟後第一次執行會檢查所有進行中訂單（只讀記憶體索引），順便修正下單時因查無品項而記為 0 的金額。
+PRICE_PROPAGATE_MINUTES = int(os.getenv("PRICE_PROPAGATE_MINUTES", 30))
+PRICE_PROPAGATE_STATUSES = {s.strip() for s in os.getenv("PRICE_PROPAGATE_STATUSES", "處理中,").split(",")}
+
+class PricePropagator:
+    """記住上次套用的價格表，只處理價格有變動的品項"""
+
+    def __init__(self):
+        self.applied = None
+        self.lock = threading.Lock()
+
+    def changed_keys(self, prices):
+        if self.applied is None:
+            return None
+        return {k for k in set(prices) | set(self.applied) if prices.get(k) != self.applied.get(k)}
+
+    def run(self):
+        """排程呼叫；回傳修正的訂單筆數"""
+        with self.lock:
+            prices = dict(price_cache.get())
+            if not prices:
+                return 0
+            keys = self.changed_keys(prices)
+            if keys is not None and not keys:
+                return 0
+            fixed = order_repo.reprice(prices, keys)
+            self.applied = prices
+        if fixed:
+            metrics.inc("price_propagated_rows_total", fixed)
+            print(f"價格表異動：已修正 {fixed} 筆訂單的單價與總金額")
+        return fixed
+
+metrics.describe("price_propagated_rows_total", "Open orders whose 單價/總金額 were corrected after a price change", "counter")
+price_propagator = PricePropagator()
+
+def propagate_prices():
+    return price_propagator.run()
+
+
+def instrumented_event(func):
+    """記錄每個事件的總耗時、Sheets 呼叫次數與各階段耗時"""
+    @functools.wraps(func)
+    def wrapper(event):
+        metrics.begin_event()
+        line_bot_api.begin(event)
+        try:
+            return func(event)
+        finally:
+            # 這個事件的所有回覆合併成一次 API 呼叫
+            line_bot_api.flush()
+            source = getattr(event, "source", None)
+            metrics.end_event(handler=func.__name__, user=getattr(source, "user_id", None))
+    return wrapper
+
+# ---------- 我的訂單 ----------
+# 列出用戶最近的訂單，並以快速回覆按鈕送出「查詢訂單 <編號>」等文字，直接帶入既有的查詢／刪除／修改流程
+MY_ORDERS_LIMIT = int(os.getenv("MY_ORDERS_LIMIT", 5))
+MY_ORDERS_QUICK_REPLY = 4  # 每筆 3 個按鈕，LINE 快速回覆最多 13 個
+ORDER_ACTION_PATTERN = re.compile(r'^(查詢|刪除|修改)訂單\s+(\S+)$')
+ORDER_ACTION_STATES = {"查詢": "querying_order_id", "刪除": "waiting_delete_id", "修改": "waiting_modify_id"}
+
+def my_orders_message(user_id):
+    # 購物車訂單的各品項列合併成一筆顯示
+    orders = {}
+    for row in order_repo.recent_for_user(user_id, None):
+        orders.setdefault(cart_order_id(row[0]), []).append(row)
+    orders = list(orders.items())[:MY_ORDERS_LIMIT]
+    if not orders:
+        return TextSendMessage(text="❌ 您目前沒有訂單。\n輸入『下單』即可開始新訂單。")
+    lines = ["📋 您最近的訂單："]
+    headers = order_repo.headers()
+    for oid, rows in orders:
+        rows.sort(key=lambda row: row[0])
+        info = dict(zip(headers, rows[0]))
+        items = "\n".join(f"{order_repo.field(row, '咖啡品名')} {order_repo.field(row, '樣式')} x{order_repo.field(row, '數量')}" for row in rows)
+        lines.append(
+            f"---\n【訂單編號】：{oid}\n"
+            f"{items}\n"
+            f"【狀態】：{info.get('狀態') or '處理中'}\n"
+            f"【下單時間】：{info.get('下單時間', '')}"
+        )
+    lines.append("---\n請點選下方按鈕查詢、修改或刪除訂單。")
+    buttons = []
+    for oid, rows in orders[:MY_ORDERS_QUICK_REPLY]:
+        # 多項商品的訂單不能修改，不顯示修改按鈕
+        for action in ("查詢", "修改", "刪除") if len(rows) == 1 else ("查詢", "刪除"):
+            buttons.append(QuickReplyButton(action=MessageAction(label=f"{action} {oid}", text=f"{action}訂單 {oid}")))
+    return TextSendMessage(text="\n".join(lines), quick_reply=QuickReply(items=buttons))
+
+# ---------- 購物車下單 ----------
+# 一則訊息可包含多項商品（咖啡品名／樣式／數量 重複多組），整張購物車只查一次價格表，
+# 各品項以一次批次寫入多列，編號為「訂單編號-序號」。付款方式以快速回覆按鈕選擇；
+# 下單內容已填「付款方式」時直接成立訂單，只需一次往返。
+PAYMENT_QUICK_REPLY = QuickReply(items=[QuickReplyButton(action=MessageAction(label=m, text=m)) for m in ("匯款", "付現")])
+ORDER_EXAMPLE_TEXT = (
+    "例：\n姓名：王大明\n電話：0900123456\n咖啡品名：耶加雪菲\n樣式：掛耳包\n數量：2\n咖啡品名：曼特寧\n樣式：豆子\n數量：1\n"
+    "送達地址：台北市大安區羅斯福路四段1號\n備註：酸感多一點\n付款方式：匯款\n\n"
+    "註：\n【咖啡品名】請於基本檔案頁面先確認現有販售品項\n【樣式】掛耳包/豆子 擇一填寫\n"
+    "【多項商品】重複填寫 咖啡品名／樣式／數量 即可一次訂購\n【送達地址】宅配地址/花蓮吉安地區可面交\n"
+    "【備註】選填\n【付款方式】匯款/付現，選填；未填寫時於下一步選擇"
+)
+ORDER_FIELDS_TEXT = "姓名：\n電話：\n咖啡品名：\n樣式：\n數量：\n送達地址：\n備註：\n付款方式："
+BANK_INFO = "💳 匯款資訊：\n銀行：示範銀行\n帳號：1234567890123\n戶名：示範戶名"
+
+def cart_items(temp):
+    # 舊版 session 只有單一品項
+    return temp.get("items") or [{"coffee": temp["coffee"], "style": temp["style"], "qty": temp["qty"]}]
+
+def cart_confirm_messages(data):
+    items = cart_items(data)
+    if len(items) == 1:
+        item_block = f"【咖啡品名】：{items[0]['coffee']}\n【樣式】：{items[0]['style']}\n【數量】：{items[0]['qty']}\n"
+    else:
+        item_block = "【商品】：\n" + "\n".join(
+            f"{i}. {item['coffee']} {item['style']} x{item['qty']}" for i, item in enumerate(items, 1)) + "\n"
+    data_block = (
+        f"【姓名】：{data['name']}\n"
+        f"【電話】：{data['phone']}\n"
+        + item_block +
+        f"【送達地址】：{data['address']}\n"
+        f"【備註】：{data['remark'] if data['remark'] else '無'}"
+    )
+    return [
+        TextSendMessage(text="以下為您的訂單資料，請確認後選擇付款方式："),
+        TextSendMessage(text=data_block),
+        TextSendMessage(text="請問付款方式為『匯款』或『付現』？", quick_reply=PAYMENT_QUICK_REPLY),
+    ]
+
+def order_lines_text(order_id, rows):
+    """多項商品訂單的明細：共用欄位只列一次，各品項列出數量與小計"""
+    field = order_repo.field
+    statuses = {field(row, "狀態") for row in rows}
+    items = []
+    for i, row in enumerate(rows, 1):
+        line = f"{i}. {field(row, '咖啡品名')} {field(row, '樣式')} x{field(row, '數量')}（單價 {field(row, '單價')}，小計 {field(row, '總金額')}）"
+        if len(statuses) > 1:
+            line += f"［{field(row, '狀態')}］"
+        items.append(line)
+    first = rows[0]
+    return (
+        f"【訂單編號】：{order_id}\n"
+        f"【姓名】：{field(first, '姓名')}\n"
+        f"【電話】：{field(first, '電話')}\n"
+        f"【商品】：\n" + "\n".join(items) + "\n"
+        f"【總金額】：{format_number(sum(to_number(field(row, '總金額')) for row in rows))}\n"
+        f"【送達地址】：{field(first, '送達地址')}\n"
+        f"【備註】：{field(first, '備註') or '無'}\n"
+        f"【付款方式】：{field(first, '付款方式')}\n"
+        f"【狀態】：{statuses.pop() if len(statuses) == 1 else '見各品項'}\n"
+        f"【下單時間】：{field(first, '下單時間')}"
+    )
+
+def place_order(user_id, temp, payment_method):
+    """寫入訂單並回傳要回覆的訊息；寫入失敗時丟出例外"""
+    items = cart_items(temp)
+    prices = get_price_info()
+    now = datetime.utcnow() + timedelta(hours=8)
+    order_id = new_order_id(now)
+    order_time = now.strftime('%Y-%m-%d %H:%M')
+    rows = []
+    for i, item in enumerate(items, 1):
+        unit_price = prices.get((item["coffee"], item["style"]), 0)
         row_dict = {
-            "訂單編號": order_id,
+            "訂單編號": order_id if len(items) == 1 else cart_line_id(order_id, i),
             "姓名": temp["name"],
             "電話": temp["phone"],
-            "咖啡品名": temp["coffee"],
+            "咖啡品名": item["coffee"],
             "付款方式": payment_method,
-            "樣式": temp["style"],
-            "數量": str(temp["qty"]),
+            "樣式": item["style"],
+            "數量": str(item["qty"]),
             "送達地址": temp["address"],
             "備註": temp["remark"],
             "狀態": "處理中",
             "下單時間": order_time,
             "顧客編號": user_id,
             "單價": str(unit_price),
-            "總金額": str(total_amount)
+            "總金額": str(unit_price * item["qty"])
         }
-        
-        try:
-            row = [row_dict.get(h, "") for h in EXPECTED_HEADERS]
-            sheet.append_row(row)
-        except Exception as e:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠️ 寫入訂單時發生錯誤，請稍後再試。錯誤：{e}"))
-            return
+        rows.append([row_dict.get(h, "") for h in EXPECTED_HEADERS])
+
+    if len(rows) == 1:
+        order_repo.add(rows[0])
+    else:
+        order_repo.add_many(rows)
+    for row in rows:
+        sales_stats.record(row)
 
+    if len(rows) == 1:
+        item = items[0]
         data_display = (
             f"【訂單編號】：{order_id}\n"
             f"【姓名】：{temp['name']}\n"
             f"【電話】：{temp['phone']}\n"
-            f"【咖啡品名】：{temp['coffee']}\n"
-            f"【樣式】：{temp['style']}\n"
-            f"【數量】：{temp['qty']}\n"
-            f"【單價】：{unit_price}\n"
-            f"【總金額】：{total_amount}\n"
+            f"【咖啡品名】：{item['coffee']}\n"
+            f"【樣式】：{item['style']}\n"
+            f"【數量】：{item['qty']}\n"
+            f"【單價】：{order_repo.field(rows[0], '單價')}\n"
+            f"【總金額】：{order_repo.field(rows[0], '總金額')}\n"
             f"【送達地址】：{temp['address']}\n"
             f"【備註】：{temp['remark'] if temp['remark'] else '無'}\n"
             f"【付款方式】：{payment_method}\n"
             f"【狀態】：處理中"
         )
-        
-        reply_messages = [TextSendMessage(text="✅ 訂單已成立！\n以下是您的訂單資訊：\n---\n" + data_display + "\n---\n訂單將於3日內出貨，再麻煩您留意到貨通知。\n感謝您的訂購!")]
-        if payment_method == "匯款":
-            bank_info = ("💳 匯款資訊：\n銀行：示範銀行\n帳號：1234567890123\n戶名：示範戶名")
-            reply_messages.append(TextSendMessage(text=bank_info))
+    else:
+        data_display = order_lines_text(order_id, rows)
+
+    reply_messages = [TextSendMessage(text="✅ 訂單已成立！\n以下是您的訂單資訊：\n---\n" + data_display + "\n---\n訂單將於3日內出貨，再麻煩您留意到貨通知。\n感謝您的訂購!")]
+    if payment_method == "匯款":
+        reply_messages.append(TextSendMessage(text=BANK_INFO))
+    return reply_messages
+
+@handler.add(MessageEvent, message=TextMessage)
+@instrumented_event
+def handle_message(event):
+    user_id = event.source.user_id
+    msg = event.message.text.strip()
+    session = session_store.get(user_id)
+    state = session.get("state", "init")
+
+    # 「我的訂單」快速回覆送來的「查詢訂單 <編號>」等指令，直接進入對應流程
+    m = ORDER_ACTION_PATTERN.match(msg)
+    if m:
+        state, msg = ORDER_ACTION_STATES[m.group(1)], m.group(2)
+
+    # ----- waiting_payment：處理使用者輸入付款方式 -----
+    if state == "waiting_payment":
+        temp = session.get("temp_order")
+        if not temp:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ 訂單資料遺失，請重新下單。"))
+            session_store.clear(user_id)
+            return
+
+        payment_method = parse_payment(msg)
+        if not payment_method:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 付款方式請輸入『匯款』或『付現』，請重新輸入。", quick_reply=PAYMENT_QUICK_REPLY))
+            return
+
+        try:
+            reply_messages = place_order(user_id, temp, payment_method)
+        except Exception as e:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠️ 寫入訂單時發生錯誤，請稍後再試。錯誤：{e}"))
+            return
 
         line_bot_api.reply_message(event.reply_token, reply_messages)
-        user_states.pop(user_id, None)
-        user_states.pop(f"{user_id}_temp_order", None)
+        session_store.clear(user_id)
         return
 
     # ----- waiting_delete_id：處理使用者輸入刪除訂單編號 -----
     if state == "waiting_delete_id":
         query = msg
-        records = sheet.get_all_values()
-        if not records or len(records) < 2:
+        if order_repo.is_empty():
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 尚無訂單資料。"))
-            user_states.pop(user_id, None)
+            session_store.clear(user_id)
             return
 
-        headers = records[0]
-        found = False
-        for idx in range(1, len(records)):
-            row = records[idx]
-            if len(row) > 0 and query == row[0]:
-                try:
-                    cust_idx = headers.index("顧客編號")
-                    if len(row) <= cust_idx or user_id != row[cust_idx]:
-                        continue
-                except ValueError:
-                    continue
-
-                try:
-                    delete_time = (datetime.utcnow() + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M')
-                    row_dict = {headers[i]: (row[i] if i < len(row) else "") for i in range(len(headers))}
-                    row_dict["刪單時間"] = delete_time
-                    target_row = [row_dict.get(h, "") for h in BACKUP_HEADERS]
-                    backup_sheet.append_row(target_row)
-
-                    sheet.delete_rows(idx + 1)
-                    found = True
-
-                    visible_fields = [f"【{h}】：{v}" for h, v in zip(headers, row) if h not in ("顧客編號","狀態") and v]
-                    reply_text = "✅ 已為您刪除以下訂單：\n---\n" + "\n".join(visible_fields) + "\n---\n若有訂購需求請再進行下單，感謝您!"
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
-                except Exception as e:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠️ 刪除訂單時發生錯誤，請稍後再試。錯誤：{e}"))
-                break
+        found, archived = find_order_lines_for_user(query, user_id)
+        if archived:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 訂單{query}已結案封存，無法刪除。"))
+        elif found:
+            try:
+                delete_time = (datetime.utcnow() + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M')
+                if len(found) == 1:
+                    rows = [order_repo.cancel(found[0][0], delete_time)]
+                else:
+                    rows = order_repo.cancel_many([line[0] for line in found], delete_time)
+                for line in found:
+                    sales_stats.remove(line[0])
+                headers = order_repo.headers()
 
-        if not found:
+                if len(rows) == 1:
+                    visible_fields = [f"【{h}】：{v}" for h, v in zip(headers, rows[0]) if h not in ("顧客編號","狀態") and v]
+                    deleted_text = "\n".join(visible_fields)
+                else:
+                    deleted_text = order_lines_text(query, rows)
+                reply_text = "✅ 已為您刪除以下訂單：\n---\n" + deleted_text + "\n---\n若有訂購需求請再進行下單，感謝您!"
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply_text))
+            except Exception as e:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠️ 刪除訂單時發生錯誤，訂單未刪除，請稍後再試。錯誤：{e}"))
+        else:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 查無符合的訂單編號或您無權刪除此訂單。"))
 
-        user_states.pop(user_id, None)
+        session_store.clear(user_id)
         return
 
     # ----- waiting_modify_id：輸入要修改的訂單編號 -----
     if state == "waiting_modify_id":
         query = msg
-        records = sheet.get_all_values()
-        if not records or len(records) < 2:
+        if order_repo.is_empty():
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 尚無訂單資料。"))
-            user_states.pop(user_id, None)
+            session_store.clear(user_id)
             return
 
-        headers = records[0]
-        found = False
-        for idx in range(1, len(records)):
-            row = records[idx]
-            if len(row) > 0 and query == row[0]:
-                try:
-                    cust_idx = headers.index("顧客編號")
-                    if len(row) <= cust_idx or user_id != row[cust_idx]:
-                        continue
-                except ValueError:
-                    continue
-
-                found = True
+        headers = order_repo.headers()
+        rows, archived = find_order_lines_for_user(query, user_id)
+        if archived:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 訂單{query}已結案封存，無法修改。"))
+            session_store.clear(user_id)
+            return
+        if len(rows) > 1:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 訂單{query}包含多項商品，無法直接修改。\n請刪除該訂單後再重新下單。"))
+            session_store.clear(user_id)
+            return
+        row = rows[0] if rows else None
+        if row:
+            try:
+                t_idx = headers.index("下單時間")
+                if len(row) > t_idx and row[t_idx] and "已修改" in str(row[t_idx]):
+                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 每筆訂單僅能修改壹次， 訂單{query}無法再次修改。\n請刪除該訂單後再重新下單。"))
+                    session_store.clear(user_id)
+                    return
+            except ValueError:
+                pass
 
-                try:
-                    t_idx = headers.index("下單時間")
-                    if len(row) > t_idx and row[t_idx] and "已修改" in str(row[t_idx]):
-                        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"❌ 每筆訂單僅能修改壹次， 訂單{query}無法再次修改。\n請刪除該訂單後再重新下單。"))
-                        user_states.pop(user_id, None)
-                        return
-                except ValueError:
-                    pass
-
-                user_states[user_id] = "modifying"
-                user_states[f"{user_id}_temp_modify"] = {"row_index": idx + 1, "order_id": query, "original_data": row}
-
-                data_for_copy = []
-                for h_i, h in enumerate(headers):
-                    if h in ("訂單編號","付款方式","狀態","顧客編號","下單時間","單價","總金額"):
-                        continue
-                    v = row[h_i] if h_i < len(row) else ""
-                    data_for_copy.append(f"{h}：{v}")
-                data_for_copy_text = "\n".join(data_for_copy)
+            session_store.save(user_id, new_session("modifying", temp_modify={"order_id": query, "original_data": row}))
 
-                instruction_text = (
-                    f"📝 您的訂單編號： {query}。\n請複製下方原訂單資料後直接修改並回傳。\n\n"
-                    "註：\n【咖啡品名】請於基本檔案頁面先確認現有販售品項\n【樣式】掛耳包/豆子 擇一填寫\n【送達地址】宅配地址/花蓮吉安地區可面交\n【備註】 選填"
-                )
-                line_bot_api.reply_message(event.reply_token, [
-                    TextSendMessage(text=instruction_text),
-                    TextSendMessage(text=data_for_copy_text)
-                ])
-                break
+            data_for_copy = []
+            for h_i, h in enumerate(headers):
+                if h in ("訂單編號","付款方式","狀態","顧客編號","下單時間","單價","總金額"):
+                    continue
+                v = row[h_i] if h_i < len(row) else ""
+                data_for_copy.append(f"{h}：{v}")
+            data_for_copy_text = "\n".join(data_for_copy)
 
-        if not found:
+            instruction_text = (
+                f"📝 您的訂單編號： {query}。\n請複製下方原訂單資料後直接修改並回傳。\n\n"
+                "註：\n【咖啡品名】請於基本檔案頁面先確認現有販售品項\n【樣式】掛耳包/豆子 擇一填寫\n【送達地址】宅配地址/花蓮吉安地區可面交\n【備註】 選填"
+            )
+            line_bot_api.reply_message(event.reply_token, [
+                TextSendMessage(text=instruction_text),
+                TextSendMessage(text=data_for_copy_text)
+            ])
+        else:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 查無符合的訂單編號或您無權修改此訂單。"))
-            user_states.pop(user_id, None)
+            session_store.clear(user_id)
         return
 
     # ----- querying_order_id: 查詢訂單（只回傳該用戶自己的訂單） -----
     if state == "querying_order_id":
         query = msg
-        records = sheet.get_all_values()
-        if not records or len(records) < 2:
+        if order_repo.is_empty() and not order_archive.size():
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 尚無訂單資料。"))
-            user_states.pop(user_id, None)
+            session_store.clear(user_id)
             return
 
-        headers = records[0]
-        found = False
-        for row in records[1:]:
-            if len(row) > 0 and query == row[0]:
-                try:
-                    cust_idx = headers.index("顧客編號")
-                    if len(row) <= cust_idx or user_id != row[cust_idx]:
-                        continue
-                except ValueError:
-                    continue
-                found = True
-
-                order_info = (
-                    f"📜 您的訂單詳情：\n---\n"
-                    f"【訂單編號】：{row[headers.index('訂單編號')]}\n"
-                    f"【姓名】：{row[headers.index('姓名')]}\n"
-                    f"【電話】：{row[headers.index('電話')]}\n"
-                    f"【咖啡品名】：{row[headers.index('咖啡品名')]}\n"
-                    f"【樣式】：{row[headers.index('樣式')]}\n"
-                    f"【數量】：{row[headers.index('數量')]}\n"
-                    f"【單價】：{row[headers.index('單價')]}\n"
-                    f"【總金額】：{row[headers.index('總金額')]}\n"
-                    f"【送達地址】：{row[headers.index('送達地址')]}\n"
-                    f"【備註】：{row[headers.index('備註')]}\n"
-                    f"【付款方式】：{row[headers.index('付款方式')]}\n"
-                    f"【狀態】：{row[headers.index('狀態')]}\n"
-                    f"【下單時間】：{row[headers.index('下單時間')]}"
-                )
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=order_info))
-                break
-
-        if not found:
+        headers = order_repo.headers()
+        rows, _ = find_order_lines_for_user(query, user_id)
+        if len(rows) > 1:
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="📜 您的訂單詳情：\n---\n" + order_lines_text(query, rows)))
+        elif rows:
+            row = rows[0]
+            order_info = (
+                f"📜 您的訂單詳情：\n---\n"
+                f"【訂單編號】：{row[headers.index('訂單編號')]}\n"
+                f"【姓名】：{row[headers.index('姓名')]}\n"
+                f"【電話】：{row[headers.index('電話')]}\n"
+                f"【咖啡品名】：{row[headers.index('咖啡品名')]}\n"
+                f"【樣式】：{row[headers.index('樣式')]}\n"
+                f"【數量】：{row[headers.index('數量')]}\n"
+                f"【單價】：{row[headers.index('單價')]}\n"
+                f"【總金額】：{row[headers.index('總金額')]}\n"
+                f"【送達地址】：{row[headers.index('送達地址')]}\n"
+                f"【備註】：{row[headers.index('備註')]}\n"
+                f"【付款方式】：{row[headers.index('付款方式')]}\n"
+                f"【狀態】：{row[headers.index('狀態')]}\n"
+                f"【下單時間】：{row[headers.index('下單時間')]}"
+            )
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=order_info))
+        else:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 查無此訂單編號或您無權查看此訂單。"))
-        user_states.pop(user_id, None)
+        session_store.clear(user_id)
         return
 
     # ----- modifying：處理使用者回傳的修改後資料（欄位：值 多行） -----
     if state == "modifying":
-        temp_modify = user_states.get(f"{user_id}_temp_modify")
+        temp_modify = session.get("temp_modify")
         if not temp_modify:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="⚠️ 訂單資料遺失，請重新操作。"))
-            user_states.pop(user_id, None)
-            user_states.pop(f"{user_id}_temp_modify", None)
+            session_store.clear(user_id)
             return
 
         new_data = parse_order_fields(msg)
@@ -405,7 +3315,7 @@ def handle_message(event):
             ])
             return
 
-        headers = sheet.get_all_values()[0]
+        headers = order_repo.headers()
         order_id = temp_modify['order_id']
         original_data = temp_modify['original_data']
         updated_time = (datetime.utcnow() + timedelta(hours=8)).strftime('%Y-%m-%d %H:%M') + " (已修改)"
@@ -440,7 +3350,8 @@ def handle_message(event):
         updated_row = [new_row_dict.get(h, "") for h in EXPECTED_HEADERS]
 
         try:
-            sheet.update(f"A{temp_modify['row_index']}", [updated_row])
+            order_repo.update(order_id, updated_row)
+            sales_stats.record(updated_row)
             data_display = (
                 f"【訂單編號】：{order_id}\n"
                 f"【姓名】：{new_data['name']}\n"
@@ -460,170 +3371,845 @@ def handle_message(event):
         except Exception as e:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠️ 修改訂單時發生錯誤，請稍後再試。錯誤：{e}"))
 
-        user_states.pop(user_id, None)
-        user_states.pop(f"{user_id}_temp_modify", None)
+        session_store.clear(user_id)
         return
 
     # ----- 主指令處理區 -----
+    if msg == "銷售統計" and user_id in ADMIN_USER_IDS:
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=sales_stats_text()))
+        return
+
+    if msg == "更新價格表" and user_id in ADMIN_USER_IDS:
+        prices = price_cache.reload()
+        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"✅ 價格表已重新載入，共 {len(prices)} 項品項。"))
+        # 受影響的進行中訂單在背景修正金額
+        threading.Thread(target=timed_job(propagate_prices), name="price-propagation", daemon=True).start()
+        return
+
     if msg == "下單":
-        user_states[user_id] = "ordering"
-        instruction_text = (
-            "請參照各欄位說明並複製以下欄位進行下單流程：\n\n"
-            "例：\n姓名：王大明\n電話：0900123456\n咖啡品名：耶加雪菲\n樣式：掛耳包\n數量：2\n送達地址：台北市大安區羅斯福路四段1號\n備註：酸感多一點\n\n"
-            "註：\n【咖啡品名】請於基本檔案頁面先確認現有販售品項\n【樣式】掛耳包/豆子 擇一填寫\n【送達地址】宅配地址/花蓮吉安地區可面交\n【備註】選填"
-        )
-        fields_text = (
-            "姓名：\n電話：\n咖啡品名：\n樣式：\n數量：\n送達地址：\n備註："
-        )
+        session_store.save(user_id, new_session("ordering"))
+        instruction_text = "請參照各欄位說明並複製以下欄位進行下單流程：\n\n" + ORDER_EXAMPLE_TEXT
         line_bot_api.reply_message(event.reply_token, [
             TextSendMessage(text=instruction_text),
-            TextSendMessage(text=fields_text)
+            TextSendMessage(text=ORDER_FIELDS_TEXT)
         ])
         return
 
+    if msg == "我的訂單":
+        line_bot_api.reply_message(event.reply_token, my_orders_message(user_id))
+        session_store.clear(user_id)
+        return
+
     if msg == "查詢訂單":
-        user_states[user_id] = "querying_order_id"
+        session_store.save(user_id, new_session("querying_order_id"))
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入您的『訂單編號』以查詢訂單："))
         return
 
     if msg == "刪除訂單":
-        user_states[user_id] = "waiting_delete_id"
+        session_store.save(user_id, new_session("waiting_delete_id"))
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入您的『訂單編號』以刪除訂單："))
         return
 
     if msg == "修改訂單":
-        user_states[user_id] = "waiting_modify_id"
+        session_store.save(user_id, new_session("waiting_modify_id"))
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text="請輸入您的『訂單編號』以修改訂單："))
         return
 
     # ----- ordering：收到用戶以「欄位：值」格式回傳下單內容 -----
-    if state == "ordering":
-        data = parse_order_fields(msg)
-        if not data:
-            instruction_text = (
-                "⚠️ 輸入格式錯誤，請重新參照各欄位說明並複製以下欄位進行下單流程：\n\n"
-                "例：\n姓名：王大明\n電話：0900123456\n咖啡品名：耶加雪菲\n樣式：掛耳包\n數量：2\n送達地址：台北市大安區羅斯福路四段1號\n備註：酸感多一點\n\n"
-                "註：\n【咖啡品名】請於基本檔案頁面先確認現有販售品項\n【樣式】掛耳包/豆子 擇一填寫\n【送達地址】宅配地址/花蓮吉安地區可面交\n【備註】選填"
-            )
-            fields_text = (
-                "姓名：\n電話：\n咖啡品名：\n樣式：\n數量：\n送達地址：\n備註："
-            )
-            line_bot_api.reply_message(event.reply_token, [
-                TextSendMessage(text="❌ 格式錯誤！"),
-                TextSendMessage(text=instruction_text),
-                TextSendMessage(text=fields_text)
-            ])
-            return
-
-        user_states[f"{user_id}_temp_order"] = data
-        user_states[user_id] = "waiting_payment"
-
-        data_block = (
-            f"【姓名】：{data['name']}\n"
-            f"【電話】：{data['phone']}\n"
-            f"【咖啡品名】：{data['coffee']}\n"
-            f"【樣式】：{data['style']}\n"
-            f"【數量】：{data['qty']}\n"
-            f"【送達地址】：{data['address']}\n"
-            f"【備註】：{data['remark'] if data['remark'] else '無'}"
+    # 未先輸入『下單』、直接貼上完整的下單內容也視為下單
+    data = parse_cart(msg) if state in ("ordering", "init") else None
+    if state == "ordering" and not data:
+        instruction_text = (
+            "⚠️ 輸入格式錯誤，請重新參照各欄位說明並複製以下欄位進行下單流程：\n\n"
+            + ORDER_EXAMPLE_TEXT
         )
-
         line_bot_api.reply_message(event.reply_token, [
-            TextSendMessage(text="以下為您的訂單資料，請確認後選擇付款方式："),
-            TextSendMessage(text=data_block),
-            TextSendMessage(text="請問付款方式為『匯款』或『付現』？")
+            TextSendMessage(text="❌ 格式錯誤！"),
+            TextSendMessage(text=instruction_text),
+            TextSendMessage(text=ORDER_FIELDS_TEXT)
         ])
         return
 
+    if data:
+        if data["payment"]:
+            # 已填付款方式：直接成立訂單
+            try:
+                reply_messages = place_order(user_id, data, data["payment"])
+            except Exception as e:
+                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"⚠️ 寫入訂單時發生錯誤，請稍後再試。錯誤：{e}"))
+                return
+            line_bot_api.reply_message(event.reply_token, reply_messages)
+            session_store.clear(user_id)
+            return
+
+        session_store.save(user_id, new_session("waiting_payment", temp_order=data))
+        line_bot_api.reply_message(event.reply_token, cart_confirm_messages(data))
+        return
+
     # ----- 其他（預設） -----
-    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="👋 您好，請依以下動作進行操作：\n『下單』---開始新訂單\n『查詢訂單』---查詢現有訂單\n『刪除訂單』---刪除現有訂單\n『修改訂單』---編輯現有訂單"))
-    user_states[user_id] = "init"
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="👋 您好，請依以下動作進行操作：\n『下單』---開始新訂單\n『我的訂單』---列出最近的訂單\n『查詢訂單』---查詢現有訂單\n『刪除訂單』---刪除現有訂單\n『修改訂單』---編輯現有訂單"))
+    session_store.clear(user_id)
     return
 
 # ---------- 定時任務（提醒 / 更新 / 統計） ----------
-# def update_prices_and_totals():
-#     try:
-#         order_ws = client.open(SPREADSHEET_NAME).worksheet("訂單清單")
-#         price_ws = client.open(SPREADSHEET_NAME).worksheet("價格表")
-#         order_data = order_ws.get_all_values()
-#         price_data = price_ws.get_all_values()
-#         if len(order_data) < 2 or len(price_data) < 2:
-#             return
-#         order_df = pd.DataFrame(order_data[1:], columns=order_data[0])
-#         price_df = pd.DataFrame(price_data[1:], columns=price_data[0])
-#         order_df = order_df[order_df["咖啡品名"].notna()]
-#         price_df = price_df[price_df["咖啡品名"].notna()]
-#         order_df["數量"] = pd.to_numeric(order_df["數量"], errors='coerce')
-#         merged_df = order_df.merge(price_df, how="left", on=["咖啡品名", "樣式"], suffixes=('', '_價格'))
-#         merged_df["單價"] = pd.to_numeric(merged_df.get("單價_價格", pd.Series()), errors='coerce')
-#         merged_df["總金額"] = merged_df["單價"] * merged_df["數量"]
-#         final_columns = order_data[0]
-#         for col in ["單價", "總金額"]:
-#             if col not in final_columns:
-#                 final_columns.append(col)
-#         merged_df = merged_df.reindex(columns=final_columns)
-#         order_ws.update([final_columns] + merged_df.fillna("").astype(str).values.tolist())
-#     except Exception as e:
-#         print("更新價格時錯誤：", e)
-
-def generate_monthly_summary():
+def to_number(value):
+    """與 pd.to_numeric(errors="coerce").fillna(0) 相同的轉換"""
     try:
-        order_ws = client.open(SPREADSHEET_NAME).worksheet("訂單清單")
-        order_data = order_ws.get_all_values()
-        if len(order_data) < 2:
-            return
-        order_df = pd.DataFrame(order_data[1:], columns=order_data[0])
-        order_df["數量"] = pd.to_numeric(order_df["數量"], errors="coerce").fillna(0)
-        order_df["單價"] = pd.to_numeric(order_df.get("單價", 0), errors="coerce").fillna(0)
-        order_df["總金額"] = pd.to_numeric(order_df.get("總金額", 0), errors="coerce").fillna(0)
+        number = float(str(value).strip())
+    except ValueError:
+        return 0
+    if number != number:
+        return 0
+    return int(number) if number.is_integer() else number
 
-        raw_times = order_df.get("下單時間", "").astype(str).str.replace(r'\s*\(已修改\)\s*', '', regex=True)
-        order_df["月份"] = pd.to_datetime(raw_times, errors="coerce").dt.to_period("M").astype(str)
+def format_number(value):
+    return str(int(value)) if float(value).is_integer() else str(value)
 
-        summary_df = order_df.groupby(["月份", "咖啡品名", "樣式", "單價"], as_index=False).agg({
-            "數量": "sum",
-            "總金額": "sum"
+def write_sheet_diff(ws, old_values, new_values):
+    """只把與上次內容不同的儲存格以一次 batch_update 寫入；多出來的舊列清空"""
+    updates = []
+    for r, new_row in enumerate(new_values):
+        old_row = old_values[r] if r < len(old_values) else []
+        changed = [c for c in range(max(len(new_row), len(old_row)))
+                   if (new_row[c] if c < len(new_row) else "") != (old_row[c] if c < len(old_row) else "")]
+        if changed:
+            first, last = changed[0], changed[-1]
+            cells = [(new_row[c] if c < len(new_row) else "") for c in range(first, last + 1)]
+            updates.append({
+                "range": f"{gspread.utils.rowcol_to_a1(r + 1, first + 1)}:{gspread.utils.rowcol_to_a1(r + 1, last + 1)}",
+                "values": [cells],
+            })
+    width = max([len(row) for row in old_values + new_values] + [1])
+    for r in range(len(new_values), len(old_values)):
+        updates.append({
+            "range": f"{gspread.utils.rowcol_to_a1(r + 1, 1)}:{gspread.utils.rowcol_to_a1(r + 1, width)}",
+            "values": [[""] * width],
         })
-        summary_df = summary_df[["月份", "咖啡品名", "樣式", "單價", "數量", "總金額"]]
+    if updates:
+        ws.batch_update(updates)
+    return len(updates)
+
+# ---------- 報表管線：每次只讀取並轉換一次訂單，所有報表共用同一份快照 ----------
+class OrderSnapshot:
+    """訂單快照：數值欄位與下單時間在建立時就轉換完成。
+    months 為 None 表示包含所有月份；否則只包含列出的月份（欄式匯出檔按需讀取時）"""
+
+    def __init__(self, values, version=None):
+        import pandas as pd  # 只有產生報表時才載入 pandas
+
+        self.version = version
+        self.months = None
+        self.headers = values[0] if values else list(EXPECTED_HEADERS)
+        self.empty = len(values) < 2
+        df = pd.DataFrame(values[1:], columns=self.headers)
+        for col in ("數量", "單價", "總金額"):
+            df[col] = pd.to_numeric(df[col] if col in df else 0, errors="coerce").fillna(0)
+        for col in ("訂單編號", "姓名", "咖啡品名", "樣式", "狀態", "顧客編號"):
+            if col not in df:
+                df[col] = ""
+        raw_times = df.get("下單時間", pd.Series("", index=df.index)).astype(str)
+        df["已修改"] = raw_times.str.contains("已修改", regex=False)
+        df["下單時間"] = raw_times.str.replace(r'\s*\(已修改\)\s*', '', regex=True)
+        df["下單時間_dt"] = pd.to_datetime(df["下單時間"], errors="coerce")
+        df["月份"] = df["下單時間_dt"].dt.to_period("M").astype(str)
+        self.frame = df
+
+    @classmethod
+    def from_frame(cls, frame, version, months=None):
+        snapshot = cls.__new__(cls)
+        snapshot.version = version
+        snapshot.months = months
+        snapshot.headers = list(frame.columns)
+        snapshot.empty = len(frame) == 0 and months is None
+        snapshot.frame = frame
+        return snapshot
+
+# ---------- 欄式訂單匯出（Arrow IPC，依月份分區） ----------
+# 定期把 order_repo 的訂單轉成有型別的欄式檔案：ORDER_EXPORT_DIR/month=YYYY-MM.arrow。
+# 只重寫內容有變動的月份；報表以 memory map 開啟，只讀取需要的欄位與月份，不再經過 Sheets。
+# 需要選用套件 pyarrow；未安裝時報表照舊由 order_repo 建立快照。
+ORDER_EXPORT = os.getenv("ORDER_EXPORT", "1") == "1"
+ORDER_EXPORT_DIR = os.getenv("ORDER_EXPORT_DIR", "order_exports")
+ORDER_EXPORT_MINUTES = int(os.getenv("ORDER_EXPORT_MINUTES", 30))
+
+ORDER_EXPORT_TEXT_COLUMNS = ["訂單編號", "姓名", "電話", "咖啡品名", "付款方式", "樣式",
+                             "送達地址", "備註", "狀態", "下單時間", "顧客編號", "月份"]
+ORDER_EXPORT_NUMBER_COLUMNS = ["數量", "單價", "總金額"]
+
+def parse_order_time(value):
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
         try:
-            summary_ws = client.open(SPREADSHEET_NAME).worksheet("每月統計")
-        except:
-            summary_ws = client.open(SPREADSHEET_NAME).add_worksheet(title="每月統計", rows="1000", cols="10")
-        summary_ws.clear()
-        summary_ws.update([summary_df.columns.tolist()] + summary_df.astype(str).values.tolist())
-    except Exception as e:
-        print("無法產生每月統計：", e)
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
 
-def generate_customer_summary():
+# order_repo.version() 在 sheets 後端是各行程自己的計數器、重啟後從 0 開始，
+# 因此 manifest 同時記錄寫入的行程，只有同一個行程才能用版本號判斷內容未變動
+EXPORT_INSTANCE = uuid.uuid4().hex
+
+def export_owner():
+    # gunicorn fork 後各 worker 的 pid 不同
+    return f"{EXPORT_INSTANCE}-{os.getpid()}"
+
+class OrderExport:
+    """依月份分區的 Arrow IPC 訂單檔；manifest.json 記錄各月份內容的檢查碼與匯出時的版本號"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.manifest = None
+
+    @staticmethod
+    def available():
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def path(self, month):
+        return os.path.join(self.directory, f"month={month}.arrow")
+
+    def load_manifest(self):
+        if self.manifest is None:
+            try:
+                with open(os.path.join(self.directory, "manifest.json"), encoding="utf-8") as f:
+                    self.manifest = json.load(f)
+            except (OSError, ValueError):
+                self.manifest = {"version": None, "months": {}}
+        return self.manifest
+
+    def save_manifest(self, manifest):
+        tmp = os.path.join(self.directory, "manifest.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.directory, "manifest.json"))
+        self.manifest = manifest
+
+    def is_current(self, version):
+        manifest = self.load_manifest()
+        return version is not None and manifest.get("owner") == export_owner() and manifest["version"] == version
+
+    def export(self):
+        """把訂單（含封存）匯出成欄式檔（排程呼叫）；回傳重寫的月份"""
+        with self.lock:
+            version = order_repo.version()
+            if self.is_current(version):
+                return []
+            values = report_values()
+            headers = values[0] if values else list(EXPECTED_HEADERS)
+            by_month = {}
+            for row in values[1:]:
+                if not row or not row[0]:
+                    continue
+                record = {h: (row[i] if i < len(row) else "") for i, h in enumerate(headers)}
+                raw_time = str(record.get("下單時間", ""))
+                record["已修改"] = "已修改" in raw_time
+                record["下單時間"] = order_time_key(raw_time)
+                record["下單時間_dt"] = parse_order_time(record["下單時間"])
+                record["月份"] = record["下單時間_dt"].strftime("%Y-%m") if record["下單時間_dt"] else "NaT"
+                by_month.setdefault(record["月份"], []).append(record)
+            os.makedirs(self.directory, exist_ok=True)
+            old = self.load_manifest()["months"]
+            months = {}
+            written = []
+            for month, records in by_month.items():
+                digest = zlib.crc32(json.dumps(records, ensure_ascii=False, default=str).encode("utf-8"))
+                months[month] = digest
+                if old.get(month) != digest or not os.path.exists(self.path(month)):
+                    self.write_partition(month, records)
+                    written.append(month)
+            for month in set(old) - set(months):
+                with contextlib.suppress(OSError):
+                    os.remove(self.path(month))
+            self.save_manifest({"version": version, "owner": export_owner(), "months": months, "exported_at": time.time()})
+            return sorted(written)
+
+    def write_partition(self, month, records):
+        import pyarrow as pa
+
+        columns = {c: pa.array([str(r.get(c, "")) for r in records], pa.string()) for c in ORDER_EXPORT_TEXT_COLUMNS}
+        for c in ORDER_EXPORT_NUMBER_COLUMNS:
+            columns[c] = pa.array([float(to_number(r.get(c, 0))) for r in records], pa.float64())
+        columns["已修改"] = pa.array([r["已修改"] for r in records], pa.bool_())
+        columns["下單時間_dt"] = pa.array([r["下單時間_dt"] for r in records], pa.timestamp("s"))
+        table = pa.table(columns)
+        tmp = self.path(month) + ".tmp"
+        with pa.OSFile(tmp, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, self.path(month))
+
+    def snapshot(self, columns=None, months=None):
+        """以 memory map 讀取指定月份（None 為全部）與欄位，回傳 OrderSnapshot"""
+        import pyarrow as pa
+        import pandas as pd
+
+        manifest = self.load_manifest()
+        wanted = sorted(manifest["months"]) if months is None else sorted(months)
+        tables = []
+        for month in wanted:
+            if month not in manifest["months"]:
+                continue
+            with pa.memory_map(self.path(month), "r") as source:
+                table = pa.ipc.open_file(source).read_all()
+            tables.append(table.select(columns) if columns else table)
+        if tables:
+            frame = pa.concat_tables(tables).to_pandas()
+            # 與 pd.to_numeric 相同：全為整數的欄位以整數呈現
+            for c in ORDER_EXPORT_NUMBER_COLUMNS:
+                if c in frame and len(frame) and (frame[c] % 1 == 0).all():
+                    frame[c] = frame[c].astype("int64")
+        else:
+            frame = pd.DataFrame(columns=columns or ORDER_EXPORT_TEXT_COLUMNS + ORDER_EXPORT_NUMBER_COLUMNS)
+        return OrderSnapshot.from_frame(frame, manifest["version"], None if months is None else set(months))
+
+    def month_digests(self):
+        return dict(self.load_manifest()["months"])
+
+order_export = OrderExport(ORDER_EXPORT_DIR)
+
+# 只確認是否安裝，不在啟動時載入 pyarrow
+if ORDER_EXPORT and importlib.util.find_spec("pyarrow") is None:
+    print("⚠️ 未安裝 pyarrow，欄式訂單匯出停用，報表改由 order_repo 建立快照（pip install pyarrow）")
+
+def export_orders():
+    if ORDER_EXPORT and OrderExport.available():
+        written = order_export.export()
+        if written:
+            print(f"訂單欄式檔已更新月份：{', '.join(written)}")
+
+# 報表名稱（即工作表名稱）→ 產生器設定
+REPORTS = {}
+REPORT_CHECK_MINUTES = int(os.getenv("REPORT_CHECK_MINUTES", 60))
+
+def register_report(title, hours, columns=None, by_month=False, reset=None):
+    """註冊報表：func(snapshot) 回傳要寫入工作表的表格（含標題列），回傳 None 表示不需更新。
+    有欄式匯出檔時只讀取 columns 指定的欄位；by_month=True 的報表只讀取上次之後有變動的月份。
+    產生或寫入失敗時呼叫 reset()，讓報表自己保存的累計狀態下次重新計算"""
+    def decorator(func):
+        REPORTS[title] = {"func": func, "hours": hours, "last_run": time.time(), "version": None, "written": None,
+                          "columns": columns, "by_month": by_month, "months": {}, "reset": reset}
+        return func
+    return decorator
+
+def get_report_ws(title):
+    try:
+        workbook.worksheet(title)
+    except:
+        workbook.add_worksheet(title, 1000, 10)
+    return workbook.handle(title)
+
+def run_reports(titles=None, force=False):
+    """產生到期的報表；同一次執行只讀取一次訂單"""
+    now = time.time()
+    due = [t for t, r in REPORTS.items()
+           if (titles is None or t in titles) and (force or now - r["last_run"] >= r["hours"] * 3600)]
+    if not due:
+        return
     try:
-        order_ws = client.open(SPREADSHEET_NAME).worksheet("訂單清單")
-        order_data = order_ws.get_all_values()
-        if len(order_data) < 2:
+        version = order_repo.version()
+        # 訂單自上次成功寫入後沒有變動的報表不必重算
+        pending = [t for t in due if force or REPORTS[t]["version"] is None or REPORTS[t]["version"] != version]
+        for t in set(due) - set(pending):
+            REPORTS[t]["last_run"] = now
+        if not pending:
             return
-        order_df = pd.DataFrame(order_data[1:], columns=order_data[0])
-        order_df["數量"] = pd.to_numeric(order_df["數量"], errors="coerce").fillna(0)
-        order_df["總金額"] = pd.to_numeric(order_df.get("總金額", 0), errors="coerce").fillna(0)
-        customer_df = order_df.groupby(["姓名", "咖啡品名", "樣式"], as_index=False).agg({
-            "數量": "count",
-            "總金額": "sum"
-        })
-        customer_df.rename(columns={"數量": "購買次數"}, inplace=True)
-        customer_df = customer_df[["姓名", "咖啡品名", "樣式", "購買次數", "總金額"]]
-        try:
-            customer_ws = client.open(SPREADSHEET_NAME).worksheet("客群統計")
-        except:
-            customer_ws = client.open(SPREADSHEET_NAME).add_worksheet(title="客群統計", rows="1000", cols="10")
-        customer_ws.clear()
-        customer_ws.update([customer_df.columns.tolist()] + customer_df.astype(str).values.tolist())
+        columnar = ORDER_EXPORT and OrderExport.available()
+        if columnar:
+            order_export.export()
+            digests = order_export.month_digests()
+            shared = None
+        else:
+            shared = OrderSnapshot(report_values(), version)
+            if shared.empty:
+                return
     except Exception as e:
-        print("無法產生客群統計：", e)
+        print("無法讀取訂單資料：", e)
+        return
+    for title in pending:
+        report = REPORTS[title]
+        try:
+            if columnar:
+                months = None
+                if report["by_month"] and report["months"]:
+                    # 內容有變動或已消失的月份
+                    months = {m for m in set(digests) | set(report["months"]) if digests.get(m) != report["months"].get(m)}
+                snapshot = order_export.snapshot(report["columns"], months)
+                if snapshot.empty:
+                    continue
+            else:
+                snapshot = shared
+            table = report["func"](snapshot)
+            if table is not None:
+                ws = get_report_ws(title)
+                if report["written"] is None:
+                    # 重啟後第一次執行：讀一次目前工作表內容作為比對基準
+                    report["written"] = ws.get_all_values()
+                write_sheet_diff(ws, report["written"], table)
+                report["written"] = table
+            report["last_run"] = now
+            report["version"] = version
+            if columnar:
+                report["months"] = digests
+        except Exception as e:
+            report["written"] = None
+            report["months"] = {}
+            if report["reset"]:
+                report["reset"]()
+            print(f"無法產生{title}：", e)
+
+class MonthlySummary:
+    """每月統計的累計值：記住每筆訂單貢獻到哪個 (月份, 咖啡品名, 樣式, 單價)，只重算有變動的月份"""
+
+    COLUMNS = ["月份", "咖啡品名", "樣式", "單價", "數量", "總金額"]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # 月份 → {訂單編號: ((月份, 咖啡品名, 樣式, 單價), 數量, 總金額)}
+        self.contributions = {}
+        self.totals = {}
+        # 上次套用的快照版本；寫入工作表失敗時由 run_reports 呼叫 reset() 清除
+        self.watermark = None
+
+    def apply(self, snapshot):
+        """套用快照中的訂單資料，回傳受影響的月份；快照只含部分月份時，其餘月份維持原狀"""
+        current = {}
+        frame = snapshot.frame
+        for order_id, month, coffee, style, price, qty, total in zip(
+            frame["訂單編號"], frame["月份"], frame["咖啡品名"], frame["樣式"],
+            frame["單價"], frame["數量"], frame["總金額"],
+        ):
+            if order_id:
+                current.setdefault(month, {})[order_id] = ((month, coffee, style, to_number(price)), to_number(qty), to_number(total))
+        months = snapshot.months if snapshot.months is not None else set(self.contributions) | set(current)
+        affected = set()
+        for month in months:
+            old = self.contributions.get(month, {})
+            new = current.get(month, {})
+            if old == new:
+                continue
+            for contribution in old.values():
+                self._add(contribution, -1)
+            for contribution in new.values():
+                self._add(contribution, 1)
+            if new:
+                self.contributions[month] = new
+            else:
+                self.contributions.pop(month, None)
+            affected.add(month)
+        self.watermark = snapshot.version
+        return affected
+
+    def _add(self, contribution, sign):
+        key, qty, total = contribution
+        # [訂單筆數, 數量, 總金額]
+        entry = self.totals.setdefault(key, [0, 0, 0])
+        entry[0] += sign
+        entry[1] += sign * qty
+        entry[2] += sign * total
+        if entry[0] == 0:
+            del self.totals[key]
+
+    def table(self):
+        rows = [[k[0], k[1], k[2], format_number(k[3]), format_number(v[1]), format_number(v[2])]
+                for k, v in sorted(self.totals.items())]
+        return [list(self.COLUMNS)] + rows
+
+monthly_summary = MonthlySummary()
+
+@register_report("每月統計", hours=12, columns=["訂單編號", "月份", "咖啡品名", "樣式", "單價", "數量", "總金額"], by_month=True,
+                 reset=monthly_summary.reset)
+def monthly_summary_report(snapshot):
+    if snapshot.version is not None and snapshot.version == monthly_summary.watermark:
+        return None
+    affected = monthly_summary.apply(snapshot)
+    if affected:
+        print(f"每月統計重新計算月份：{', '.join(sorted(affected))}")
+    return monthly_summary.table()
+
+@register_report("客群統計", hours=24, columns=["姓名", "咖啡品名", "樣式", "數量", "總金額"])
+def customer_summary_report(snapshot):
+    customer_df = snapshot.frame.groupby(["姓名", "咖啡品名", "樣式"], as_index=False).agg({
+        "數量": "count",
+        "總金額": "sum"
+    })
+    customer_df.rename(columns={"數量": "購買次數"}, inplace=True)
+    customer_df = customer_df[["姓名", "咖啡品名", "樣式", "購買次數", "總金額"]]
+    return [customer_df.columns.tolist()] + customer_df.astype(str).values.tolist()
+
+def generate_monthly_summary():
+    run_reports(["每月統計"], force=True)
+
+def generate_customer_summary():
+    run_reports(["客群統計"], force=True)
+
+# ---------- 訂單狀態通知 ----------
+# 員工在「訂單清單」手動修改「狀態」後，排程比對每筆訂單的狀態與上次通知時的狀態，
+# 依通知範本把同一種訊息的顧客合併成 multicast（每次最多 500 人）送出。
+# 已通知的狀態存在 SQLite，重啟後不會重送；第一次啟用時只記錄現況、不發送。
+STATUS_NOTIFY = os.getenv("STATUS_NOTIFY", "1") == "1"
+STATUS_NOTIFY_DB_PATH = os.getenv("STATUS_NOTIFY_DB_PATH", "notifications.db")
+STATUS_NOTIFY_MINUTES = int(os.getenv("STATUS_NOTIFY_MINUTES", 5))
+STATUS_NOTIFY_REQUESTS_PER_MINUTE = int(os.getenv("STATUS_NOTIFY_REQUESTS_PER_MINUTE", 60))
+STATUS_NOTIFY_MAX_RECIPIENTS_PER_RUN = int(os.getenv("STATUS_NOTIFY_MAX_RECIPIENTS_PER_RUN", 2000))
+# 訂單從主檔消失超過此時數才忘記已通知的狀態；工作表重建或員工搬移列期間暫時消失的訂單回來時不會重送
+STATUS_NOTIFY_FORGET_HOURS = float(os.getenv("STATUS_NOTIFY_FORGET_HOURS", 72))
+MULTICAST_MAX_RECIPIENTS = 500
+# 狀態 → 通知文字；不在表中的狀態（例如顧客自己刪單的 tombstone）不通知
+STATUS_NOTIFY_TEMPLATES = json.loads(os.getenv("STATUS_NOTIFY_TEMPLATES", "null") or "null") or {
+    "已出貨": "📦 您的咖啡訂單已出貨，再麻煩您留意到貨通知。\n輸入『我的訂單』可查看訂單詳情。",
+    "已送達": "☕ 您的咖啡訂單已送達，感謝您的訂購！\n輸入『我的訂單』可查看訂單詳情。",
+}
+
+class StatusNotifier(SQLiteStore):
+    """比對「狀態」快照並以 multicast 通知顧客；狀態來源為 order_repo（記憶體索引或本機主檔），不另外讀取試算表"""
+
+    def __init__(self, path, repo, templates):
+        self.path = path
+        self.repo = repo
+        self.templates = templates
+        self.bucket = TokenBucket(STATUS_NOTIFY_REQUESTS_PER_MINUTE, 0.0)
+        with self.open_wal() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS notified_status (
+                    order_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    notified_at REAL
+                )"""
+            )
+            if "missing_since" not in [r[1] for r in conn.execute("PRAGMA table_info(notified_status)")]:
+                conn.execute("ALTER TABLE notified_status ADD COLUMN missing_since REAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS notifier_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def changes(self):
+        """回傳 ({訂單編號: 狀態} 需要記錄但不通知, [(訂單編號, 顧客編號, 狀態)] 需要通知, 是否為第一次執行)"""
+        values = self.repo.all_values()
+        headers = values[0] if values else []
+        if "狀態" not in headers or "顧客編號" not in headers:
+            return {}, [], False
+        status_idx = headers.index("狀態")
+        customer_idx = headers.index("顧客編號")
+        with self.connect() as conn:
+            found = conn.execute("SELECT order_id, status, missing_since FROM notified_status").fetchall()
+            seeded = conn.execute("SELECT 1 FROM notifier_meta WHERE key = 'seeded'").fetchone() is not None
+        known = {oid: status for oid, status, _ in found}
+        missing = {oid: since for oid, _, since in found if since is not None}
+        silent, notify = {}, []
+        current = set()
+        for row in values[1:]:
+            if not row or not row[0]:
+                continue
+            current.add(row[0])
+            status = row[status_idx] if status_idx < len(row) else ""
+            customer = row[customer_idx] if customer_idx < len(row) else ""
+            if known.get(row[0]) == status:
+                continue
+            if seeded and status in self.templates and customer:
+                # 第一次看到的訂單也要通知：下單後在兩次比對之間就已出貨的訂單不能漏掉
+                notify.append((row[0], customer, status))
+            else:
+                # 第一次執行、或狀態不需通知（例如新訂單的處理中）：只記下目前狀態
+                silent[row[0]] = status
+        now = time.time()
+        gone = [oid for oid in known if oid not in current and oid not in missing]
+        forgotten = [oid for oid, since in missing.items()
+                     if oid not in current and now - since > STATUS_NOTIFY_FORGET_HOURS * 3600]
+        returned = [oid for oid in missing if oid in current]
+        if gone or forgotten or returned:
+            with self.connect() as conn:
+                # 消失的訂單先保留已通知的狀態，超過 STATUS_NOTIFY_FORGET_HOURS 仍未回來才不再追蹤
+                conn.executemany("UPDATE notified_status SET missing_since = ? WHERE order_id = ?", [(now, oid) for oid in gone])
+                conn.executemany("DELETE FROM notified_status WHERE order_id = ?", [(oid,) for oid in forgotten])
+                conn.executemany("UPDATE notified_status SET missing_since = NULL WHERE order_id = ?", [(oid,) for oid in returned])
+        return silent, notify, not seeded
+
+    def mark(self, statuses, notified_at=None):
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO notified_status (order_id, status, notified_at) VALUES (?, ?, ?)",
+                [(oid, status, notified_at) for oid, status in statuses.items()],
+            )
+
+    def run(self):
+        """比對狀態並送出通知（排程呼叫），回傳已通知的顧客數"""
+        silent, notify, first_run = self.changes()
+        self.mark(silent)
+        if first_run:
+            with self.connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO notifier_meta (key, value) VALUES ('seeded', ?)", (str(time.time()),))
+            return 0
+        # 依範本分組；同一位顧客同一種通知只送一次
+        groups = {}
+        for order_id, customer, status in notify:
+            group = groups.setdefault(status, {})
+            group.setdefault(customer, []).append(order_id)
+        sent = 0
+        for status, customers in groups.items():
+            recipients = list(customers)
+            for i in range(0, len(recipients), MULTICAST_MAX_RECIPIENTS):
+                chunk = recipients[i:i + MULTICAST_MAX_RECIPIENTS]
+                if sent + len(chunk) > STATUS_NOTIFY_MAX_RECIPIENTS_PER_RUN:
+                    # 超過單次上限的留到下一輪
+                    return sent
+                self.bucket.acquire()
+                try:
+                    line_bot_api.multicast(chunk, TextSendMessage(text=self.templates[status]))
+                except Exception as e:
+                    print(f"發送訂單狀態通知時發生錯誤: {e}")
+                    continue
+                metrics.inc("status_notifications_total", len(chunk), status=status)
+                self.mark({oid: status for c in chunk for oid in customers[c]}, time.time())
+                sent += len(chunk)
+        return sent
+
+metrics.describe("status_notifications_total", "Customers notified of an order status change", "counter")
+status_notifier = StatusNotifier(STATUS_NOTIFY_DB_PATH, order_repo, STATUS_NOTIFY_TEMPLATES)
 
 # ---------- 啟用 scheduler（示範排程） ----------
-scheduler = BackgroundScheduler()
-# scheduler.add_job(update_prices_and_totals, 'interval', minutes=30)
-scheduler.add_job(generate_monthly_summary, 'interval', hours=12)
-scheduler.add_job(generate_customer_summary, 'interval', hours=24)
-scheduler.start()
+# 每個行程都會執行「本機工作」（自己的索引、記憶體狀態表）；
+# 統計報表、刪除 tombstone 列等「共用工作」只由取得 leader 檔案鎖的單一行程執行。
+# SCHEDULER_MODE=embedded（預設）：webhook worker 互相競爭 leader，leader 結束後由其他 worker 接手。
+# SCHEDULER_MODE=standalone：webhook worker 不執行共用工作，改由 `python app.py scheduler` 另開行程執行。
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "embedded")
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", "scheduler.lock")
+SCHEDULER_DB_PATH = os.getenv("SCHEDULER_DB_PATH", "scheduler.db")
+SCHEDULER_LEADER_RETRY_SECONDS = int(os.getenv("SCHEDULER_LEADER_RETRY_SECONDS", 30))
+scheduler = None
+
+class LeaderLock:
+    """以 flock 實作的 leader 選舉：持有檔案鎖的行程就是 leader，行程結束時作業系統自動釋放"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self, blocking=False):
+        if self.file is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            # 非 POSIX 平台無法跨行程協調，視為單一行程部署
+            print("此平台不支援 fcntl，排程 leader 選舉停用")
+            self.file = open(self.path, "a+")
+            return True
+        f = open(self.path, "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(f"{os.getpid()}\n")
+        f.flush()
+        self.file = f
+        return True
+
+    def is_leader(self):
+        return self.file is not None
+
+leader_lock = LeaderLock(SCHEDULER_LOCK_PATH)
+
+class JobLedger(SQLiteStore):
+    """記錄每個排程工作最近一次的執行時間、耗時與成功時間（所有行程共用，供 /scheduler 查詢）"""
+
+    def __init__(self, path):
+        self.path = path
+        with self.open_wal() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS job_runs (
+                    job TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    last_started_at REAL,
+                    last_duration REAL,
+                    last_success_at REAL,
+                    last_error TEXT,
+                    runs INTEGER NOT NULL DEFAULT 0,
+                    failures INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (job, pid)
+                )"""
+            )
+
+    def record(self, job, started_at, duration, error=None):
+        try:
+            with self.connect() as conn:
+                conn.execute("INSERT OR IGNORE INTO job_runs (job, pid) VALUES (?, ?)", (job, os.getpid()))
+                conn.execute(
+                    """UPDATE job_runs SET last_started_at = ?, last_duration = ?, runs = runs + 1,
+                           last_success_at = CASE WHEN ? IS NULL THEN ? ELSE last_success_at END,
+                           last_error = ?, failures = failures + (? IS NOT NULL)
+                       WHERE job = ? AND pid = ?""",
+                    (started_at, duration, error, started_at + duration, error, error, job, os.getpid()),
+                )
+        except Exception as e:
+            print(f"記錄排程工作 {job} 時發生錯誤: {e}")
+
+    def summary(self):
+        with self.connect() as conn:
+            rows = conn.execute(
+                """SELECT job, pid, last_started_at, last_duration, last_success_at, last_error, runs, failures
+                   FROM job_runs ORDER BY job, last_started_at DESC"""
+            ).fetchall()
+        keys = ("job", "pid", "last_started_at", "last_duration", "last_success_at", "last_error", "runs", "failures")
+        return [dict(zip(keys, row)) for row in rows]
+
+job_ledger = JobLedger(SCHEDULER_DB_PATH)
+
+def timed_job(func):
+    """排程工作的執行時間與失敗次數記錄到 job_seconds / job_failures_total 與 job_ledger"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper():
+        started_at = time.time()
+        error = None
+        try:
+            with metrics.timer("job_seconds", job=name), background_priority():
+                return func()
+        except Exception as e:
+            error = str(e)
+            metrics.inc("job_failures_total", job=name)
+            print(f"排程工作 {name} 發生錯誤: {e}")
+        finally:
+            job_ledger.record(name, started_at, time.time() - started_at, error)
+    return wrapper
+
+def add_local_jobs(scheduler):
+    """每個行程各自維護的記憶體狀態"""
+    scheduler.add_job(timed_job(session_store.purge), 'interval', minutes=10)
+    scheduler.add_job(timed_job(event_dedup.purge), 'interval', minutes=10)
+    scheduler.add_job(timed_job(order_index.check_for_changes), 'interval', seconds=ORDER_INDEX_CHECK_SECONDS)
+    scheduler.add_job(timed_job(sales_stats.refresh), 'interval', seconds=SALES_STATS_REFRESH_SECONDS)
+
+def add_shared_jobs(scheduler):
+    """整個部署只需執行一次的工作，只加在 leader 行程"""
+    scheduler.add_job(timed_job(propagate_prices), 'interval', minutes=PRICE_PROPAGATE_MINUTES)
+    scheduler.add_job(timed_job(run_reports), 'interval', minutes=REPORT_CHECK_MINUTES)
+    scheduler.add_job(timed_job(export_orders), 'interval', minutes=ORDER_EXPORT_MINUTES)
+    scheduler.add_job(timed_job(archive_orders), 'interval', hours=ARCHIVE_CHECK_HOURS)
+    scheduler.add_job(timed_job(sheets_order_repo.compact), 'interval', minutes=TOMBSTONE_COMPACT_MINUTES)
+    if isinstance(order_repo, SQLiteOrderRepository):
+        scheduler.add_job(timed_job(order_repo.pull_staff_edits), 'interval', minutes=ORDER_INDEX_RESYNC_MINUTES)
+    if STATUS_NOTIFY:
+        scheduler.add_job(timed_job(status_notifier.run), 'interval', minutes=STATUS_NOTIFY_MINUTES)
+
+leader_jobs_lock = threading.Lock()
+
+def become_leader(blocking=False):
+    """取得檔案鎖後把共用工作加入本行程的 scheduler（只加一次）"""
+    with leader_jobs_lock:
+        if leader_lock.is_leader():
+            return True
+        if not leader_lock.acquire(blocking):
+            return False
+        print(f"行程 {os.getpid()} 成為排程 leader")
+        add_shared_jobs(scheduler)
+        if scheduler.get_job("leader-election"):
+            scheduler.remove_job("leader-election")
+        return True
+
+def campaign_for_leadership():
+    """非 leader 的行程定期嘗試取得檔案鎖；leader 行程結束後由其他行程接手"""
+    become_leader()
+
+def start_scheduler():
+    global scheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    scheduler = BackgroundScheduler()
+    add_local_jobs(scheduler)
+    if SCHEDULER_MODE == "embedded":
+        scheduler.add_job(campaign_for_leadership, 'interval', seconds=SCHEDULER_LEADER_RETRY_SECONDS,
+                          id="leader-election", next_run_time=datetime.now())
+    scheduler.start()
+
+def run_scheduler_process():
+    """`python app.py scheduler`：在 webhook worker 之外執行共用工作（等到取得 leader 鎖為止）"""
+    startup["ready"].wait()
+    print("等待取得排程 leader 鎖...")
+    become_leader(blocking=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        scheduler.shutdown()
+
+# ---------- 啟動與就緒狀態 ----------
+# STARTUP_MODE=eager（預設）：import 時就完成工作表檢查、索引與價格表載入，再開始服務。
+# STARTUP_MODE=lazy：import 後立即可服務，預熱在背景執行；未預熱完成前的請求會按需載入。
+STARTUP_MODE = os.getenv("STARTUP_MODE", "eager")
+startup = {
+    "ready": threading.Event(),
+    "import_ms": None,
+    "warm_up_ms": None,
+    "first_request_ms": None,
+    "error": None,
+}
+
+def elapsed_ms():
+    return round((time.perf_counter() - PROCESS_STARTED) * 1000, 1)
+
+def warm_up():
+    started = time.perf_counter()
+    try:
+        workbook.worksheet("訂單清單")
+        workbook.worksheet("已取消訂單")
+        order_repo.is_empty()
+        price_cache.get()
+        sales_stats.rebuild()
+    except Exception as e:
+        startup["error"] = str(e)
+        print(f"啟動預熱時發生錯誤: {e}")
+    start_scheduler()
+    startup["warm_up_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    startup["ready"].set()
+
+@app.before_request
+def record_first_request():
+    if startup["first_request_ms"] is None:
+        startup["first_request_ms"] = elapsed_ms()
+        print(f"冷啟動：import 完成 {startup['import_ms']} ms，第一個請求於 {startup['first_request_ms']} ms 抵達")
+
+metrics.gauge("scheduler_leader", "1 when this process runs the shared scheduled jobs", lambda: int(leader_lock.is_leader()))
+metrics.gauge("session_store_entries", "Conversation sessions currently stored", session_store.size)
+metrics.gauge("order_index_entries", "Orders held in the in-memory index", lambda: len(order_index.rows))
+metrics.gauge("order_journal_pending", "Journaled rows not yet written to Sheets", order_journal.pending_count)
+metrics.gauge("webhook_queue_depth", "LINE events waiting in the async dispatcher", lambda: dispatcher.stats()["queue_depth"])
+metrics.gauge("webhook_dedup_entries", "LINE event ids remembered for redelivery checks", event_dedup.size)
+metrics.gauge("webhook_rejected_total", "LINE events rejected because the dispatcher queue was full", lambda: dispatcher.stats()["rejected"])
+if ORDER_BACKEND == "sqlite" and ORDER_SHEET_MIRROR:
+    metrics.gauge("order_mirror_dead_ops", "Order changes that could not be mirrored to the sheet (outbox_dead)", order_repo.dead_count)
+
+@app.route("/metrics", methods=['GET'])
+def metrics_route():
+    require_token(METRICS_TOKEN)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/readyz", methods=['GET'])
+def readyz():
+    ready = startup["ready"].is_set()
+    body = {k: v for k, v in startup.items() if k != "ready"}
+    body.update(ready=ready, mode=STARTUP_MODE)
+    return jsonify(body), (200 if ready else 503)
+
+@app.route("/scheduler", methods=['GET'])
+def scheduler_status():
+    require_token(METRICS_TOKEN)
+    return jsonify(mode=SCHEDULER_MODE, pid=os.getpid(), leader=leader_lock.is_leader(), jobs=job_ledger.summary())
+
+if STARTUP_MODE == "lazy":
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+else:
+    warm_up()
+startup["import_ms"] = elapsed_ms()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
+    if sys.argv[1:2] == ["scheduler"]:
+        run_scheduler_process()
+    else:
+        app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
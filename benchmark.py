@@ -0,0 +1,567 @@
+"""
+離線壓力測試：以記憶體中的假 Google Sheets / LINE API 取代外部服務，
+重播簽章正確的 webhook 請求到 /callback，量測延遲、每個事件的 Sheets 呼叫數與記憶體用量。
+
+用法：
+    python benchmark.py --rows 1000 --users 50 --flows 200
+    python benchmark.py --rows 100000 --sheets-latency 0.05 --error-rate 0.01 --json
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import gspread
+import linebot
+import oauth2client.service_account
+
+CHANNEL_SECRET = "benchmark-secret"
+
+
+# ---------- 假 Google Sheets ----------
+class FakeResponse:
+    """提供 gspread.exceptions.APIError 需要的欄位"""
+
+    def __init__(self, status_code, message):
+        self.status_code = status_code
+        self.text = message
+        self._message = message
+
+    def json(self):
+        return {"error": {"code": self.status_code, "message": self._message, "status": str(self.status_code)}}
+
+
+class FakeSheetsBackend:
+    """所有假工作表共用的設定與統計：延遲、錯誤注入、每分鐘讀寫配額"""
+
+    READS = {"get_all_values", "get_all_records", "row_values", "col_values", "get", "batch_get", "get_lastUpdateTime"}
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, read_quota=0, write_quota=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.read_quota = read_quota
+        self.write_quota = write_quota
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.window = {"read": [], "write": []}
+
+    def call(self, method):
+        kind = "read" if method in self.READS else "write"
+        with self.lock:
+            self.calls[method] += 1
+            quota = self.read_quota if kind == "read" else self.write_quota
+            now = time.monotonic()
+            window = [t for t in self.window[kind] if now - t < 60]
+            self.window[kind] = window
+            if quota and len(window) >= quota:
+                self.errors["429"] += 1
+                raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded"))
+            window.append(now)
+            failed = self.error_rate and self.random.random() < self.error_rate
+            delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if failed:
+            with self.lock:
+                self.errors["503"] += 1
+            raise gspread.exceptions.APIError(FakeResponse(503, "Backend Error"))
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+
+def a1_to_rowcol(a1):
+    m = re.match(r"^([A-Z]*)(\d*)$", a1.split("!")[-1])
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + ord(ch) - 64
+    return (int(m.group(2)) if m.group(2) else None), (col or None)
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, sheet_id):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows = []
+        self.lock = threading.RLock()
+
+    def _call(self, method):
+        self.spreadsheet.backend.call(method)
+        if method not in FakeSheetsBackend.READS:
+            self.spreadsheet.touch()
+
+    def _parse_range(self, rng):
+        start, _, end = rng.partition(":")
+        r1, c1 = a1_to_rowcol(start)
+        r2, c2 = a1_to_rowcol(end) if end else (r1, c1)
+        return r1 or 1, c1 or 1, r2 or max(len(self.rows), 1), c2
+
+    def get_all_values(self, *args, **kwargs):
+        self._call("get_all_values")
+        with self.lock:
+            width = max([len(r) for r in self.rows] + [0])
+            return [list(r) + [""] * (width - len(r)) for r in self.rows]
+
+    def get_all_records(self, *args, **kwargs):
+        self._call("get_all_records")
+        with self.lock:
+            if not self.rows:
+                return []
+            headers = self.rows[0]
+            return [dict(zip(headers, r + [""] * (len(headers) - len(r)))) for r in self.rows[1:]]
+
+    def row_values(self, row, *args, **kwargs):
+        self._call("row_values")
+        with self.lock:
+            return list(self.rows[row - 1]) if 0 < row <= len(self.rows) else []
+
+    def col_values(self, col, *args, **kwargs):
+        self._call("col_values")
+        with self.lock:
+            return [r[col - 1] if col - 1 < len(r) else "" for r in self.rows]
+
+    def get(self, rng=None, *args, **kwargs):
+        self._call("get")
+        with self.lock:
+            r1, c1, r2, c2 = self._parse_range(rng or "A1")
+            return [list(r[c1 - 1:c2] if c2 else r[c1 - 1:]) for r in self.rows[r1 - 1:r2]]
+
+    def batch_get(self, ranges, *args, **kwargs):
+        self._call("batch_get")
+        with self.lock:
+            result = []
+            for rng in ranges:
+                r1, c1, r2, c2 = self._parse_range(rng)
+                result.append([list(r[c1 - 1:c2] if c2 else r[c1 - 1:]) for r in self.rows[r1 - 1:r2]])
+            return result
+
+    def _write(self, r, c, values):
+        for i, row in enumerate(values):
+            while len(self.rows) < r + i:
+                self.rows.append([])
+            current = self.rows[r + i - 1]
+            while len(current) < c - 1 + len(row):
+                current.append("")
+            for j, v in enumerate(row):
+                current[c - 1 + j] = "" if v is None else str(v)
+
+    def update(self, range_name=None, values=None, *args, **kwargs):
+        self._call("update")
+        if isinstance(range_name, list):
+            range_name, values = "A1", range_name
+        with self.lock:
+            r, c, _, _ = self._parse_range(range_name)
+            self._write(r, c, values)
+
+    def update_cell(self, row, col, value):
+        self._call("update_cell")
+        with self.lock:
+            self._write(row, col, [[value]])
+
+    def batch_update(self, data, *args, **kwargs):
+        self._call("batch_update")
+        with self.lock:
+            for item in data:
+                r, c, _, _ = self._parse_range(item["range"])
+                self._write(r, c, item["values"])
+
+    def batch_clear(self, ranges):
+        self._call("batch_clear")
+        with self.lock:
+            for rng in ranges:
+                r1, c1, r2, c2 = self._parse_range(rng)
+                for row in self.rows[r1 - 1:r2]:
+                    for j in range(c1 - 1, min(c2 or len(row), len(row))):
+                        row[j] = ""
+
+    def append_row(self, values, *args, **kwargs):
+        return self.append_rows([values], _method="append_row")
+
+    def append_rows(self, values, *args, _method="append_rows", **kwargs):
+        self._call(_method)
+        with self.lock:
+            start = len(self.rows) + 1
+            self.rows.extend([["" if v is None else str(v) for v in row] for row in values])
+            end = len(self.rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:N{end}", "updatedRows": len(values)}}
+
+    def delete_rows(self, start, end=None):
+        self._call("delete_rows")
+        with self.lock:
+            del self.rows[start - 1:(end or start)]
+
+    def clear(self):
+        self._call("clear")
+        with self.lock:
+            self.rows = []
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend, title="coffee_orders"):
+        self.backend = backend
+        self.title = title
+        self.id = "fake-spreadsheet-key"
+        self.sheets = {}
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def touch(self):
+        self.updated = time.time()
+
+    def worksheet(self, title):
+        self.backend.call("worksheet")
+        if title not in self.sheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self):
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows=1000, cols=26, *args, **kwargs):
+        self.backend.call("add_worksheet")
+        with self.lock:
+            if title not in self.sheets:
+                self.sheets[title] = FakeWorksheet(self, title, len(self.sheets) + 1)
+            return self.sheets[title]
+
+    def del_worksheet(self, ws):
+        self.backend.call("del_worksheet")
+        self.sheets.pop(ws.title, None)
+
+    def batch_update(self, body):
+        self.backend.call("spreadsheet.batch_update")
+        by_id = {ws.id: ws for ws in self.sheets.values()}
+        for request in body.get("requests", []):
+            rng = request["deleteDimension"]["range"]
+            ws = by_id[rng["sheetId"]]
+            with ws.lock:
+                del ws.rows[rng["startIndex"]:rng["endIndex"]]
+        self.touch()
+        return {}
+
+    def get_lastUpdateTime(self):
+        """與 Drive API 的 modifiedTime 相同格式（RFC 3339，UTC）"""
+        self.backend.call("get_lastUpdateTime")
+        return datetime.fromtimestamp(self.updated, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+class FakeClient:
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open(self, title, *args, **kwargs):
+        self.spreadsheet.backend.call("open")
+        return self.spreadsheet
+
+    def open_by_key(self, key):
+        self.spreadsheet.backend.call("open_by_key")
+        return self.spreadsheet
+
+    def login(self):
+        pass
+
+
+# ---------- 假 LINE Messaging API ----------
+class FakeLineBotApi:
+    """記錄每個 reply token 收到回覆的時間，供計算端到端延遲"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.replied = {}
+        self.messages = []
+
+    def _send(self, method, key, messages):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+        if failed:
+            raise linebot.exceptions.LineBotApiError(500, {}, error=None)
+        messages = messages if isinstance(messages, list) else [messages]
+        with self.lock:
+            self.messages.append((method, key, messages))
+            if method == "reply_message":
+                self.replied[key] = time.perf_counter()
+
+    def reply_message(self, reply_token, messages, *args, **kwargs):
+        self._send("reply_message", reply_token, messages)
+
+    def push_message(self, to, messages, *args, **kwargs):
+        self._send("push_message", to, messages)
+
+    def multicast(self, to, messages, *args, **kwargs):
+        self._send("multicast", tuple(to), messages)
+
+
+# ---------- 測試資料與流量 ----------
+PRODUCTS = [("耶加雪菲", "掛耳包", 50), ("耶加雪菲", "豆子", 400), ("曼特寧", "掛耳包", 45), ("曼特寧", "豆子", 380)]
+
+HEADERS = [
+    "訂單編號", "姓名", "電話", "咖啡品名", "付款方式",
+    "樣式", "數量", "送達地址", "備註", "狀態",
+    "下單時間", "顧客編號", "單價", "總金額"
+]
+
+
+def seed_spreadsheet(spreadsheet, rows, users, rnd):
+    """建立「訂單清單」、「已取消訂單」、「價格表」，回傳每位用戶既有的訂單編號"""
+    orders = spreadsheet.add_worksheet("訂單清單")
+    spreadsheet.add_worksheet("已取消訂單")
+    prices = spreadsheet.add_worksheet("價格表")
+    prices.rows = [["咖啡品名", "樣式", "單價"]] + [[c, s, str(p)] for c, s, p in PRODUCTS]
+    orders.rows = [list(HEADERS)]
+    owned = {u: [] for u in users}
+    for i in range(rows):
+        user = users[i % len(users)]
+        coffee, style, price = PRODUCTS[i % len(PRODUCTS)]
+        qty = 1 + i % 3
+        order_id = f"{i:08x}"
+        day = 1 + i % 28
+        orders.rows.append([
+            order_id, f"顧客{i % 500}", f"09{i % 100000000:08d}", coffee, "匯款", style, str(qty),
+            "台北市", "", "處理中", f"2026-{1 + i % 9:02d}-{day:02d} 12:00", user, str(price), str(price * qty),
+        ])
+        owned[user].append(order_id)
+    return owned
+
+
+def order_text(rnd):
+    coffee, style, _ = rnd.choice(PRODUCTS)
+    return (
+        f"姓名：測試{rnd.randint(1, 999)}\n電話：09{rnd.randint(0, 99999999):08d}\n咖啡品名：{coffee}\n"
+        f"樣式：{style}\n數量：{rnd.randint(1, 3)}\n送達地址：台北市大安區\n備註："
+    )
+
+
+def build_flows(owned, flows, rnd):
+    """依比例產生使用者操作：下單 50%、查詢 25%、修改 15%、刪除 10%"""
+    users = list(owned)
+    plans = []
+    for _ in range(flows):
+        user = rnd.choice(users)
+        kind = rnd.choices(["order", "query", "modify", "delete"], weights=[50, 25, 15, 10])[0]
+        if kind != "order" and not owned[user]:
+            kind = "order"
+        if kind == "order":
+            steps = ["下單", order_text(rnd), rnd.choice(["匯款", "付現"])]
+        elif kind == "query":
+            steps = ["查詢訂單", rnd.choice(owned[user])]
+        elif kind == "modify":
+            steps = ["修改訂單", owned[user].pop(rnd.randrange(len(owned[user]))), order_text(rnd)]
+        else:
+            steps = ["刪除訂單", owned[user].pop(rnd.randrange(len(owned[user])))]
+        plans.append((user, kind, steps))
+    return plans
+
+
+def signed_body(user, text, seq):
+    body = json.dumps({
+        "destination": "benchmark",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "webhookEventId": f"bench-{seq}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"token-{seq}",
+            "source": {"type": "user", "userId": user},
+            "message": {"type": "text", "id": str(seq), "text": text},
+        }],
+    }, ensure_ascii=False)
+    signature = base64.b64encode(hmac.new(CHANNEL_SECRET.encode(), body.encode(), hashlib.sha256).digest()).decode()
+    return body, signature
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def load_app(backend, line_api, workdir, args):
+    """以假服務取代外部連線後載入 app.py"""
+    spreadsheet = FakeSpreadsheet(backend)
+    oauth2client.service_account.ServiceAccountCredentials.from_json_keyfile_name = staticmethod(lambda *a, **k: None)
+    gspread.authorize = lambda *a, **k: FakeClient(spreadsheet)
+    linebot.LineBotApi = lambda *a, **k: line_api
+    os.environ.update({
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "benchmark-token",
+        "ORDER_JOURNAL_PATH": os.path.join(workdir, "order_journal.db"),
+        "ORDER_DB_PATH": os.path.join(workdir, "orders.db"),
+        "SESSION_DB_PATH": os.path.join(workdir, "sessions.db"),
+        "SCHEDULER_LOCK_PATH": os.path.join(workdir, "scheduler.lock"),
+        "SCHEDULER_DB_PATH": os.path.join(workdir, "scheduler.db"),
+        "EVENT_DEDUP_DB_PATH": os.path.join(workdir, "events.db"),
+        "STATUS_NOTIFY_DB_PATH": os.path.join(workdir, "notifications.db"),
+        "ORDER_EXPORT_DIR": os.path.join(workdir, "order_exports"),
+        "ORDER_ARCHIVE_DB_PATH": os.path.join(workdir, "order_archive.db"),
+        "WEBHOOK_ASYNC": "1" if args.async_mode else "0",
+        "STARTUP_MODE": "lazy",
+        "SHEETS_READS_PER_MINUTE": str(args.client_reads_per_minute),
+        "SHEETS_WRITES_PER_MINUTE": str(args.client_writes_per_minute),
+        "SHEETS_BACKOFF_BASE": str(args.backoff_base),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    return spreadsheet
+
+
+def run(args):
+    rnd = random.Random(args.seed)
+    backend = FakeSheetsBackend(
+        latency=args.sheets_latency, jitter=args.sheets_jitter, error_rate=args.error_rate,
+        read_quota=args.read_quota, write_quota=args.write_quota, seed=args.seed,
+    )
+    line_api = FakeLineBotApi(latency=args.line_latency, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix="coffee-bench-")
+    spreadsheet = load_app(backend, line_api, workdir, args)
+
+    users = [f"Ubench{u:05d}" for u in range(args.users)]
+    owned = seed_spreadsheet(spreadsheet, args.rows, users, rnd)
+    plans = build_flows(owned, args.flows, rnd)
+
+    tracemalloc.start()
+    import_started = time.perf_counter()
+    import app as bot
+    bot.startup["ready"].wait(60)
+    import_ms = (time.perf_counter() - import_started) * 1000
+    client = bot.app.test_client()
+
+    warm_calls = backend.total_calls()
+    backend.calls.clear()
+    latencies = []
+    kinds = Counter()
+    seq = [0]
+    seq_lock = threading.Lock()
+
+    def post(user, text):
+        with seq_lock:
+            seq[0] += 1
+            n = seq[0]
+        body, signature = signed_body(user, text, n)
+        sent = time.perf_counter()
+        resp = client.post("/callback", data=body.encode("utf-8"), headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+        return f"token-{n}", sent, resp.status_code
+
+    def run_flow(plan):
+        user, kind, steps = plan
+        results = []
+        for text in steps:
+            token, sent, status = post(user, text)
+            if args.async_mode:
+                deadline = time.perf_counter() + 30
+                while token not in line_api.replied and time.perf_counter() < deadline:
+                    time.sleep(0.001)
+            results.append((token, sent, status))
+        return kind, results
+
+    started = time.perf_counter()
+    statuses = Counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for kind, results in pool.map(run_flow, plans):
+            kinds[kind] += 1
+            for token, sent, status in results:
+                statuses[status] += 1
+                replied = line_api.replied.get(token)
+                if replied is not None:
+                    latencies.append((replied - sent) * 1000)
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    events = sum(statuses.values())
+    sheets_calls = backend.total_calls()
+    return {
+        "rows": args.rows,
+        "users": args.users,
+        "flows": dict(kinds),
+        "events": events,
+        "http_status": {str(k): v for k, v in statuses.items()},
+        "replies": len(latencies),
+        "wall_seconds": round(wall, 3),
+        "events_per_second": round(events / wall, 1) if wall else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p90": round(percentile(latencies, 90), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(max(latencies), 2) if latencies else 0.0,
+        },
+        "sheets_calls": sheets_calls,
+        "sheets_calls_per_event": round(sheets_calls / events, 3) if events else 0.0,
+        "sheets_calls_by_method": dict(backend.calls.most_common()),
+        "sheets_errors": dict(backend.errors),
+        "warm_up_sheets_calls": warm_calls,
+        "line_calls": dict(line_api.calls),
+        "import_ms": round(import_ms, 1),
+        "python_peak_mb": round(peak / 1024 / 1024, 1),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def print_report(result):
+    print(f"訂單列數 {result['rows']}，用戶 {result['users']}，流程 {result['flows']}")
+    print(f"事件 {result['events']}（HTTP {result['http_status']}），收到回覆 {result['replies']}")
+    print(f"耗時 {result['wall_seconds']} s，{result['events_per_second']} events/s")
+    lat = result["latency_ms"]
+    print(f"延遲 p50 {lat['p50']} ms / p90 {lat['p90']} ms / p99 {lat['p99']} ms / max {lat['max']} ms")
+    print(f"Sheets 呼叫 {result['sheets_calls']} 次，每事件 {result['sheets_calls_per_event']} 次（啟動預熱另計 {result['warm_up_sheets_calls']} 次）")
+    print(f"  依方法：{result['sheets_calls_by_method']}")
+    if result["sheets_errors"]:
+        print(f"  注入錯誤：{result['sheets_errors']}")
+    print(f"LINE 呼叫：{result['line_calls']}")
+    print(f"import {result['import_ms']} ms，Python 記憶體峰值 {result['python_peak_mb']} MB，RSS 峰值 {result['max_rss_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="linebot-coffee 離線壓力測試")
+    parser.add_argument("--rows", type=int, default=1000, help="「訂單清單」既有列數")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--flows", type=int, default=200, help="要重播的操作流程數")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--sheets-latency", type=float, default=0.0, help="每次 Sheets 呼叫的延遲（秒）")
+    parser.add_argument("--sheets-jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Sheets 呼叫回傳 503 的機率")
+    parser.add_argument("--read-quota", type=int, default=0, help="每分鐘讀取上限（0 為不限）")
+    parser.add_argument("--write-quota", type=int, default=0, help="每分鐘寫入上限（0 為不限）")
+    parser.add_argument("--client-reads-per-minute", type=float, default=0, help="app 端讀取 token bucket（0 為不限）")
+    parser.add_argument("--client-writes-per-minute", type=float, default=0, help="app 端寫入 token bucket（0 為不限）")
+    parser.add_argument("--backoff-base", type=float, default=0.05, help="429/5xx 退避的起始秒數")
+    parser.add_argument("--line-latency", type=float, default=0.0)
+    parser.add_argument("--async", dest="async_mode", action="store_true", help="以 WEBHOOK_ASYNC=1 模式執行")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出，方便在 review 時比對")
+    args = parser.parse_args()
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+以 benchmark.py 的假 Google Sheets / LINE API 載入 app.py，測試不連線到外部服務。
+"""
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark  # noqa: E402
+from fakes import FakeMirror  # noqa: E402
+
+WORKDIR = tempfile.mkdtemp(prefix="coffee-test-")
+LINE = benchmark.FakeLineBotApi()
+SPREADSHEET = benchmark.load_app(
+    benchmark.FakeSheetsBackend(),
+    LINE,
+    WORKDIR,
+    SimpleNamespace(async_mode=False, client_reads_per_minute=0, client_writes_per_minute=0, backoff_base=0.01),
+)
+benchmark.seed_spreadsheet(SPREADSHEET, 0, ["Utest"], None)
+os.environ.update({
+    "ORDER_BACKEND": "sqlite",
+    # 報表一律由 order_repo 建立快照，不經過欄式匯出檔
+    "ORDER_EXPORT": "0",
+    # 共用排程工作不在測試行程中執行
+    "SCHEDULER_MODE": "standalone",
+})
+
+import app as bot  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    bot.startup["ready"].wait(60)
+    return bot
+
+
+@pytest.fixture
+def line(app):
+    """假 LINE API：messages 為 (方法, 對象, 訊息 list)"""
+    LINE.messages.clear()
+    LINE.calls.clear()
+    return LINE
+
+
+@pytest.fixture
+def mirror(app):
+    return FakeMirror(app.EXPECTED_HEADERS)
+
+
+@pytest.fixture
+def repo(app, mirror, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "MIRROR_RETRY_SECONDS", 0)
+    monkeypatch.setattr(app, "MIRROR_MAX_ATTEMPTS", 3)
+    repo = app.SQLiteOrderRepository(str(tmp_path / "orders.db"), mirror=mirror)
+    # 由測試自己呼叫 replay_outbox，不啟動背景鏡像執行緒
+    monkeypatch.setattr(repo, "notify_mirror", lambda: None)
+    return repo
+
+
+@pytest.fixture
+def sheets_repo(app, tmp_path, monkeypatch):
+    """以假工作表建立的 SheetsOrderRepository（日誌由測試自己送出）"""
+    spreadsheet = benchmark.FakeSpreadsheet(benchmark.FakeSheetsBackend())
+    ws = spreadsheet.add_worksheet("訂單清單")
+    ws.rows = [list(app.EXPECTED_HEADERS)]
+    backup = spreadsheet.add_worksheet("已取消訂單")
+    backup.rows = [list(app.BACKUP_HEADERS)]
+    index = app.OrderIndex(ws)
+
+    def on_flushed(target, rows, first_row):
+        if target == "訂單清單":
+            for i, row in enumerate(rows):
+                index.on_append(row, first_row + i if first_row else None)
+
+    journal = app.OrderJournal(str(tmp_path / "journal.db"), {"訂單清單": ws, "已取消訂單": backup}, on_flushed)
+    monkeypatch.setattr(journal, "start_flusher", lambda: None)
+    index.journal = journal
+    return app.SheetsOrderRepository(ws, index, journal)
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    """可手動推進的 time.time()"""
+    now = [1_800_000_000.0]
+    monkeypatch.setattr(app.time, "time", lambda: now[0])
+
+    def advance(seconds):
+        now[0] += seconds
+
+    return advance
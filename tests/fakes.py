@@ -0,0 +1,84 @@
+"""測試共用的假鏡像與訂單資料"""
+import benchmark
+
+
+class FakeMirror:
+    """記錄鏡像呼叫的「訂單清單」；fail 中的訂單編號寫入時丟出錯誤"""
+
+    def __init__(self, headers):
+        self.headers = list(headers)
+        self.rows = {}
+        self.fail = set()
+
+    def _check(self, order_id):
+        if order_id in self.fail:
+            raise RuntimeError(f"寫入 {order_id} 失敗")
+
+    def all_values(self):
+        return [list(self.headers)] + [list(row) for row in self.rows.values()]
+
+    def add(self, row):
+        self._check(row[0])
+        self.rows[row[0]] = list(row)
+
+    def add_many(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def update(self, order_id, row):
+        self._check(order_id)
+        if order_id not in self.rows:
+            raise LookupError("訂單已被刪除")
+        self.rows[order_id] = list(row)
+
+    def cancel(self, order_id, delete_time):
+        self._check(order_id)
+        if order_id not in self.rows:
+            raise LookupError("訂單已被刪除")
+        del self.rows[order_id]
+
+    def cancel_many(self, order_ids, delete_time, missing_ok=False):
+        for order_id in order_ids:
+            self._check(order_id)
+            if order_id not in self.rows and not missing_ok:
+                raise LookupError("訂單已被刪除")
+            self.rows.pop(order_id, None)
+
+    def set_status(self, order_ids, status, from_statuses=None):
+        i = self.headers.index("狀態")
+        for order_id in order_ids:
+            self._check(order_id)
+            row = self.rows.get(order_id)
+            if row and (from_statuses is None or row[i] in from_statuses):
+                row[i] = status
+
+
+def make_row(app, order_id, customer="U1", status="處理中", order_time="2026-10-01 12:00", qty=2, price=50,
+             coffee="耶加雪菲", style="掛耳包"):
+    row_dict = {
+        "訂單編號": order_id, "姓名": "王小明", "電話": "0900123456", "咖啡品名": coffee, "付款方式": "匯款",
+        "樣式": style, "數量": str(qty), "送達地址": "台北", "備註": "", "狀態": status,
+        "下單時間": order_time, "顧客編號": customer, "單價": str(price), "總金額": str(price * qty),
+    }
+    return [row_dict[h] for h in app.EXPECTED_HEADERS]
+
+
+def status_of(app, row):
+    return row[app.EXPECTED_HEADERS.index("狀態")]
+
+
+def order_sheet(app, *rows):
+    spreadsheet = benchmark.FakeSpreadsheet(benchmark.FakeSheetsBackend())
+    ws = spreadsheet.add_worksheet("訂單清單")
+    ws.rows = [list(app.EXPECTED_HEADERS)] + [list(row) for row in rows]
+    return ws
+
+
+def pending_ops(repo):
+    with repo.connect() as conn:
+        return conn.execute("SELECT op, order_id, attempts FROM outbox WHERE done_at IS NULL ORDER BY id").fetchall()
+
+
+def retry_now(repo):
+    with repo.connect() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_at = 0")
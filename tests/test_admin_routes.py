@@ -0,0 +1,50 @@
+import pytest
+
+
+@pytest.fixture
+def client(app, monkeypatch):
+    monkeypatch.setattr(app, "STATS_TOKEN", "secret")
+    return app.app.test_client()
+
+
+def test_stats_requires_bearer_token(client):
+    assert client.get("/stats").status_code == 403
+    assert client.get("/stats", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    assert client.get("/stats", headers={"Authorization": "Bearer secret"}).status_code == 200
+
+
+def test_token_in_query_string_is_rejected(client):
+    assert client.get("/stats?token=secret").status_code == 403
+
+
+def test_routes_are_closed_when_no_token_is_configured(app, monkeypatch):
+    monkeypatch.setattr(app, "STATS_TOKEN", "")
+    client = app.app.test_client()
+    assert client.get("/stats", headers={"Authorization": "Bearer "}).status_code == 403
+
+
+@pytest.fixture
+def ops_client(app, monkeypatch):
+    monkeypatch.setattr(app, "METRICS_TOKEN", "ops")
+    return app.app.test_client()
+
+
+def test_metrics_requires_metrics_token(ops_client):
+    assert ops_client.get("/metrics").status_code == 403
+    resp = ops_client.get("/metrics", headers={"Authorization": "Bearer ops"})
+    assert resp.status_code == 200
+    assert "# TYPE sheets_calls_total counter" in resp.get_data(as_text=True)
+
+
+def test_callback_stats_requires_metrics_token(ops_client):
+    assert ops_client.get("/callback/stats").status_code == 403
+    resp = ops_client.get("/callback/stats", headers={"Authorization": "Bearer ops"})
+    assert resp.status_code == 200
+    assert resp.get_json()["mode"] == "sync"
+
+
+def test_scheduler_status_requires_metrics_token(ops_client):
+    assert ops_client.get("/scheduler").status_code == 403
+    resp = ops_client.get("/scheduler", headers={"Authorization": "Bearer ops"})
+    assert resp.status_code == 200
+    assert resp.get_json()["mode"] == "standalone"
@@ -0,0 +1,73 @@
+import itertools
+import re
+
+import pytest
+
+import benchmark
+from fakes import make_row, pending_ops, status_of
+
+SEQ = itertools.count(1)
+CART_TEXT = (
+    "姓名：王小明\n電話：0900123456\n咖啡品名：耶加雪菲\n樣式：掛耳包\n數量：2\n"
+    "咖啡品名：曼特寧\n樣式：豆子\n數量：1\n送達地址：台北\n備註："
+)
+
+
+@pytest.fixture
+def chat(app, sheets_repo, line, monkeypatch):
+    """以 Sheets 訂單主檔處理 webhook；回傳送出文字並取得回覆文字的函式"""
+    monkeypatch.setattr(app, "order_repo", sheets_repo)
+    monkeypatch.setattr(app, "session_store", app.MemorySessionStore(600, 100))
+    monkeypatch.setattr(app, "event_dedup", app.MemoryEventDedup(600, 100))
+    client = app.app.test_client()
+
+    def send(text, user="Ucart"):
+        body, signature = benchmark.signed_body(user, text, f"cart-{next(SEQ)}")
+        line.messages.clear()
+        resp = client.post("/callback", data=body.encode("utf-8"),
+                           headers={"X-Line-Signature": signature, "Content-Type": "application/json"})
+        assert resp.status_code == 200
+        return [m.text for _, _, messages in line.messages for m in messages]
+
+    return send
+
+
+def test_cart_order_takes_one_round_trip_per_step_and_cancels_as_a_whole(app, sheets_repo, chat):
+    confirm = chat(CART_TEXT)
+    assert "1. 耶加雪菲 掛耳包 x2" in confirm[-2]
+    assert "付款方式" in confirm[-1]
+
+    placed = chat("匯款")
+    order_id = re.search(r"【訂單編號】：(\S+)", placed[0]).group(1)
+    assert "【總金額】：480" in placed[0]
+    sheets_repo.journal.flush()
+    lines = sheets_repo.order_lines(order_id, "Ucart")
+    assert [row[0] for row in lines] == [f"{order_id}-1", f"{order_id}-2"]
+
+    chat("刪除訂單")
+    deleted = chat(order_id)
+    assert deleted[0].startswith("✅ 已為您刪除以下訂單")
+    assert sheets_repo.order_lines(order_id, "Ucart") == []
+    sheets_repo.journal.flush()
+    backup = sheets_repo.journal.worksheets["已取消訂單"]
+    assert [row[0] for row in backup.rows[1:]] == [f"{order_id}-1", f"{order_id}-2"]
+
+
+def test_cart_with_payment_filled_in_is_placed_immediately(sheets_repo, chat):
+    placed = chat(CART_TEXT + "\n付款方式：付現")
+    assert placed[0].startswith("✅ 訂單已成立")
+    # 付現不附匯款資訊
+    assert len(placed) == 1
+
+
+@pytest.mark.parametrize("backend", ["sheets", "sqlite"])
+def test_cancel_many_rolls_back_when_a_line_is_missing(app, backend, repo, sheets_repo):
+    target = sheets_repo if backend == "sheets" else repo
+    target.add_many([make_row(app, "A-1"), make_row(app, "A-2")])
+
+    with pytest.raises(LookupError):
+        target.cancel_many(["A-1", "A-2", "A-3"], "2026-10-02 09:00")
+
+    assert [status_of(app, target.get(order_id)) for order_id in ("A-1", "A-2")] == ["處理中", "處理中"]
+    if backend == "sqlite":
+        assert [op for op, _, _ in pending_ops(repo)] == ["add_many"]
@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def dedup(app, request, tmp_path, clock):
+    if request.param == "sqlite":
+        return app.SQLiteEventDedup(str(tmp_path / "events.db"), 60, 2)
+    return app.MemoryEventDedup(60, 2)
+
+
+def make_event(event_id, user_id="U1", redelivery=False):
+    return SimpleNamespace(
+        webhook_event_id=event_id,
+        source=SimpleNamespace(user_id=user_id),
+        delivery_context=SimpleNamespace(is_redelivery=redelivery),
+    )
+
+
+def test_event_is_claimed_once_until_released(dedup):
+    assert dedup.claim("E1")
+    assert not dedup.claim("E1")
+
+    dedup.release("E1")
+    assert dedup.claim("E1")
+
+
+def test_claim_expires_after_ttl(dedup, clock):
+    dedup.claim("E1")
+    clock(61)
+    assert dedup.claim("E1")
+
+
+def test_purge_keeps_only_recent_events(dedup, clock):
+    for event_id in ("E1", "E2", "E3"):
+        dedup.claim(event_id)
+        clock(1)
+    dedup.purge()
+    assert dedup.size() == 2
+
+    clock(60)
+    dedup.purge()
+    assert dedup.size() == 0
+
+
+def test_claim_event_drops_redelivered_events(app, monkeypatch):
+    monkeypatch.setattr(app, "event_dedup", app.MemoryEventDedup(60, 10))
+
+    assert app.claim_event(make_event("E1")) == (True, "E1")
+    assert app.claim_event(make_event("E1", redelivery=True)) == (False, "E1")
+    # 沒有任何 ID 的事件不去重
+    assert app.claim_event(SimpleNamespace()) == (True, None)
+
+
+def test_async_worker_releases_event_when_handling_fails(app, monkeypatch):
+    dedup = app.MemoryEventDedup(60, 10)
+    monkeypatch.setattr(app, "event_dedup", dedup)
+
+    def fail(event):
+        raise RuntimeError("處理失敗")
+
+    monkeypatch.setattr(app, "dispatch_event", fail)
+    dispatcher = app.EventDispatcher(1, 10)
+    fresh, key = app.claim_event(make_event("E1"))
+    assert fresh and dispatcher.submit(make_event("E1"), key)
+    dispatcher.queues[0].join()
+
+    # LINE 重送時要能再處理
+    assert app.claim_event(make_event("E1", redelivery=True)) == (True, "E1")
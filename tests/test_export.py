@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from fakes import make_row, status_of
+
+
+@pytest.fixture
+def orders(app, tmp_path, monkeypatch):
+    repo = app.SQLiteOrderRepository(str(tmp_path / "orders.db"))
+    monkeypatch.setattr(app, "order_repo", repo)
+    monkeypatch.setattr(app, "EXPORT_TOKEN", "secret")
+    monkeypatch.setattr(app, "EXPORT_SOURCE", "local")
+    repo.add(make_row(app, "A"))
+    repo.add(make_row(app, "B", status="已送達"))
+    return repo
+
+
+def export(app, method="GET", query=""):
+    client = app.app.test_client()
+    return client.open(f"/export/orders?{query}", method=method, headers={"Authorization": "Bearer secret"})
+
+
+def test_export_requires_token(app, orders):
+    assert app.app.test_client().get("/export/orders").status_code == 403
+
+
+def test_csv_export_does_not_mark(app, orders):
+    body = export(app).get_data(as_text=True)
+
+    lines = body.lstrip("\ufeff").splitlines()
+    assert lines[0].split(",")[0] == "訂單編號"
+    assert [line.split(",")[0] for line in lines[1:]] == ["A", "B"]
+    assert status_of(app, orders.get("A")) == "處理中"
+
+
+def test_marking_only_touches_unshipped_orders_and_reports_the_count(app, orders):
+    body = export(app, "POST", "format=ndjson&mark=1").get_data(as_text=True)
+
+    records = [json.loads(line) for line in body.splitlines()]
+    assert [r["訂單編號"] for r in records[:-1]] == ["A", "B"]
+    assert records[-1] == {"_marked": 1}
+    assert status_of(app, orders.get("A")) == "已出貨"
+    assert status_of(app, orders.get("B")) == "已送達"
+
+
+def test_marking_failure_ends_the_file_with_an_error(app, orders, monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(orders, "set_status", unavailable)
+    body = export(app, "POST", "mark=1").get_data(as_text=True)
+
+    lines = body.splitlines()
+    assert [line.split(",")[0] for line in lines[1:-1]] == ["A", "B"]
+    assert lines[-1] == "#error=database is locked"
+    assert status_of(app, orders.get("A")) == "處理中"
@@ -0,0 +1,71 @@
+import pytest
+
+from fakes import make_row, order_sheet
+
+
+@pytest.fixture
+def journal(app, tmp_path, monkeypatch):
+    ws = order_sheet(app)
+    journal = app.OrderJournal(str(tmp_path / "journal.db"), {"訂單清單": ws})
+    monkeypatch.setattr(journal, "start_flusher", lambda: None)
+    return journal
+
+
+def sheet_ids(journal):
+    return [row[0] for row in journal.worksheets["訂單清單"].rows[1:]]
+
+
+def retry_now(journal):
+    with journal.connect() as conn:
+        conn.execute("UPDATE journal SET next_attempt_at = 0")
+
+
+def test_recorded_rows_are_appended_once_in_one_call(app, journal):
+    assert journal.record("訂單清單", "A", make_row(app, "A"))
+    assert not journal.record("訂單清單", "A", make_row(app, "A", qty=9))
+    assert journal.record_many("訂單清單", [make_row(app, "B-1"), make_row(app, "B-2"), make_row(app, "A")]) == 2
+
+    assert journal.flush() == 3
+    assert sheet_ids(journal) == ["A", "B-1", "B-2"]
+    assert journal.worksheets["訂單清單"].spreadsheet.backend.calls["append_rows"] == 1
+    assert journal.pending_count() == 0
+    assert journal.flush() == 0
+
+
+def test_retry_skips_rows_that_reached_the_sheet(app, journal, monkeypatch):
+    ws = journal.worksheets["訂單清單"]
+    append_rows = ws.append_rows
+
+    def append_then_time_out(rows, *args, **kwargs):
+        append_rows(rows, *args, **kwargs)
+        raise TimeoutError("寫入逾時")
+
+    journal.record_many("訂單清單", [make_row(app, "A"), make_row(app, "B")])
+    monkeypatch.setattr(ws, "append_rows", append_then_time_out)
+    assert journal.flush() == 0
+    assert journal.pending_count() == 2
+
+    monkeypatch.setattr(ws, "append_rows", append_rows)
+    journal.record("訂單清單", "C", make_row(app, "C"))
+    retry_now(journal)
+    assert journal.flush() == 1
+    assert sheet_ids(journal) == ["A", "B", "C"]
+    assert journal.pending_count() == 0
+
+
+def test_failed_flush_backs_off(app, journal, monkeypatch):
+    ws = journal.worksheets["訂單清單"]
+    append_rows = ws.append_rows
+
+    def unavailable(rows, *args, **kwargs):
+        raise RuntimeError("Sheets 暫時無法使用")
+
+    journal.record("訂單清單", "A", make_row(app, "A"))
+    monkeypatch.setattr(ws, "append_rows", unavailable)
+    journal.flush()
+    monkeypatch.setattr(ws, "append_rows", append_rows)
+
+    # 退避時間未到，不重試
+    assert journal.flush() == 0
+    retry_now(journal)
+    assert journal.flush() == 1
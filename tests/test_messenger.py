@@ -0,0 +1,104 @@
+from types import SimpleNamespace
+
+import pytest
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+
+
+class ScriptedLineApi:
+    """依序丟出 errors 中的錯誤，之後成功；calls 記錄 (方法, 對象, 當時的 retry key)"""
+
+    def __init__(self, app, errors=()):
+        self.app = app
+        self.errors = list(errors)
+        self.calls = []
+
+    def _call(self, method, to, messages):
+        self.calls.append((method, to, getattr(self.app.line_retry_key, "value", None)))
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def reply_message(self, reply_token, messages, **kwargs):
+        self._call("reply_message", reply_token, messages)
+
+    def push_message(self, to, messages, **kwargs):
+        self._call("push_message", to, messages)
+
+
+def api_error(status, message="error"):
+    return LineBotApiError(status, {}, error=SimpleNamespace(message=message))
+
+
+@pytest.fixture
+def messenger(app, monkeypatch):
+    monkeypatch.setattr(app, "LINE_BACKOFF_BASE", 0)
+
+    def build(*errors):
+        api = ScriptedLineApi(app, errors)
+        return app.Messenger(api), api
+
+    return build
+
+
+def event(user_id="U1"):
+    return SimpleNamespace(source=SimpleNamespace(user_id=user_id))
+
+
+def test_replies_of_one_event_are_sent_in_one_call(messenger):
+    bot, api = messenger()
+    bot.begin(event())
+    bot.reply_message("T1", TextSendMessage(text="一"))
+    bot.reply_message("T1", [TextSendMessage(text="二")])
+    assert api.calls == []
+
+    bot.flush()
+    assert api.calls == [("reply_message", "T1", None)]
+
+
+def test_expired_reply_token_falls_back_to_push(messenger):
+    bot, api = messenger(api_error(400, "Invalid reply token"))
+    bot.begin(event("U9"))
+    bot.reply_message("T1", TextSendMessage(text="hi"))
+    bot.flush()
+
+    assert [(method, to) for method, to, _ in api.calls] == [("reply_message", "T1"), ("push_message", "U9")]
+
+
+def test_reply_that_may_have_been_delivered_is_not_pushed_again(messenger):
+    # 第一次 500 可能已送達，重試時 token 已被用掉
+    bot, api = messenger(api_error(500), api_error(400, "Invalid reply token"))
+    bot.begin(event("U9"))
+    bot.reply_message("T1", TextSendMessage(text="hi"))
+    bot.flush()
+
+    assert [method for method, _, _ in api.calls] == ["reply_message", "reply_message"]
+
+
+def test_push_retries_reuse_one_retry_key_per_call(messenger):
+    bot, api = messenger(api_error(503), api_error(429))
+    bot.push_message("U1", TextSendMessage(text="一"))
+    bot.push_message("U1", TextSendMessage(text="二"))
+
+    keys = [key for _, _, key in api.calls]
+    assert len(keys) == 4 and None not in keys
+    assert keys[0] == keys[1] == keys[2] != keys[3]
+
+
+def test_pooled_client_sends_the_retry_key_of_its_own_thread(app, monkeypatch):
+    client = app.PooledHttpClient()
+    sent = []
+
+    def post(url, headers=None, data=None, timeout=None):
+        sent.append(headers)
+        return SimpleNamespace(status_code=200, headers={}, text="{}", content=b"{}")
+
+    monkeypatch.setattr(client.session, "post", post)
+    app.line_retry_key.value = "key-1"
+    try:
+        client.post("https://api.line.me/v2/bot/message/push", headers={"Authorization": "Bearer x"})
+    finally:
+        app.line_retry_key.value = None
+    client.post("https://api.line.me/v2/bot/message/push", headers={"Authorization": "Bearer x"})
+
+    assert sent[0] == {"Authorization": "Bearer x", "X-Line-Retry-Key": "key-1"}
+    assert sent[1] == {"Authorization": "Bearer x"}
@@ -0,0 +1,68 @@
+import pytest
+
+from fakes import make_row
+
+
+@pytest.fixture
+def orders(app, tmp_path):
+    return app.SQLiteOrderRepository(str(tmp_path / "orders.db"))
+
+
+@pytest.fixture
+def notifier(app, orders, tmp_path, line):
+    return app.StatusNotifier(str(tmp_path / "notifications.db"), orders, app.STATUS_NOTIFY_TEMPLATES)
+
+
+def multicasts(line):
+    return [(tuple(to), messages[0].text) for method, to, messages in line.messages if method == "multicast"]
+
+
+def test_first_run_only_records_current_statuses(app, orders, notifier, line):
+    orders.add(make_row(app, "A", status="已出貨"))
+
+    assert notifier.run() == 0
+    assert notifier.run() == 0
+    assert line.messages == []
+
+
+def test_status_change_is_notified_once_per_customer(app, orders, notifier, line):
+    orders.add(make_row(app, "A"))
+    orders.add(make_row(app, "B"))
+    orders.add(make_row(app, "C", customer="U2"))
+    notifier.run()
+
+    orders.set_status(["A", "B", "C"], "已出貨")
+    assert notifier.run() == 2
+    assert multicasts(line) == [(("U1", "U2"), app.STATUS_NOTIFY_TEMPLATES["已出貨"])]
+    assert notifier.run() == 0
+
+
+def test_order_first_seen_with_notifiable_status_is_notified(app, orders, notifier, line):
+    notifier.run()
+    # 下單後在兩次比對之間就已出貨
+    orders.add(make_row(app, "A", status="已出貨"))
+    orders.add(make_row(app, "B", customer="U2"))
+
+    assert notifier.run() == 1
+    assert multicasts(line) == [(("U1",), app.STATUS_NOTIFY_TEMPLATES["已出貨"])]
+
+
+def test_orders_missing_for_a_while_are_not_notified_again(app, orders, notifier, line, monkeypatch):
+    row = make_row(app, "A", status="已出貨")
+    orders.add(row)
+    notifier.run()
+
+    # 工作表重建期間訂單暫時消失，之後回來
+    orders.archive(["A"])
+    notifier.run()
+    orders.add(row)
+    assert notifier.run() == 0
+
+    # 消失超過 STATUS_NOTIFY_FORGET_HOURS 才忘記
+    orders.archive(["A"])
+    notifier.run()
+    monkeypatch.setattr(app, "STATUS_NOTIFY_FORGET_HOURS", 0)
+    notifier.run()
+    orders.add(row)
+    assert notifier.run() == 1
+    assert line.messages
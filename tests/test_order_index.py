@@ -0,0 +1,45 @@
+from fakes import make_row
+
+
+def loaded(sheets_repo, *rows):
+    sheets_repo.ws.rows += [list(row) for row in rows]
+    sheets_repo.index.check_for_changes()
+    return sheets_repo.index.sync_count
+
+
+def test_own_writes_do_not_trigger_a_resync(app, sheets_repo):
+    synced = loaded(sheets_repo, make_row(app, "A"))
+
+    sheets_repo.update("A", make_row(app, "A", qty=3))
+    sheets_repo.index.check_for_changes()
+
+    assert sheets_repo.index.sync_count == synced
+
+
+def test_changes_after_own_write_trigger_a_resync(app, sheets_repo):
+    synced = loaded(sheets_repo, make_row(app, "A"))
+
+    sheets_repo.update("A", make_row(app, "A", qty=3))
+    # 另一個 worker 在之後新增了訂單
+    sheets_repo.ws.append_rows([make_row(app, "B", customer="U2")])
+    sheets_repo.index.check_for_changes()
+
+    assert sheets_repo.index.sync_count == synced + 1
+    assert sheets_repo.get("B") is not None
+
+
+def test_lookup_miss_resyncs_at_most_once_per_interval(app, sheets_repo, monkeypatch):
+    monkeypatch.setattr(app, "order_repo", sheets_repo)
+    loaded(sheets_repo, make_row(app, "A"))
+    sheets_repo.ws.append_rows([make_row(app, "B", customer="U2")])
+    # 本行程隨後也寫入：最後更新時間看起來是自己的寫入
+    sheets_repo.update("A", make_row(app, "A", qty=3))
+    sheets_repo.index.check_for_changes()
+    assert sheets_repo.get("B") is None
+
+    rows, archived = app.find_order_lines_for_user("B", "U2")
+    assert [row[0] for row in rows] == ["B"] and not archived
+
+    synced = sheets_repo.index.sync_count
+    assert app.find_order_lines_for_user("C", "U2") == ([], False)
+    assert sheets_repo.index.sync_count == synced
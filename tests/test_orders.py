@@ -0,0 +1,148 @@
+from fakes import make_row, pending_ops, retry_now, status_of
+
+
+# ---------- outbox 重播 ----------
+def test_replay_mirrors_changes_in_order(app, repo, mirror):
+    repo.add(make_row(app, "A"))
+    repo.update("A", make_row(app, "A", qty=3))
+    repo.set_status(["A"], "已出貨")
+
+    assert repo.replay_outbox() == 3
+    assert pending_ops(repo) == []
+    assert mirror.rows["A"] == make_row(app, "A", qty=3, status="已出貨")
+
+
+def test_failing_op_holds_back_only_its_own_order(app, repo, mirror):
+    repo.add(make_row(app, "A"))
+    repo.add(make_row(app, "B"))
+    repo.update("A", make_row(app, "A", qty=3))
+    mirror.fail.add("A")
+
+    assert repo.replay_outbox() == 1
+    assert "B" in mirror.rows
+    # A 的修改排在失敗的新增之後，不能先重播
+    assert pending_ops(repo) == [("add", "A", 1), ("update", "A", 0)]
+
+    mirror.fail.clear()
+    assert repo.replay_outbox() == 2
+    assert mirror.rows["A"] == make_row(app, "A", qty=3)
+
+
+def test_failing_op_backs_off(app, repo, mirror, monkeypatch):
+    monkeypatch.setattr(app, "MIRROR_RETRY_SECONDS", 60)
+    repo.add(make_row(app, "A"))
+    mirror.fail.add("A")
+    assert repo.replay_outbox() == 0
+
+    mirror.fail.clear()
+    # 退避時間未到，不重試
+    assert repo.replay_outbox() == 0
+    retry_now(repo)
+    assert repo.replay_outbox() == 1
+
+
+def test_op_moves_to_dead_letter_after_max_attempts(app, repo, mirror):
+    repo.add(make_row(app, "A"))
+    repo.add(make_row(app, "B"))
+    mirror.fail.add("A")
+
+    for _ in range(3):
+        repo.replay_outbox()
+
+    assert pending_ops(repo) == []
+    assert "B" in mirror.rows
+    with repo.connect() as conn:
+        dead = conn.execute("SELECT op, order_id, attempts, last_error FROM outbox_dead").fetchall()
+    assert dead == [("add", "A", 3, "寫入 A 失敗")]
+
+
+def test_cart_cancel_waits_for_its_failed_add(app, repo, mirror, monkeypatch):
+    monkeypatch.setattr(app, "MIRROR_RETRY_SECONDS", 60)
+    repo.add_many([make_row(app, "X-1"), make_row(app, "X-2")])
+    mirror.fail.add("X-1")
+    assert repo.replay_outbox() == 0
+
+    repo.cancel_many(["X-1", "X-2"], "2026-10-02 09:00")
+    # 整車刪除不能趕在新增之前重播
+    assert repo.replay_outbox() == 0
+    assert [op for op, _, _ in pending_ops(repo)] == ["add_many", "cancel_many"]
+
+    mirror.fail.clear()
+    retry_now(repo)
+    assert repo.replay_outbox() == 2
+    assert mirror.rows == {}
+
+
+def test_status_change_waits_for_its_failed_add(app, repo, mirror, monkeypatch):
+    monkeypatch.setattr(app, "MIRROR_RETRY_SECONDS", 60)
+    repo.add(make_row(app, "A"))
+    mirror.fail.add("A")
+    assert repo.replay_outbox() == 0
+
+    repo.set_status(["A"], "已出貨")
+    assert repo.replay_outbox() == 0
+    repo.pull_staff_edits()
+    assert status_of(app, repo.get("A")) == "已出貨"
+
+    mirror.fail.clear()
+    retry_now(repo)
+    assert repo.replay_outbox() == 2
+    assert status_of(app, mirror.rows["A"]) == "已出貨"
+    repo.pull_staff_edits()
+    assert status_of(app, repo.get("A")) == "已出貨"
+
+
+def test_failed_batch_op_holds_back_later_ops_of_its_orders(app, repo, mirror, monkeypatch):
+    repo.add(make_row(app, "A"))
+    repo.add(make_row(app, "B"))
+    repo.replay_outbox()
+    monkeypatch.setattr(app, "MIRROR_RETRY_SECONDS", 60)
+    repo.set_status(["A", "B"], "已出貨")
+    repo.update("A", make_row(app, "A", qty=3, status="已出貨"))
+    mirror.fail.add("B")
+
+    assert repo.replay_outbox() == 0
+    assert [op for op, _, _ in pending_ops(repo)] == ["status", "update"]
+
+
+def test_changes_after_a_dead_lettered_add_are_parked(app, repo, mirror):
+    repo.add(make_row(app, "A"))
+    mirror.fail.add("A")
+    for _ in range(3):
+        repo.replay_outbox()
+    mirror.fail.clear()
+
+    repo.update("A", make_row(app, "A", qty=3))
+    assert repo.replay_outbox() == 0
+    assert pending_ops(repo) == []
+    assert repo.dead_count() == 2
+    assert "A" not in mirror.rows
+
+
+def test_update_and_cancel_of_rows_missing_from_sheet_count_as_done(app, repo, mirror):
+    repo.add(make_row(app, "A"))
+    repo.add(make_row(app, "B"))
+    repo.replay_outbox()
+    # 員工手動刪除了試算表上的列
+    mirror.rows.clear()
+
+    repo.update("A", make_row(app, "A", qty=5))
+    repo.cancel("B", "2026-10-02 09:00")
+
+    assert repo.replay_outbox() == 2
+    assert pending_ops(repo) == []
+    assert mirror.rows == {}
+
+
+def test_pull_staff_edits_keeps_unmirrored_local_status(app, repo, mirror):
+    repo.add(make_row(app, "A"))
+    repo.add(make_row(app, "B"))
+    repo.replay_outbox()
+    repo.set_status(["A"], "已出貨")
+    mirror.rows["B"][app.EXPECTED_HEADERS.index("狀態")] = "已送達"
+
+    repo.pull_staff_edits()
+
+    # A 的新狀態還在 outbox，不被試算表上的舊值蓋回；B 是員工的修改
+    assert status_of(app, repo.get("A")) == "已出貨"
+    assert status_of(app, repo.get("B")) == "已送達"
@@ -0,0 +1,78 @@
+import threading
+import time
+
+
+class CountingLoader:
+    def __init__(self, *results, delay=0.0):
+        self.results = list(results)
+        self.delay = delay
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.delay:
+            time.sleep(self.delay)
+        result = self.results.pop(0) if len(self.results) > 1 else self.results[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_cold_cache_loads_once_for_concurrent_requests(app):
+    loader = CountingLoader({("耶加雪菲", "掛耳包"): 50}, delay=0.05)
+    cache = app.PriceCache(loader, 60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert loader.calls == 1
+    assert results == [{("耶加雪菲", "掛耳包"): 50}] * 8
+
+
+def test_expired_prices_are_served_while_one_request_refreshes(app, clock):
+    loader = CountingLoader({"old": 1}, {"new": 2})
+    cache = app.PriceCache(loader, 60)
+    assert cache.get() == {"old": 1}
+    clock(61)
+
+    loader.started.clear()
+    loader.release.clear()
+    refresher = threading.Thread(target=cache.get)
+    refresher.start()
+    assert loader.started.wait(5)
+    # 另一個請求不等待重新讀取
+    assert cache.get() == {"old": 1}
+
+    loader.release.set()
+    refresher.join()
+    assert cache.get() == {"new": 2}
+    assert loader.calls == 2
+
+
+def test_failed_refresh_keeps_last_prices_and_waits_before_retrying(app, clock):
+    loader = CountingLoader({"old": 1}, RuntimeError("Sheets 暫時無法使用"), {"new": 2})
+    cache = app.PriceCache(loader, 60)
+    cache.get()
+    clock(61)
+
+    assert cache.get() == {"old": 1}
+    assert cache.get() == {"old": 1}
+    assert loader.calls == 2
+    clock(31)
+    assert cache.get() == {"new": 2}
+
+
+def test_invalidate_reloads_on_next_request(app):
+    loader = CountingLoader({"old": 1}, {"new": 2})
+    cache = app.PriceCache(loader, 60)
+    cache.get()
+    cache.invalidate()
+    assert cache.get() == {"new": 2}
@@ -0,0 +1,68 @@
+import pytest
+
+from fakes import make_row, order_sheet
+
+
+# ---------- 每月統計 ----------
+def snapshot(app, rows, version):
+    return app.OrderSnapshot([list(app.EXPECTED_HEADERS)] + rows, version)
+
+
+def summary_rows(table):
+    return [tuple(row) for row in table[1:]]
+
+
+def test_monthly_summary_recomputes_only_changed_months(app):
+    summary = app.MonthlySummary()
+    rows = [
+        make_row(app, "A", order_time="2026-09-05 10:00", qty=1),
+        make_row(app, "B", order_time="2026-10-01 12:00", qty=2),
+        make_row(app, "C", order_time="2026-10-03 12:00", qty=1),
+    ]
+    assert summary.apply(snapshot(app, rows, 1)) == {"2026-09", "2026-10"}
+    assert summary_rows(summary.table()) == [
+        ("2026-09", "耶加雪菲", "掛耳包", "50", "1", "50"),
+        ("2026-10", "耶加雪菲", "掛耳包", "50", "3", "150"),
+    ]
+
+    # 只有十月的快照：C 被刪除，九月維持原狀
+    october = snapshot(app, rows[1:2], 2)
+    partial = app.OrderSnapshot.from_frame(october.frame, 2, months={"2026-10"})
+    assert summary.apply(partial) == {"2026-10"}
+    assert summary.watermark == 2
+    assert summary_rows(summary.table()) == [
+        ("2026-09", "耶加雪菲", "掛耳包", "50", "1", "50"),
+        ("2026-10", "耶加雪菲", "掛耳包", "50", "2", "100"),
+    ]
+
+
+@pytest.fixture
+def monthly_report(app, tmp_path, monkeypatch):
+    repo = app.SQLiteOrderRepository(str(tmp_path / "report_orders.db"))
+    monkeypatch.setattr(app, "order_repo", repo)
+    report = app.REPORTS["每月統計"]
+    for key in ("version", "written", "months"):
+        monkeypatch.setitem(report, key, None if key != "months" else {})
+    app.monthly_summary.reset()
+    yield repo
+    app.monthly_summary.reset()
+
+
+def test_monthly_report_recomputes_after_failed_write(app, monthly_report, monkeypatch):
+    monthly_report.add(make_row(app, "A", order_time="2026-10-01 12:00", qty=2))
+    ws = order_sheet(app)
+
+    def unavailable(title):
+        raise RuntimeError("Sheets 暫時無法使用")
+
+    monkeypatch.setattr(app, "get_report_ws", unavailable)
+    app.run_reports(["每月統計"], force=True)
+    # 寫入失敗：累計值與水位一併清除，下次不會誤判為已寫入
+    assert app.monthly_summary.watermark is None
+    assert app.monthly_summary.totals == {}
+
+    monkeypatch.setattr(app, "get_report_ws", lambda title: ws)
+    ws.rows = []
+    app.run_reports(["每月統計"], force=True)
+    assert summary_rows(ws.rows) == [("2026-10", "耶加雪菲", "掛耳包", "50", "2", "100")]
+    assert app.monthly_summary.watermark == monthly_report.version()
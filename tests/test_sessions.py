@@ -0,0 +1,49 @@
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(app, request, tmp_path, clock):
+    if request.param == "sqlite":
+        return app.SQLiteSessionStore(str(tmp_path / "sessions.db"), 60, 2)
+    return app.MemorySessionStore(60, 2)
+
+
+def test_saved_session_is_returned_until_cleared(app, store):
+    assert store.get("U1") == {"state": "init"}
+    store.save("U1", app.new_session("await_order", temp_order={"name": "王小明"}))
+
+    assert store.get("U1") == {"state": "await_order", "temp_order": {"name": "王小明"}}
+    store.clear("U1")
+    assert store.get("U1") == {"state": "init"}
+
+
+def test_idle_sessions_expire_and_reads_count_as_use(app, store, clock):
+    store.save("U1", app.new_session("await_order"))
+    store.save("U2", app.new_session("await_order"))
+    clock(50)
+    assert store.get("U1")["state"] == "await_order"
+
+    clock(20)
+    assert store.get("U1")["state"] == "await_order"
+    assert store.get("U2")["state"] == "init"
+
+
+def test_least_recently_used_session_is_evicted(app, store, clock):
+    for user in ("U1", "U2"):
+        store.save(user, app.new_session("await_order"))
+        clock(1)
+    store.get("U1")
+    clock(1)
+    store.save("U3", app.new_session("await_order"))
+    store.purge()
+
+    assert store.size() == 2
+    assert store.get("U2")["state"] == "init"
+    assert store.get("U1")["state"] == "await_order"
+
+
+def test_purge_drops_expired_sessions(app, store, clock):
+    store.save("U1", app.new_session("await_order"))
+    clock(61)
+    store.purge()
+    assert store.size() == 0
@@ -0,0 +1,43 @@
+import gspread
+
+import benchmark
+from fakes import make_row, status_of
+
+
+def api_error(status):
+    return gspread.exceptions.APIError(benchmark.FakeResponse(status, "Backend Error"))
+
+
+def test_gateway_retries_idempotent_calls(app, monkeypatch):
+    monkeypatch.setattr(app, "SHEETS_BACKOFF_BASE", 0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise api_error(503)
+        return "ok"
+
+    assert app.sheets_gateway.execute("read", "get", flaky) == "ok"
+    assert len(calls) == 3
+
+
+def test_row_deletes_are_not_resent_after_server_errors(app, sheets_repo, monkeypatch):
+    monkeypatch.setattr(app, "SHEETS_BACKOFF_BASE", 0)
+    sheets_repo.ws.rows += [make_row(app, "A", status=app.TOMBSTONE_STATUS), make_row(app, "B")]
+    calls = []
+
+    def lost_response(body):
+        # 刪除其實已完成，但回應是 503
+        calls.append(body)
+        benchmark.FakeSpreadsheet.batch_update(sheets_repo.ws.spreadsheet, body)
+        raise api_error(503)
+
+    monkeypatch.setattr(sheets_repo.ws.spreadsheet, "batch_update", lost_response)
+
+    assert sheets_repo.compact() == 0
+    assert len(calls) == 1
+    # B 往上移到第 2 列，不能被重送的刪除誤刪；索引已依試算表重新同步
+    assert [row[0] for row in sheets_repo.ws.rows[1:]] == ["B"]
+    assert sheets_repo.index.get("B")[0] == 2
+    assert status_of(app, sheets_repo.index.get("B")[1]) == "處理中"
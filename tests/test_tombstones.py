@@ -0,0 +1,62 @@
+import json
+
+import gspread
+import pytest
+
+import benchmark
+from fakes import make_row, order_sheet
+
+
+def test_cancelled_order_is_gone_and_backed_up(app, repo):
+    repo.add(make_row(app, "A"))
+    repo.cancel("A", "2026-10-02 09:00")
+
+    assert repo.get("A") is None
+    assert repo.list_by_customer("U1") == []
+    with repo.connect() as conn:
+        backup = conn.execute("SELECT row_json FROM cancelled_orders WHERE order_id = 'A'").fetchone()
+    assert json.loads(backup[0])[0] == "A"
+    with pytest.raises(LookupError):
+        repo.cancel("A", "2026-10-02 09:01")
+
+
+def test_index_treats_tombstoned_rows_as_missing(app):
+    ws = order_sheet(app, make_row(app, "A"), make_row(app, "B", status=app.TOMBSTONE_STATUS))
+    index = app.OrderIndex(ws)
+
+    assert index.get("A")[0] == 2
+    assert index.get("B") is None
+    assert [row[0] for _, row in index.for_customer("U1")] == ["A"]
+
+
+def test_verify_returns_none_for_row_tombstoned_on_sheet(app):
+    ws = order_sheet(app, make_row(app, "A"))
+    index = app.OrderIndex(ws)
+    assert index.get("A") is not None
+
+    # 另一個 worker 把這列標記為 tombstone，本行程的索引還沒同步
+    ws.rows[1][app.EXPECTED_HEADERS.index("狀態")] = app.TOMBSTONE_STATUS
+
+    assert index.verify("A") is None
+    assert index.get("A") is None
+    assert index.is_empty()
+
+
+def test_backup_is_written_only_after_tombstone_is_marked(app, sheets_repo, monkeypatch):
+    sheets_repo.ws.rows.append(make_row(app, "A"))
+    update = sheets_repo.ws.update
+
+    def unavailable(*args, **kwargs):
+        raise gspread.exceptions.APIError(benchmark.FakeResponse(400, "Bad Request"))
+
+    monkeypatch.setattr(sheets_repo.ws, "update", unavailable)
+    with pytest.raises(gspread.exceptions.APIError):
+        sheets_repo.cancel("A", "2026-10-02 09:00")
+    assert sheets_repo.journal.pending_rows("已取消訂單") == []
+    assert sheets_repo.index.get("A") is not None
+
+    monkeypatch.setattr(sheets_repo.ws, "update", update)
+    sheets_repo.cancel("A", "2026-10-02 09:00")
+    sheets_repo.journal.flush()
+    assert [row[0] for row in sheets_repo.journal.worksheets["已取消訂單"].rows[1:]] == ["A"]
+    assert sheets_repo.index.get("A") is None